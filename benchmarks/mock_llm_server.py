@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dialogue_history import SUMMARY_SYSTEM_PROMPT
+from evaluation import CATEGORY_TITLES, EVALUATOR_SYSTEM_PROMPT
+from scenarios_data import SCENARIOS
+
+# --- Заглушка OpenAI-совместимого сервера LLM ---
+# Отвечает на /v1/chat/completions (обычный и потоковый режим) и /v1/models так же, как
+# KoboldCpp, но без модели: тип ответа выбирается по системному промпту (пациент, консультант,
+# оценщик, генератор сценариев, сжатие истории). Задержка до первого токена, скорость
+# генерации и число одновременно обслуживаемых запросов (слотов) настраиваются, поэтому
+# можно воспроизводить и быстрый GPU-сервер, и медленный однопоточный CPU-узел.
+# Доля испорченных JSON-ответов (--malformed-json-rate — чинится парсером, --broken-json-rate —
+# не чинится) проверяет путь разбора ответов оценщика и генератора.
+#
+#   python benchmarks/mock_llm_server.py --port 5002 --ttft 0.3 --tokens-per-second 25 --slots 1
+
+PATIENT_REPLIES = [
+    "Доктор, у меня болит живот уже второй день, особенно справа внизу.",
+    "Началось вчера вечером, сначала болело вокруг пупка, потом сместилось.",
+    "Температура была тридцать семь и восемь, подташнивает, аппетита нет.",
+    "Раньше такого не было. Лекарства постоянно не принимаю, аллергии нет.",
+    "Когда иду или кашляю, боль усиливается. Лежать на боку чуть легче.",
+]
+CONSULTANT_REPLY = "Коллега, по описанию картина соответствует острому процессу. Рекомендую уточнить данные осмотра, оценить лабораторные маркеры воспаления и при сохранении симптомов — инструментальное исследование."
+SUMMARY_REPLY = "Пациент жалуется на боль в животе в течение суток, сопровождающуюся субфебрильной температурой и тошнотой. Осмотр и назначения проведены."
+
+
+def evaluation_reply(rng):
+    scores = {category: rng.randint(3, 10) for category in CATEGORY_TITLES}
+    return {"overall_score": round(sum(scores.values()) / len(scores)),
+            "score_breakdown": {category: {"score": score, "comments": f"Оценка раздела: {title}."} for (category, title), score in zip(CATEGORY_TITLES.items(), scores.values())},
+            "identified_scenario_mistakes_ids": [], "general_feedback": {"positive_aspects": ["Последовательный сбор анамнеза."], "areas_for_improvement": ["Уточнить план обследования."]},
+            "time_management_comment": "Время использовано рационально.", "consultation_impact_comment": "Консультации не повлияли на итог."}
+
+
+def scenario_reply(rng):
+    return dict(rng.choice(SCENARIOS), id=f"generated_{uuid.uuid4().hex[:8]}")
+
+
+def spoil_json(text, broken):
+    # Испорченный JSON: обрыв на середине (не чинится) или висячая запятая и обертка в ```json (чинится).
+    if broken: return text[:max(1, len(text) // 2)]
+    return "Вот результат:\n```json\n" + text[:-1] + ",}\n```"
+
+
+class MockLLMState:
+    def __init__(self, ttft, tokens_per_second, slots, malformed_json_rate, broken_json_rate, seed):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.slots = threading.Semaphore(slots)
+        self.malformed_json_rate = malformed_json_rate
+        self.broken_json_rate = broken_json_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.counters = {"requests": 0, "streamed": 0, "malformed_json": 0, "broken_json": 0}
+        self.counters_lock = threading.Lock()
+
+    def count(self, name):
+        with self.counters_lock: self.counters[name] += 1
+
+    def reply_text(self, messages):
+        system_prompt = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+        with self.rng_lock:
+            if system_prompt.startswith(EVALUATOR_SYSTEM_PROMPT[:40]): return self._json_text(evaluation_reply(self.rng))
+            if "созданию детализированных медицинских" in system_prompt: return self._json_text(scenario_reply(self.rng))
+            if system_prompt.startswith(SUMMARY_SYSTEM_PROMPT[:40]): return SUMMARY_REPLY
+            if "врач-консультант" in system_prompt: return CONSULTANT_REPLY
+            turn = sum(1 for m in messages if m.get("role") == "user")
+            return PATIENT_REPLIES[(turn - 1) % len(PATIENT_REPLIES)]
+
+    def _json_text(self, data):
+        text = json.dumps(data, ensure_ascii=False)
+        roll = self.rng.random()
+        if roll < self.broken_json_rate: self.count("broken_json"); return spoil_json(text, broken=True)
+        if roll < self.broken_json_rate + self.malformed_json_rate: self.count("malformed_json"); return spoil_json(text, broken=False)
+        return text
+
+
+def split_tokens(text):
+    # Приближение токенов: слово с пробелом; длинные JSON-строки режутся по 4 символа.
+    tokens = []
+    for word in text.split(" "):
+        chunk = word + " "
+        tokens.extend(chunk[i:i + 4] for i in range(0, len(chunk), 4)) if len(chunk) > 12 else tokens.append(chunk)
+    return tokens
+
+
+def make_handler(state):
+    class MockLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status); self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"): self._send_json({"object": "list", "data": [{"id": "local-model", "object": "model"}]})
+            elif self.path.rstrip("/").endswith("/stats"): self._send_json(state.counters)
+            else: self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json({"error": "not found"}, 404); return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            state.count("requests")
+            tokens = split_tokens(state.reply_text(request.get("messages", [])))
+            tokens = tokens[:max(1, int(request.get("max_tokens") or len(tokens)))]
+            with state.slots:  # как однопоточный KoboldCpp: лишние запросы ждут свободного слота
+                time.sleep(state.ttft)
+                if request.get("stream"): self._stream(request, tokens)
+                else:
+                    time.sleep(max(0, len(tokens) - 1) / state.tokens_per_second)
+                    self._send_json({"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion", "created": int(time.time()), "model": "local-model",
+                                     "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens).strip()}, "finish_reason": "stop"}],
+                                     "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}})
+
+        def _stream(self, request, tokens):
+            state.count("streamed")
+            self.send_response(200); self.send_header("Content-Type", "text/event-stream"); self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close"); self.end_headers()
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+            def send(payload): self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")); self.wfile.flush()
+            try:
+                for i, token in enumerate(tokens):
+                    if i: time.sleep(1 / state.tokens_per_second)
+                    send({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": "local-model",
+                          "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+                send({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": "local-model",
+                      "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                if (request.get("stream_options") or {}).get("include_usage"):
+                    send({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": "local-model", "choices": [],
+                          "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}})
+                self.wfile.write(b"data: [DONE]\n\n"); self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # клиент прервал поток (например, JSON уже закрыт)
+            self.close_connection = True
+
+    return MockLLMHandler
+
+
+def start_mock_server(host="127.0.0.1", port=0, ttft=0.2, tokens_per_second=40.0, slots=1, malformed_json_rate=0.0, broken_json_rate=0.0, seed=0):
+    # Запуск в фоновом потоке (для simulate_sessions.py); возвращает (сервер, адрес /v1/).
+    state = MockLLMState(ttft, tokens_per_second, slots, malformed_json_rate, broken_json_rate, seed)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True; server.state = state
+    threading.Thread(target=server.serve_forever, name="mock-llm-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1/"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-совместимая заглушка LLM-сервера для нагрузочных тестов.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5002)
+    parser.add_argument("--ttft", type=float, default=0.2, help="задержка до первого токена, с")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--slots", type=int, default=1, help="сколько запросов обслуживается одновременно")
+    parser.add_argument("--malformed-json-rate", type=float, default=0.0, help="доля JSON-ответов с ошибками, которые чинит парсер")
+    parser.add_argument("--broken-json-rate", type=float, default=0.0, help="доля JSON-ответов, оборванных на середине")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server, base_url = start_mock_server(args.host, args.port, args.ttft, args.tokens_per_second, args.slots, args.malformed_json_rate, args.broken_json_rate, args.seed)
+    print(f"Заглушка LLM: {base_url} (ttft {args.ttft} с, {args.tokens_per_second} ток/с, слотов: {args.slots})")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
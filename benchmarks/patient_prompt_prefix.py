@@ -0,0 +1,127 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from patient_prompt import build_patient_messages, build_patient_system_prompt, make_state_modifier
+from scenarios_data import SCENARIOS
+
+# --- Бенчмарк: переиспользование префикса промпта пациента ---
+# Сравнивает прежнюю раскладку промпта (модификаторы состояния внутри системного промпта)
+# с текущей (неизменный системный промпт, история и модификаторы только дописываются).
+#
+# Без --url считает, сколько символов запроса совпадает с префиксом предыдущего хода и
+# сколько пришлось бы обработать заново (приблизительно число новых токенов, не попавших в KV-кэш).
+# С --url отправляет диалог на KoboldCpp / OpenAI-совместимый сервер и измеряет время до первого токена.
+#
+#   python benchmarks/patient_prompt_prefix.py --turns 12 --trigger-turn 4
+#   python benchmarks/patient_prompt_prefix.py --url http://localhost:5002/v1/ --turns 8
+
+DOCTOR_TURNS = [
+    "Здравствуйте. Что вас беспокоит?", "Когда это началось?", "Опишите, пожалуйста, характер жалоб подробнее.",
+    "Были ли раньше похожие эпизоды?", "Какие лекарства вы принимаете?", "Есть ли у вас аллергия?",
+    "Измеряю температуру.", "Измеряю АД.", "Слушаю легкие.", "Пальпирую живот.", "Назначаю общий анализ крови.",
+    "Курите ли вы? Как часто употребляете алкоголь?", "Есть ли хронические заболевания?", "Как вы спите?",
+]
+STATE_MODIFIER = "Пациент дополнительно сообщил следующее: кстати, доктор, неделю назад у меня была похожая боль."
+
+
+def legacy_messages(scenario, dialogue, state_modifiers):
+    # Раскладка до изменения: модификаторы дописывались в конец системного промпта.
+    system_prompt = f"{build_patient_system_prompt(scenario)}\n" + "\n".join(m["text"] for m in state_modifiers)
+    return [{"role": "system", "content": system_prompt}] + [dict(m) for m in dialogue]
+
+
+def append_only_messages(scenario, dialogue, state_modifiers):
+    return build_patient_messages(build_patient_system_prompt(scenario), dialogue, state_modifiers)
+
+
+LAYOUTS = {"legacy": legacy_messages, "append_only": append_only_messages}
+
+
+def render(messages):
+    # Приближение шаблона чата: сервер видит сообщения как одну последовательность токенов.
+    return "".join(f"<|{m['role']}|>\n{m['content']}\n" for m in messages)
+
+
+def shared_prefix_length(a, b):
+    limit = min(len(a), len(b)); i = 0
+    while i < limit and a[i] == b[i]: i += 1
+    return i
+
+
+def run_offline(scenario, turns, trigger_turn):
+    results = {}
+    for layout_name, build_fn in LAYOUTS.items():
+        dialogue, modifiers, previous_text, per_turn = [], [], "", []
+        for turn in range(1, turns + 1):
+            dialogue.append({"role": "user", "content": DOCTOR_TURNS[(turn - 1) % len(DOCTOR_TURNS)]})
+            request_text = render(build_fn(scenario, dialogue, modifiers))
+            reused = shared_prefix_length(previous_text, request_text)
+            per_turn.append({"turn": turn, "total_chars": len(request_text), "new_chars": len(request_text) - reused})
+            reply = f"Ответ пациента на ход {turn}: чувствую себя так же, доктор."
+            dialogue.append({"role": "assistant", "content": reply})
+            previous_text = request_text + f"<|assistant|>\n{reply}\n"  # сгенерированный ответ тоже остается в кэше
+            if turn == trigger_turn: modifiers.append(make_state_modifier(STATE_MODIFIER, dialogue))
+        results[layout_name] = per_turn
+    return results
+
+
+def run_live(scenario, turns, trigger_turn, base_url, max_tokens):
+    from openai import OpenAI
+    client = OpenAI(base_url=base_url, api_key="sk-not-needed", max_retries=0)
+    results = {}
+    for layout_name, build_fn in LAYOUTS.items():
+        dialogue, modifiers, per_turn = [], [], []
+        for turn in range(1, turns + 1):
+            dialogue.append({"role": "user", "content": DOCTOR_TURNS[(turn - 1) % len(DOCTOR_TURNS)]})
+            messages = build_fn(scenario, dialogue, modifiers)
+            started_at = time.perf_counter(); ttft = None; reply_parts = []
+            stream = client.chat.completions.create(model="local-model", messages=messages, max_tokens=max_tokens, temperature=0.0,
+                                                    stream=True, extra_body={"cache_prompt": True})
+            for chunk in stream:
+                if chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+                    if ttft is None: ttft = time.perf_counter() - started_at
+                    reply_parts.append(chunk.choices[0].delta.content)
+            per_turn.append({"turn": turn, "total_chars": len(render(messages)), "ttft_s": ttft, "total_s": time.perf_counter() - started_at})
+            dialogue.append({"role": "assistant", "content": "".join(reply_parts).strip() or "..."})
+            if turn == trigger_turn: modifiers.append(make_state_modifier(STATE_MODIFIER, dialogue))
+        results[layout_name] = per_turn
+    return results
+
+
+def print_report(results, metric):
+    print(f"{'ход':>4} {'символов':>9} " + " ".join(f"{name:>14}" for name in results))
+    turns = len(next(iter(results.values())))
+    for i in range(turns):
+        row = next(iter(results.values()))[i]
+        values = []
+        for per_turn in results.values():
+            value = per_turn[i].get(metric)
+            values.append(f"{value:>14.3f}" if isinstance(value, float) else f"{value if value is not None else '-':>14}")
+        print(f"{row['turn']:>4} {row['total_chars']:>9} " + " ".join(values))
+    for name, per_turn in results.items():
+        values = [r[metric] for r in per_turn if r.get(metric) is not None]
+        if values: print(f"{name}: сумма {sum(values):.3f}, медиана {statistics.median(values):.3f}, последний ход {values[-1]:.3f} ({metric})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк переиспользования префикса промпта пациента.")
+    parser.add_argument("--url", help="OpenAI-совместимый адрес KoboldCpp (например, http://localhost:5002/v1/); без него — расчет без сервера")
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--trigger-turn", type=int, default=4, help="ход, после которого появляется модификатор состояния")
+    parser.add_argument("--scenario", type=int, default=0, help="индекс сценария в SCENARIOS")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    args = parser.parse_args()
+    scenario = SCENARIOS[args.scenario]
+    if args.url:
+        print_report(run_live(scenario, args.turns, args.trigger_turn, args.url, args.max_tokens), "ttft_s")
+    else:
+        print_report(run_offline(scenario, args.turns, args.trigger_turn), "new_chars")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compiled_scenario import CompiledScenario
+from consultant_prompt import build_consultant_messages, CONSULTANT_MAX_TOKENS, CONSULTANT_TEMPERATURE
+from dialogue_history import DEFAULT_HISTORY_TOKEN_BUDGET, DialogueHistory, summarize_with_llm
+from evaluation import EVALUATION_MODES, EVALUATION_SINGLE, evaluate_with_llm
+from llm_cache import CachingLLMClient
+from llm_grammar import CONSTRAINED_MODES, CONSTRAINED_OFF
+from llm_pool import LLMBackendPool
+from llm_scheduler import PRIORITY_CONSULTANT, PRIORITY_PATIENT, PriorityLLMScheduler
+from patient_prompt import build_patient_messages, make_state_modifier
+from scenarios_data import SCENARIOS
+import telemetry
+from trigger_engine import TriggerEngine
+
+# --- Симулятор сессий и нагрузочный бенчмарк ---
+# Проигрывает сценарные диалоги врача по SCENARIOS без Streamlit, в том же порядке шагов,
+# что и обработчик хода в app.py: триггеры, назначение исследований, ответы на команды
+# осмотра без LLM, сжатие истории, потоковый ответ пациента, выдача результатов исследований;
+# затем консультация и оценка (evaluate_with_llm). N виртуальных пользователей работают
+# параллельно через общий стек клиента LLM приложения (пул узлов + планировщик приоритетов).
+#
+# Отчет: p50/p95 задержки хода и времени до первого токена, задержка консультации и оценки,
+# доля ответов оценщика, которые не удалось разобрать (и которые пришлось чинить), сессий в час.
+# Без --url поднимается заглушка сервера (benchmarks/mock_llm_server.py) с заданными задержками.
+# --json-out сохраняет отчет, --baseline сравнивает с сохраненным и завершается с кодом 1 при регрессии.
+#
+#   python benchmarks/simulate_sessions.py --users 4 --sessions-per-user 3
+#   python benchmarks/simulate_sessions.py --url http://localhost:5002/v1/ --users 2 --json-out baseline.json
+#   python benchmarks/simulate_sessions.py --users 4 --baseline baseline.json --max-regression 0.2
+
+GENERAL_QUESTIONS = [
+    "Здравствуйте. Что вас беспокоит?", "Когда это началось?", "Опишите, пожалуйста, характер жалоб подробнее.",
+    "Были ли раньше похожие эпизоды?", "Какие лекарства вы принимаете?", "Есть ли у вас аллергия?",
+    "Есть ли хронические заболевания?", "Курите ли вы? Как часто употребляете алкоголь?",
+]
+CONSULTATION_QUESTION = "Какой диагноз наиболее вероятен и что назначить в первую очередь?"
+# Метрики, по которым --baseline ищет регрессию (больше — хуже).
+REGRESSION_METRICS = ["turn_latency_s.p50", "turn_latency_s.p95", "ttft_s.p50", "ttft_s.p95", "evaluation_latency_s.p50", "evaluation_latency_s.p95"]
+
+
+def percentile(values, fraction):
+    if not values: return None
+    ordered = sorted(values); position = (len(ordered) - 1) * fraction
+    lower = int(position); upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values):
+    return {"count": len(values), "p50": percentile(values, 0.5), "p95": percentile(values, 0.95), "max": max(values) if values else None}
+
+
+def build_doctor_script(scenario, compiled, turns):
+    # Вопросы чередуются с командами осмотра (кнопки быстрых действий) и назначениями исследований сценария.
+    exam_texts = [text for _, text, _, exam_keys in compiled.quick_exam_actions if exam_keys][:3]
+    investigation_texts = [f"Назначаю {inv_key}." for inv_key in list(scenario.get("available_investigations", {}) or {})[:2]]
+    script, questions = [], list(GENERAL_QUESTIONS)
+    while len(script) < turns:
+        script.append(questions[len(script) % len(questions)])
+        if exam_texts and len(script) % 3 == 2: script.append(exam_texts.pop(0))
+        if investigation_texts and len(script) % 4 == 3: script.append(investigation_texts.pop(0))
+    return script[:turns]
+
+
+class SimulatedSession:
+    def __init__(self, client, scenario, user_id, history_budget=DEFAULT_HISTORY_TOKEN_BUDGET, exam_fast_path=True, streaming=True, timeout=60.0):
+        self.client = client
+        self.scenario = scenario
+        self.user_id = user_id
+        self.compiled = CompiledScenario(scenario)
+        self.trigger_engine = TriggerEngine(scenario)
+        self.dialogue_history = DialogueHistory(history_budget)
+        self.exam_fast_path = exam_fast_path
+        self.streaming = streaming
+        self.timeout = timeout
+        self.messages = [{"role": "assistant", "content": scenario.get("initial_patient_greeting", "Здравствуйте, доктор.")}]
+        self.patient_state_modifiers = []
+        self.pending_investigation_results = {}
+        self.turn = 0
+        self.consultations = []
+        self.turn_stats = []
+
+    def _history_view(self):
+        summarize_fn = lambda previous_summary, messages_to_fold: summarize_with_llm(self.client, previous_summary, messages_to_fold, priority=PRIORITY_PATIENT,
+                                                                                     user_id=self.user_id, timeout=self.timeout, use_cache=True)
+        return self.dialogue_history.compact(self.messages, summarize_fn) if self.dialogue_history.needs_compaction(self.messages) else self.dialogue_history.compact(self.messages)
+
+    def _patient_reply(self, patient_messages, stats):
+        request = dict(priority=PRIORITY_PATIENT, user_id=self.user_id, model="local-model", messages=patient_messages, max_tokens=450, temperature=0.75,
+                       timeout=self.timeout, affinity_key=self.user_id, extra_body={"cache_prompt": True})
+        started_at = time.perf_counter()
+        if not self.streaming:
+            response = self.client.create_chat_completion(**request)
+            stats["ttft_s"] = time.perf_counter() - started_at
+            return (response.choices[0].message.content or "").strip() if response.choices else ""
+        parts = []
+        for chunk in self.client.create_chat_completion(stream=True, **request):
+            delta_text = getattr(chunk.choices[0].delta, "content", None) if chunk.choices else None
+            if not delta_text: continue
+            if "ttft_s" not in stats: stats["ttft_s"] = time.perf_counter() - started_at
+            parts.append(delta_text)
+        return "".join(parts).strip()
+
+    def run_turn(self, text):
+        # Шаги обработчика хода из app.py.
+        started_at = time.perf_counter(); stats = {"turn": self.turn + 1}
+        self.messages.append({"role": "user", "content": text}); self.turn += 1
+        lowered = text.lower()
+        self.trigger_engine.on_user_message(lowered, self.turn)
+        investigations = self.scenario.get("available_investigations") or {}
+        for inv_key in self.compiled.sort_investigations(self.compiled.investigation_matcher.match(lowered)):
+            if inv_key not in self.pending_investigation_results or not self.pending_investigation_results[inv_key]["provided"]:
+                self.pending_investigation_results[inv_key] = {"ready_at_turn": self.turn + investigations[inv_key].get("turn_to_provide_results", 1),
+                                                               "results_text": investigations[inv_key].get("results_text", ""), "provided": False}
+            self.trigger_engine.on_investigation_ordered(inv_key, self.turn)
+        reply = self.compiled.exam_responder.respond(lowered, self.trigger_engine.vitals_overrides()) if self.exam_fast_path else None
+        stats["fast_path"] = bool(reply)
+        if not reply:
+            patient_messages = build_patient_messages(self.compiled.patient_system_prompt, self.messages, self.patient_state_modifiers, history_view=self._history_view())
+            reply = self._patient_reply(patient_messages, stats) or "Пациент задумался и молчит..."
+        parts = [reply]
+        for inv_key, inv_status in sorted(self.pending_investigation_results.items(), key=lambda item: item[1]["ready_at_turn"]):
+            if not inv_status["provided"] and self.turn >= inv_status["ready_at_turn"]:
+                parts.append(f"\n\n📋 **Результаты исследования '{inv_key}':**\n{inv_status['results_text']}"); inv_status["provided"] = True
+        self.messages.append({"role": "assistant", "content": "".join(parts), **({"pinned": True} if len(parts) > 1 else {})})
+        self.trigger_engine.on_patient_message(reply, self.turn)
+        firing = self.trigger_engine.next_firing(self.turn)
+        if firing:
+            stats["trigger"] = True
+            if firing["message"]: self.messages.append(firing["message"])
+            if firing["modifier"]: self.patient_state_modifiers.append(make_state_modifier(firing["modifier"], self.messages))
+        stats["latency_s"] = time.perf_counter() - started_at
+        self.turn_stats.append(stats)
+        return stats
+
+    def consult(self, question=CONSULTATION_QUESTION, specialist="Терапия"):
+        started_at = time.perf_counter()
+        response = self.client.create_chat_completion(
+            priority=PRIORITY_CONSULTANT, user_id=self.user_id, model="local-model",
+            messages=build_consultant_messages(self.messages, question, specialist, self.scenario.get("patient_initial_info_display", ""), self._history_view()),
+            max_tokens=CONSULTANT_MAX_TOKENS, temperature=CONSULTANT_TEMPERATURE, timeout=self.timeout, use_cache=True)
+        self.consultations.append({"specialist": specialist, "request": question, "response": response.choices[0].message.content if response.choices else ""})
+        return time.perf_counter() - started_at
+
+    def evaluate(self, evaluation_mode=EVALUATION_SINGLE, raters=1, constrained_mode=CONSTRAINED_OFF, session_seconds=None):
+        notices = []; started_at = time.perf_counter()
+        result, _ = evaluate_with_llm(self.client, self.scenario, list(self.messages), self.scenario.get("true_diagnosis_internal", ""),
+                                      self.scenario.get("correct_plan_detailed", ""), time_taken_seconds=session_seconds, consultations_count=len(self.consultations),
+                                      user_id=self.user_id, timeout=self.timeout * 5, notify=lambda level, message: notices.append((level, message)),
+                                      constrained_mode=constrained_mode, dialogue_history=self.dialogue_history, scenario_info=self.compiled.evaluation_scenario_info,
+                                      evaluation_mode=evaluation_mode, raters=raters)
+        return {"latency_s": time.perf_counter() - started_at, "parse_failed": any(level == "error" for level, _ in notices),
+                "repaired": any(level == "info" and message.startswith("Ремонт") for level, message in notices),
+                "overall_score": (result or {}).get("overall_score")}
+
+
+def build_client(base_urls, backend_concurrency):
+    pool = LLMBackendPool.from_urls(base_urls, backend_concurrency, health_check_interval=0)
+    return telemetry.InstrumentedLLMClient(CachingLLMClient(PriorityLLMScheduler(pool), None)), pool
+
+
+def run_benchmark(client, args):
+    records = {"turns": [], "consultations": [], "evaluations": [], "errors": []}
+    records_lock = threading.Lock()
+
+    def run_user(user_index):
+        for session_index in range(args.sessions_per_user):
+            scenario = SCENARIOS[(user_index * args.sessions_per_user + session_index) % len(SCENARIOS)]
+            session = SimulatedSession(client, scenario, f"sim-user-{user_index}", history_budget=args.history_budget,
+                                       exam_fast_path=not args.no_exam_fast_path, streaming=not args.no_streaming)
+            session_started_at = time.perf_counter()
+            try:
+                for text in build_doctor_script(scenario, session.compiled, args.turns):
+                    stats = session.run_turn(text)
+                    with records_lock: records["turns"].append(stats)
+                    if args.think_time: time.sleep(args.think_time)
+                if args.consult:
+                    consult_latency = session.consult()
+                    with records_lock: records["consultations"].append(consult_latency)
+                evaluation = session.evaluate(args.evaluation_mode, args.raters, args.constrained_mode, time.perf_counter() - session_started_at)
+                with records_lock: records["evaluations"].append(evaluation)
+            except Exception as e:
+                with records_lock: records["errors"].append(f"{scenario.get('id')}: {e}")
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users, thread_name_prefix="sim-user") as executor:
+        list(executor.map(run_user, range(args.users)))
+    wall_seconds = time.perf_counter() - started_at
+    return build_report(records, wall_seconds, args)
+
+
+def build_report(records, wall_seconds, args):
+    turns, evaluations = records["turns"], records["evaluations"]
+    llm_turns = [t for t in turns if not t.get("fast_path")]
+    return {
+        "config": {"users": args.users, "sessions_per_user": args.sessions_per_user, "turns": args.turns, "consult": args.consult,
+                   "evaluation_mode": args.evaluation_mode, "raters": args.raters, "streaming": not args.no_streaming, "exam_fast_path": not args.no_exam_fast_path},
+        "wall_seconds": wall_seconds,
+        "sessions_completed": len(evaluations),
+        "sessions_per_hour": len(evaluations) / wall_seconds * 3600 if wall_seconds else None,
+        "turn_latency_s": summarize([t["latency_s"] for t in turns]),
+        "llm_turn_latency_s": summarize([t["latency_s"] for t in llm_turns]),
+        "ttft_s": summarize([t["ttft_s"] for t in llm_turns if t.get("ttft_s") is not None]),
+        "fast_path_turns": len(turns) - len(llm_turns),
+        "triggers_fired": sum(1 for t in turns if t.get("trigger")),
+        "consultation_latency_s": summarize(records["consultations"]),
+        "evaluation_latency_s": summarize([e["latency_s"] for e in evaluations]),
+        "json_parse_failure_rate": sum(e["parse_failed"] for e in evaluations) / len(evaluations) if evaluations else None,
+        "json_repair_rate": sum(e["repaired"] for e in evaluations) / len(evaluations) if evaluations else None,
+        "errors": records["errors"],
+    }
+
+
+def metric_value(report, dotted_name):
+    value = report
+    for part in dotted_name.split("."): value = (value or {}).get(part)
+    return value
+
+
+def compare_with_baseline(report, baseline, max_regression):
+    regressions = []
+    for name in REGRESSION_METRICS:
+        current, previous = metric_value(report, name), metric_value(baseline, name)
+        if current is None or not previous: continue
+        change = (current - previous) / previous
+        print(f"{name:<28} {previous:>9.3f} -> {current:>9.3f}  {change:+.1%}")
+        if change > max_regression: regressions.append(name)
+    for name in ["sessions_per_hour"]:
+        current, previous = report.get(name), baseline.get(name)
+        if current and previous:
+            change = (current - previous) / previous
+            print(f"{name:<28} {previous:>9.1f} -> {current:>9.1f}  {change:+.1%}")
+            if -change > max_regression: regressions.append(name)
+    return regressions
+
+
+def print_report(report):
+    def fmt(value): return "-" if value is None else f"{value:.3f}"
+    print(f"Сессий: {report['sessions_completed']} за {report['wall_seconds']:.1f} с ({fmt(report['sessions_per_hour'])} в час)")
+    for name in ["turn_latency_s", "llm_turn_latency_s", "ttft_s", "consultation_latency_s", "evaluation_latency_s"]:
+        stats = report[name]
+        print(f"{name:<24} n={stats['count']:<5} p50={fmt(stats['p50'])}  p95={fmt(stats['p95'])}  max={fmt(stats['max'])}")
+    print(f"Ходов без LLM (команды осмотра): {report['fast_path_turns']}, сработало триггеров: {report['triggers_fired']}")
+    print(f"Ответы оценщика: не разобрано {fmt(report['json_parse_failure_rate'])}, починено {fmt(report['json_repair_rate'])}")
+    for error in report["errors"][:10]: print(f"Ошибка: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симуляция сессий без Streamlit и нагрузочный бенчмарк.")
+    parser.add_argument("--url", action="append", help="OpenAI-совместимый адрес LLM (можно несколько); без него запускается заглушка")
+    parser.add_argument("--users", type=int, default=4, help="одновременных пользователей")
+    parser.add_argument("--sessions-per-user", type=int, default=2)
+    parser.add_argument("--turns", type=int, default=10, help="ходов врача в сессии")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза между ходами врача, с")
+    parser.add_argument("--consult", action=argparse.BooleanOptionalAction, default=True, help="запрашивать консультацию в конце сессии")
+    parser.add_argument("--evaluation-mode", choices=EVALUATION_MODES, default=EVALUATION_SINGLE)
+    parser.add_argument("--raters", type=int, default=1)
+    parser.add_argument("--constrained-mode", choices=CONSTRAINED_MODES, default=CONSTRAINED_OFF)
+    parser.add_argument("--history-budget", type=int, default=DEFAULT_HISTORY_TOKEN_BUDGET)
+    parser.add_argument("--no-streaming", action="store_true")
+    parser.add_argument("--no-exam-fast-path", action="store_true")
+    parser.add_argument("--backend-concurrency", type=int, default=1, help="LLM_BACKEND_MAX_CONCURRENCY для каждого узла")
+    parser.add_argument("--mock-ttft", type=float, default=0.2)
+    parser.add_argument("--mock-tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--mock-slots", type=int, default=1)
+    parser.add_argument("--malformed-json-rate", type=float, default=0.0)
+    parser.add_argument("--broken-json-rate", type=float, default=0.0)
+    parser.add_argument("--json-out", help="сохранить отчет в JSON (базовая линия)")
+    parser.add_argument("--metrics-out", help="сохранить метрики прогона в текстовом формате Prometheus")
+    parser.add_argument("--telemetry-log", help="JSON-лог спанов: stderr или путь к файлу")
+    parser.add_argument("--baseline", help="сравнить с сохраненным отчетом")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="допустимое ухудшение метрик относительно базовой линии")
+    args = parser.parse_args()
+    telemetry.configure_json_logs(args.telemetry_log)
+
+    base_urls = args.url
+    if not base_urls:
+        from mock_llm_server import start_mock_server
+        mock_server, mock_url = start_mock_server(ttft=args.mock_ttft, tokens_per_second=args.mock_tokens_per_second, slots=args.mock_slots,
+                                                  malformed_json_rate=args.malformed_json_rate, broken_json_rate=args.broken_json_rate)
+        base_urls = [mock_url]; print(f"Заглушка LLM: {mock_url}")
+    client, _ = build_client(base_urls, args.backend_concurrency)
+    report = run_benchmark(client, args)
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.metrics_out:
+        with open(args.metrics_out, "w", encoding="utf-8") as f: f.write(telemetry.metrics.render_prometheus())
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.max_regression)
+        if regressions:
+            print(f"Регрессия относительно {args.baseline}: {', '.join(regressions)}"); sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
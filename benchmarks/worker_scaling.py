@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_llm_server import start_mock_server
+from simulate_sessions import GENERAL_QUESTIONS, percentile
+
+# --- Масштабирование по числу процессов приложения ---
+# Нагрузочный тест режима с несколькими процессами (deploy/docker-compose.yml): для каждого
+# значения --workers запускается W процессов, каждый из которых, как отдельный сервер Streamlit,
+# прогоняет скрипт app.py (streamlit.testing AppTest) для своих U пользователей по кругу: выбор
+# готового сценария, затем ходы врача. Все процессы используют общее состояние в одном временном
+# каталоге (хранилище сессий, кэш ответов, пул сценариев, задачи оценки, снимки метрик) — так же,
+# как контейнеры с общим томом. LLM — заглушка с запасом слотов, чтобы узким местом был скрипт.
+#
+# Отчет: ходов в секунду, p50/p95 времени хода, эффективность масштабирования
+# (пропускная способность W процессов / (W × один процесс)) и оценка числа пользователей,
+# которых выдерживает конфигурация при паузе --think-time между ходами (сами процессы ходят
+# без пауз, измеряется предельная пропускная способность). Линейный рост
+# возможен только при числе ядер не меньше W.
+#
+#   python benchmarks/worker_scaling.py --workers 1,2,4 --users-per-worker 4 --duration 60
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def shared_state_env(state_dir, llm_url):
+    return {"KOBOLD_API_URL": llm_url, "SESSION_STORE_PATH": os.path.join(state_dir, "sessions.sqlite3"),
+            "LLM_RESPONSE_CACHE_PATH": os.path.join(state_dir, "llm_cache.sqlite3"), "EVALUATION_RESULTS_DIR": os.path.join(state_dir, "evaluation_results"),
+            "SCENARIO_POOL_PATH": os.path.join(state_dir, "scenario_pool.sqlite3"), "TELEMETRY_SHARED_DIR": os.path.join(state_dir, "metrics")}
+
+
+class SimulatedUser:
+    # Один пользователь — один экземпляр AppTest (своя st.session_state), как вкладка браузера.
+    def __init__(self, user_index, turns):
+        self.user_index = user_index; self.turns = turns; self.app = None; self.turn = 0; self.sessions = 0
+
+    def _start_session(self):
+        from streamlit.testing.v1 import AppTest
+        self.app = AppTest.from_file(APP_PATH, default_timeout=120).run()
+        buttons = [b for b in self.app.button if b.key and b.key.startswith("predef_scn_btn_")]
+        buttons[(self.user_index + self.sessions) % len(buttons)].click().run()
+        self.turn = 0; self.sessions += 1
+
+    def step(self):
+        if self.app is None or self.turn >= self.turns: self._start_session()
+        started = time.perf_counter()
+        self.app.chat_input[0].set_value(GENERAL_QUESTIONS[self.turn % len(GENERAL_QUESTIONS)]).run()
+        self.turn += 1
+        if self.app.exception: raise RuntimeError(str(self.app.exception[0].message))
+        return time.perf_counter() - started
+
+
+def run_worker(args):
+    # Дочерний процесс: готовит пользователей до start_at, затем ходит по кругу до start_at + duration.
+    users = [SimulatedUser(args.worker_index * args.users_per_worker + i, args.turns) for i in range(args.users_per_worker)]
+    for user in users: user._start_session()
+    warmup_overrun = max(0.0, time.time() - args.start_at)
+    time.sleep(max(0.0, args.start_at - time.time()))
+    deadline = args.start_at + args.duration; latencies = []; errors = 0; i = 0
+    while time.time() < deadline:
+        user = users[i % len(users)]; i += 1
+        try: latencies.append(user.step())
+        except Exception as e:
+            errors += 1; user.app = None; print(f"worker {args.worker_index}: {e}", file=sys.stderr)
+    print(json.dumps({"latencies": latencies, "errors": errors, "warmup_overrun_s": warmup_overrun}))
+
+
+def measure(worker_count, args, llm_url):
+    state_dir = tempfile.mkdtemp(prefix=f"vp-scaling-{worker_count}-")
+    env = dict(os.environ, **shared_state_env(state_dir, llm_url))
+    start_at = time.time() + args.warmup
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker-index", str(i), "--start-at", str(start_at), "--duration", str(args.duration),
+                                   "--users-per-worker", str(args.users_per_worker), "--turns", str(args.turns)],
+                                  env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL if not args.verbose else None, text=True)
+                 for i in range(worker_count)]
+    results = []
+    for process in processes:
+        stdout, _ = process.communicate()
+        lines = [line for line in stdout.splitlines() if line.startswith("{")]
+        results.append(json.loads(lines[-1]) if lines else {"latencies": [], "errors": 1, "warmup_overrun_s": 0.0})
+    latencies = [value for r in results for value in r["latencies"]]
+    throughput = len(latencies) / args.duration
+    p50 = percentile(latencies, 0.5)
+    return {"workers": worker_count, "users": worker_count * args.users_per_worker, "turns": len(latencies), "errors": sum(r["errors"] for r in results),
+            "turns_per_s": throughput, "turn_latency_p50_s": p50, "turn_latency_p95_s": percentile(latencies, 0.95),
+            "warmup_overrun_s": max(r["warmup_overrun_s"] for r in results), "state_dir": state_dir,
+            # Пользователь с паузой think_time делает ход раз в (think_time + время хода).
+            "supported_users": throughput * (args.think_time + p50) if p50 is not None and args.think_time else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность приложения в зависимости от числа процессов.")
+    parser.add_argument("--workers", default="1,2,4", help="числа процессов через запятую")
+    parser.add_argument("--users-per-worker", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=8, help="ходов в сессии, после чего пользователь начинает новую")
+    parser.add_argument("--duration", type=float, default=60.0, help="длительность измерения для каждого числа процессов, с")
+    parser.add_argument("--warmup", type=float, default=30.0, help="время на запуск процессов и выбор сценариев, с")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между ходами для оценки числа пользователей, с")
+    parser.add_argument("--url", help="OpenAI-совместимый адрес LLM; без него запускается заглушка")
+    parser.add_argument("--mock-ttft", type=float, default=0.05)
+    parser.add_argument("--mock-tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--mock-slots", type=int, default=64)
+    parser.add_argument("--json-out", help="сохранить отчет в JSON")
+    parser.add_argument("--verbose", action="store_true", help="показывать вывод процессов")
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker_index is not None:
+        run_worker(args); return
+    mock_server = None
+    if args.url: llm_url = args.url
+    else: mock_server, llm_url = start_mock_server(ttft=args.mock_ttft, tokens_per_second=args.mock_tokens_per_second, slots=args.mock_slots)
+    print(f"CPU: {os.cpu_count()}, LLM: {llm_url}")
+    rows = []
+    for worker_count in [int(w) for w in args.workers.split(",") if w.strip()]:
+        row = measure(worker_count, args, llm_url); rows.append(row)
+        base = rows[0]["turns_per_s"] / rows[0]["workers"] if rows[0]["turns_per_s"] else None
+        row["scaling_efficiency"] = row["turns_per_s"] / (worker_count * base) if base else None
+        print(f"процессов {worker_count}: {row['turns_per_s']:.2f} ход/с, p50 {row['turn_latency_p50_s'] or 0:.3f} с, p95 {row['turn_latency_p95_s'] or 0:.3f} с, "
+              f"эффективность {row['scaling_efficiency'] or 0:.0%}" + (f", пользователей при паузе {args.think_time:g} с: {row['supported_users']:.0f}" if row["supported_users"] else "")
+              + (f", ошибок: {row['errors']}" if row["errors"] else "") + (f" (прогрев превышен на {row['warmup_overrun_s']:.1f} с)" if row["warmup_overrun_s"] else ""))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f: json.dump({"cpu_count": os.cpu_count(), "args": vars(args), "results": rows}, f, ensure_ascii=False, indent=2)
+    if mock_server is not None: mock_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
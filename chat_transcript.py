@@ -0,0 +1,35 @@
+import html
+from functools import lru_cache
+
+# --- Статическая часть чата ---
+# Сообщения диалога только дописываются, поэтому ранняя часть истории не меняется между ходами.
+# Она выводится блоками по CHAT_BLOCK_SIZE сообщений: один элемент Markdown на блок вместо пары
+# элементов на сообщение, а HTML блока строится один раз на процесс (кэш общий для всех сессий).
+# Последние сообщения (не меньше CHAT_LIVE_MESSAGES) выводятся обычными st.chat_message.
+
+CHAT_BLOCK_SIZE = 20
+CHAT_LIVE_MESSAGES = 10
+AVATARS = {"user": "🧑‍⚕️", "assistant": "🤒"}
+
+_MESSAGE_HTML = {
+    "user": "<div style='display:flex;gap:0.75rem;padding:0.75rem 1rem;margin-bottom:0.5rem;border-radius:0.5rem;background-color:rgba(240,242,246,0.5);'>"
+            "<div style='font-size:1.25rem;line-height:1.6;'>{avatar}</div><div style='flex:1;min-width:0;'>\n\n{content}\n\n</div></div>",
+    "assistant": "<div style='display:flex;gap:0.75rem;padding:0.75rem 1rem;margin-bottom:0.5rem;'>"
+                 "<div style='font-size:1.25rem;line-height:1.6;'>{avatar}</div><div style='flex:1;min-width:0;'>\n\n{content}\n\n</div></div>",
+}
+
+
+def frozen_message_count(message_count, block_size=CHAT_BLOCK_SIZE, live_messages=CHAT_LIVE_MESSAGES):
+    # Сколько первых сообщений выводится блоками: только целые блоки, границы кратны block_size и не сдвигаются.
+    return max(0, (message_count - live_messages) // block_size * block_size)
+
+
+def message_blocks(messages, frozen_count, block_size=CHAT_BLOCK_SIZE):
+    return [tuple((m["role"], m["content"]) for m in messages[start:start + block_size]) for start in range(0, frozen_count, block_size)]
+
+
+@lru_cache(maxsize=4096)
+def render_message_block(block):
+    # block — кортеж (роль, текст); HTML-разметка в тексте экранируется, Markdown сохраняется.
+    return "\n\n".join(_MESSAGE_HTML.get(role, _MESSAGE_HTML["assistant"]).format(avatar=AVATARS.get(role, "💬"), content=html.escape(content, quote=False))
+                       for role, content in block)
@@ -0,0 +1,189 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from evaluation import CATEGORY_TITLES
+from session_store import COHORT_SESSION_COLUMNS
+
+# --- Аналитика по группе обучающихся ---
+# Оцененные сессии из хранилища загружаются в столбцовые таблицы pandas: сессии, баллы по
+# категориям (строка на категорию) и выявленные ошибки (строка на ошибку). Все агрегаты —
+# векторные groupby без циклов по сессиям. Таблицы догружаются только новыми оценками
+# (по data_version хранилища), а результаты запросов кэшируются до следующей оценки.
+#
+# Фильтры всех запросов: learner_id и scenario_id (None — без фильтра).
+
+SCORE_VALUES = list(range(0, 11))
+
+
+def _share(part, total):
+    return np.where(total > 0, part / np.maximum(total, 1), 0.0)
+
+
+class CohortAnalytics:
+    def __init__(self, session_store):
+        self.session_store = session_store
+        self._lock = threading.Lock()
+        self._version = None
+        self._sessions = pd.DataFrame(columns=COHORT_SESSION_COLUMNS)
+        self._scores = pd.DataFrame(columns=["session_id", "category", "score"])
+        self._mistakes = pd.DataFrame(columns=["session_id", "mistake_id"])
+        self._results = {}
+        self._counters = {"full_loads": 0, "incremental_loads": 0, "cache_hits": 0, "cache_misses": 0}
+
+    # --- Загрузка ---
+    def refresh(self):
+        self._frames()
+
+    def _frames(self):
+        version = self.session_store.data_version()
+        with self._lock:
+            if version != self._version:
+                self._refresh(version); self._version = version; self._results = {}
+            return self._version, self._sessions, self._scores, self._mistakes
+
+    def _refresh(self, version):
+        evaluated_count = version[0] or 0
+        last_evaluation = self._version[1] if self._version else None
+        if last_evaluation is not None and evaluated_count >= len(self._sessions):
+            # Догрузка: сессии с оценками новее последней известной; переоцененные сессии заменяются.
+            delta = self._attach_session_columns(*self._build_frames(self.session_store.cohort_rows(after_evaluation=last_evaluation)))
+            replaced = delta[0]["session_id"].to_numpy()
+            sessions, scores, mistakes = (pd.concat([old[~old["session_id"].isin(replaced)], new], ignore_index=True)
+                                          for old, new in zip((self._sessions, self._scores, self._mistakes), delta))
+            if len(sessions) == evaluated_count:
+                self._sessions, self._scores, self._mistakes = sessions, scores, mistakes
+                self._counters["incremental_loads"] += 1; return
+        # Первая загрузка или удаление истории: таблицы строятся заново.
+        self._sessions, self._scores, self._mistakes = self._attach_session_columns(*self._build_frames(self.session_store.cohort_rows()))
+        self._counters["full_loads"] += 1
+
+    @staticmethod
+    def _build_frames(rows):
+        sessions = pd.DataFrame.from_records(rows["sessions"], columns=COHORT_SESSION_COLUMNS)
+        for column in ["submitted_at", "time_taken_seconds", "consultations_used", "overall_score", "evaluated_at"]:
+            sessions[column] = pd.to_numeric(sessions[column], errors="coerce")
+        sessions["consultations_used"] = sessions["consultations_used"].fillna(0).astype(int)
+        sessions["timer_active"] = sessions["timer_active"].fillna(0).astype(bool)
+        sessions["time_taken_minutes"] = sessions["time_taken_seconds"] / 60
+        scores = pd.DataFrame.from_records(rows["scores"], columns=["session_id", "category", "score"])
+        scores["score"] = pd.to_numeric(scores["score"], errors="coerce")
+        mistakes = pd.DataFrame.from_records(rows["mistakes"], columns=["session_id", "mistake_id"])
+        return sessions, scores, mistakes
+
+    @staticmethod
+    def _attach_session_columns(sessions, scores, mistakes):
+        # Обучающийся и сценарий копируются в строки баллов и ошибок, чтобы фильтр был одной маской.
+        sessions = sessions.reset_index(drop=True)
+        positions = pd.Series(np.arange(len(sessions)), index=sessions["session_id"].to_numpy())
+        attached = []
+        for frame in (scores, mistakes):
+            frame = frame.drop(columns=["learner_id", "scenario_id"], errors="ignore")
+            rows = frame["session_id"].map(positions)
+            frame = frame[rows.notna()].reset_index(drop=True); rows = rows.dropna().to_numpy(dtype=int)
+            frame["learner_id"] = sessions["learner_id"].to_numpy()[rows]; frame["scenario_id"] = sessions["scenario_id"].to_numpy()[rows]
+            attached.append(frame)
+        return (sessions, *attached)
+
+    # --- Запросы ---
+    def _query(self, name, learner_id, scenario_id, compute):
+        version, sessions, scores, mistakes = self._frames()
+        key = (name, learner_id, scenario_id)
+        cached = self._results.get(key)
+        if cached is not None:
+            self._counters["cache_hits"] += 1; return cached
+        self._counters["cache_misses"] += 1
+        frames = []
+        for frame in (sessions, scores, mistakes):
+            mask = np.ones(len(frame), dtype=bool)
+            if learner_id: mask &= (frame["learner_id"] == learner_id).to_numpy()
+            if scenario_id: mask &= (frame["scenario_id"] == scenario_id).to_numpy()
+            frames.append(frame[mask])
+        result = compute(*frames)
+        with self._lock:
+            if self._version == version: self._results[key] = result
+        return result
+
+    def summary(self, learner_id=None, scenario_id=None):
+        def compute(sessions, scores, mistakes):
+            return {"sessions": len(sessions), "learners": sessions["learner_id"].nunique(), "scenarios": sessions["scenario_id"].nunique(),
+                    "mean_score": sessions["overall_score"].mean(), "median_score": sessions["overall_score"].median(),
+                    "mean_time_minutes": sessions["time_taken_minutes"].mean(), "mean_consultations": sessions["consultations_used"].mean()}
+        return self._query("summary", learner_id, scenario_id, compute)
+
+    def category_distribution(self, learner_id=None, scenario_id=None):
+        # Строка на категорию: число оценок, среднее, квартили и число сессий с каждым баллом 0–10.
+        def compute(sessions, scores, mistakes):
+            scored = scores.dropna(subset=["score"])
+            grouped = scored.groupby("category")["score"]
+            stats = pd.DataFrame({"sessions": grouped.size(), "mean": grouped.mean(), "median": grouped.median(),
+                                  "p25": grouped.quantile(0.25), "p75": grouped.quantile(0.75)})
+            counts = scored.assign(score=scored["score"].clip(0, 10).astype(int)).groupby(["category", "score"]).size().unstack(fill_value=0)
+            counts = counts.reindex(columns=SCORE_VALUES, fill_value=0)
+            result = stats.join(counts)
+            order = [c for c in CATEGORY_TITLES if c in result.index] + [c for c in result.index if c not in CATEGORY_TITLES]
+            return result.loc[order]
+        return self._query("category_distribution", learner_id, scenario_id, compute)
+
+    def mistake_frequencies(self, learner_id=None, scenario_id=None):
+        # Частота ошибок сценария: доля оцененных сессий этого сценария, в которых ошибка выявлена.
+        def compute(sessions, scores, mistakes):
+            counts = mistakes.groupby(["scenario_id", "mistake_id"]).size().rename("sessions").reset_index()
+            scenario_sessions = sessions.groupby("scenario_id").size()
+            counts["share"] = _share(counts["sessions"].to_numpy(), counts["scenario_id"].map(scenario_sessions).fillna(0).to_numpy())
+            return counts.sort_values(["sessions", "scenario_id"], ascending=[False, True]).reset_index(drop=True)
+        return self._query("mistake_frequencies", learner_id, scenario_id, compute)
+
+    def correlations(self, learner_id=None, scenario_id=None):
+        # Связь итогового балла со временем, консультациями и таймером (Пирсон и Спирмен).
+        def compute(sessions, scores, mistakes):
+            factors = {"time_taken_minutes": sessions["time_taken_minutes"], "consultations_used": sessions["consultations_used"],
+                       "timer_active": sessions["timer_active"].astype(float)}
+            rows = []
+            for factor, values in factors.items():
+                pair = pd.DataFrame({"x": values, "y": sessions["overall_score"]}).dropna()
+                varies = len(pair) > 2 and pair["x"].nunique() > 1 and pair["y"].nunique() > 1
+                rows.append({"factor": factor, "sessions": len(pair), "pearson": pair["x"].corr(pair["y"]) if varies else np.nan,
+                             "spearman": pair["x"].rank().corr(pair["y"].rank()) if varies else np.nan})
+            return pd.DataFrame(rows).set_index("factor")
+        return self._query("correlations", learner_id, scenario_id, compute)
+
+    def score_by_consultations(self, learner_id=None, scenario_id=None):
+        def compute(sessions, scores, mistakes):
+            grouped = sessions.groupby("consultations_used")["overall_score"]
+            return pd.DataFrame({"sessions": grouped.size(), "mean_score": grouped.mean()})
+        return self._query("score_by_consultations", learner_id, scenario_id, compute)
+
+    def learner_trends(self, learner_id=None, scenario_id=None):
+        # По обучающемуся: число сессий, средний, первый и последний балл и наклон (изменение балла за сессию).
+        def compute(sessions, scores, mistakes):
+            ordered = sessions.dropna(subset=["overall_score"]).sort_values("submitted_at")
+            x = ordered.groupby("learner_id").cumcount().astype(float); y = ordered["overall_score"]
+            sums = pd.DataFrame({"learner_id": ordered["learner_id"], "x": x, "y": y, "xx": x * x, "xy": x * y}).groupby("learner_id").sum()
+            grouped = ordered.groupby("learner_id")["overall_score"]
+            n = grouped.size()
+            variance = sums["xx"] - sums["x"] ** 2 / n
+            trend = ((sums["xy"] - sums["x"] * sums["y"] / n) / variance.where(variance > 0)).rename("trend")
+            result = pd.DataFrame({"sessions": n, "mean_score": grouped.mean(), "first_score": grouped.first(), "last_score": grouped.last(), "trend": trend,
+                                   "last_session_at": ordered.groupby("learner_id")["submitted_at"].max()})
+            return result.sort_values("sessions", ascending=False)
+        return self._query("learner_trends", learner_id, scenario_id, compute)
+
+    def scenario_stats(self, learner_id=None, scenario_id=None):
+        def compute(sessions, scores, mistakes):
+            grouped = sessions.groupby("scenario_id")
+            result = pd.DataFrame({"name": grouped["scenario_name"].first(), "sessions": grouped.size(), "mean_score": grouped["overall_score"].mean(),
+                                   "std_score": grouped["overall_score"].std(), "mean_time_minutes": grouped["time_taken_minutes"].mean(),
+                                   "mean_consultations": grouped["consultations_used"].mean()})
+            return result.sort_values("sessions", ascending=False)
+        return self._query("scenario_stats", learner_id, scenario_id, compute)
+
+    def scenarios(self):
+        # (id, название) сценариев с оценками — для фильтра на панели.
+        _, sessions, _, _ = self._frames()
+        return list(sessions.drop_duplicates("scenario_id")[["scenario_id", "scenario_name"]].itertuples(index=False, name=None))
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "cached_results": len(self._results), **self._counters}
@@ -0,0 +1,43 @@
+from constants import QUICK_EXAM_ACTIONS, QUICK_EXAM_ACTION_KEYS, QUICK_INVESTIGATION_ACTIONS
+from evaluation import build_evaluation_scenario_info
+from exam_responder import ExamResponder
+from keyword_matcher import build_investigation_matcher
+from patient_prompt import build_patient_system_prompt
+
+# --- Скомпилированный сценарий ---
+# Все, что зависит только от сценария, вычисляется один раз при его выборе: системный промпт
+# пациента (с сериализованными данными осмотра и исследований), кнопки быстрых действий,
+# сопоставитель назначений, ответы на команды осмотра, карта типичных ошибок и эталонный блок для оценщика.
+# Перезапуски Streamlit и ходы диалога используют готовые значения.
+
+
+def _widget_key(prefix, label):
+    return prefix + label.replace('°', 'deg').replace('/', '_').replace(' ', '_').replace('(', '').replace(')', '')
+
+
+class CompiledScenario:
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.patient_system_prompt = build_patient_system_prompt(scenario)
+        self.evaluation_scenario_info = build_evaluation_scenario_info(scenario)
+        self.investigation_matcher = build_investigation_matcher(scenario)
+        self.investigation_order = {inv_key: i for i, inv_key in enumerate(scenario.get("available_investigations", {}) or {})}
+        self.mistakes_by_id = {m["id"]: m["description"] for m in scenario.get("common_mistakes", []) if isinstance(m, dict) and "id" in m and "description" in m}
+        self.quick_exam_actions = self._build_quick_exam_actions(scenario.get("physical_exam_findings_prompt_details") or {})
+        self.exam_responder = ExamResponder(scenario.get("physical_exam_findings_prompt_details") or {}, self.quick_exam_actions)
+        self.quick_investigation_actions = [(label, text, _widget_key("quick_investigation_", label)) for label, text in QUICK_INVESTIGATION_ACTIONS.items()]
+
+    def _build_quick_exam_actions(self, exam_details):
+        # (подпись, текст врача, ключ виджета, ключи осмотра в сценарии). Если ни одна кнопка не соответствует
+        # данным сценария (или данных нет), показываются все.
+        scenario_keys = {str(k).lower().strip(): k for k in exam_details}
+        actions = []
+        for label, text in QUICK_EXAM_ACTIONS.items():
+            exam_keys = [scenario_keys[k] for k in QUICK_EXAM_ACTION_KEYS.get(label, [label.lower()]) if k in scenario_keys]
+            if exam_keys: actions.append((label, text, _widget_key("quick_action_", label), exam_keys))
+        if not actions:
+            actions = [(label, text, _widget_key("quick_action_", label), []) for label, text in QUICK_EXAM_ACTIONS.items()]
+        return actions
+
+    def sort_investigations(self, inv_keys):
+        return sorted(inv_keys, key=lambda inv_key: self.investigation_order.get(inv_key, len(self.investigation_order)))
@@ -0,0 +1,80 @@
+# --- Константы ---
+MEDICAL_SPECIALIZATIONS = ["Общая терапия", "Гастроэнтерология", "Кардиология", "Пульмонология", "Неврология", "Эндокринология", "Нефрология (Урология)", "Инфекционные болезни", "Ревматология", "Педиатрия (общие случаи)", "Травматология и Ортопедия (несложные случаи)", "Гинекология (базовые случаи)", "Дерматология", "Психиатрия (базовые случаи)", "Офтальмология (базовые случаи)", "ЛОР (базовые случаи)"]
+AGE_RANGES = {"Младенец/Ребенок (0-5 лет)": (0, 5), "Ребенок (6-12 лет)": (6, 12), "Подросток (13-17 лет)": (13, 17), "Молодой взрослый (18-35 лет)": (18, 35), "Средний возраст (36-60 лет)": (36, 60), "Пожилой (61-80 лет)": (61, 80), "Старческий (81+ лет)": (81, 100)}
+GENDERS = ["Любой", "Мужской", "Женский"]
+DIFFICULTY_LEVELS = ["Легкий", "Средний", "Тяжелый", "Экспертный"]
+
+DIFFICULTY_LEVELS_DETAILS = {
+    "Легкий": {
+        "description": "Симптомы КЛАССИЧЕСКИЕ, один ведущий синдром. Пациент КОНТАКТНЫЙ, ЯСНО излагает, предоставляет всю информацию легко. Результаты физикального осмотра ОДНОЗНАЧНЫ. Диф. диагноз МИНИМАЛЕН. Сопутствующие заболевания ОТСУТСТВУЮТ или не влияют.",
+        "patient_persona_modifier": "Ты очень кооперативный пациент, всегда готов помочь врачу, ясно и полно отвечаешь на все вопросы. Твое состояние не вызывает у тебя сильного беспокойства."
+    },
+    "Средний": {
+        "description": "Симптомы СЛЕГКА АТИПИЧНЫЕ или 2-3 симптома. Возможен один 'красный флаг'. Пациент может быть НЕМНОГО ВСТРЕВОЖЕН, давать информацию НЕ СРАЗУ, а после уточняющих вопросов. Результаты осмотра могут требовать ИНТЕРПРЕТАЦИИ. Диф. диагноз с 1-2 состояниями. 1-2 НЕКРИТИЧНЫХ сопутствующих заболевания.",
+        "patient_persona_modifier": "Ты пациент, который немного обеспокоен своим состоянием. Ты стараешься отвечать на вопросы, но иногда можешь что-то упустить, если врач не спросит прямо. Иногда можешь переспросить или выразить легкое волнение."
+    },
+    "Тяжелый": {
+        "description": "Симптомы АТИПИЧНЫЕ, МНОЖЕСТВЕННЫЕ, МАСКИРУЮЩИЕСЯ. Несколько 'красных флагов'. Пациент может быть ТРУДНЫМ В ОБЩЕНИИ (скрытным, раздражительным, многословным и уводящим от темы). Может давать ПРОТИВОРЕЧИВУЮ информацию. Результаты осмотра НЕОДНОЗНАЧНЫ. Обширный ДИФ. ДИАГНОЗ. ЗНАЧИМЫЕ сопутствующие заболевания. Возможны 'ЛОЖНЫЕ СЛЕДЫ'.",
+        "patient_persona_modifier": "Ты сложный пациент. Возможно, ты напуган, раздражен или не доверяешь врачам. Ты можешь быть немногословен, или наоборот, говорить слишком много о несущественных деталях. Врачу придется постараться, чтобы получить от тебя нужную информацию. Твои ответы могут быть не всегда прямыми или полными с первого раза."
+    },
+    "Экспертный": {
+        "description": "Все признаки ТЯЖЕЛОГО + РЕДКИЕ заболевания, СЛОЖНЫЕ ЭТИЧЕСКИЕ ДИЛЕММЫ, необходимость сообщить плохие новости. Пациент с ВЫРАЖЕННЫМИ КОММУНИКАТИВНЫМИ БАРЬЕРАМИ (языковой, психологический). Возможна необходимость принятия решений в условиях ОГРАНИЧЕННЫХ РЕСУРСОВ (симулируется).",
+        "patient_persona_modifier": "Ты очень сложный пациент. У тебя могут быть серьезные психологические проблемы, языковой барьер, или ты можешь быть настроен крайне скептически или враждебно. Возможно, тебе нужно сообщить очень плохие новости, и твоя реакция будет сильной. Твои симптомы могут быть крайне запутанными и указывать на очень редкое заболевание."
+    }
+}
+TIMER_DURATIONS_MINUTES = [10, 15, 20, 25, 30, 40, 60]
+MAX_CONSULTATIONS = 3
+# Фразы врача, по которым осмотр считается проведенным (ключи совпадают с physical_exam_findings_prompt_details).
+PHYSICAL_EXAM_KEYWORDS = {
+    "temperature": ["температура", "термометрия"], "blood_pressure": ["ад", "артериальное давление", "давление"],
+    "heart_rate": ["чсс", "частота сердечных сокращений"], "pulse": ["пульс"], "spo2": ["spo2", "сатурация"],
+    "auscultation_lungs": ["слушаю легкие", "аускультация легких", "легкие"], "palpation_abdomen": ["живот"],
+    "throat_inspection": ["горло", "зев"], "skin_appearance": ["кожные покровы", "кожа"], "lymph_nodes": ["лимфоузлы"],
+    "thyroid_palpation": ["щитовидная железа"], "joints_inspection": ["суставы"], "neuro_status_brief": ["неврологический осмотр", "неврологический статус"],
+    "liver_palpation": ["печень"], "spleen_palpation": ["селезенка"], "edema_check": ["отеки"], "peripheral_pulses": ["периферическая пульсация"],
+    "ear_inspection": ["уши", "ушей", "отоскопия"], "nose_inspection": ["нос", "риноскопия"],
+}
+# Подписи результатов осмотра в ответах без LLM (ключи без подписи выводятся как есть).
+PHYSICAL_EXAM_LABELS = {
+    "temperature": "Температура", "blood_pressure": "АД", "heart_rate": "ЧСС", "pulse": "Пульс", "spo2": "SpO2",
+    "respiratory_rate": "ЧДД", "auscultation_lungs": "Аускультация легких", "percussion_lungs": "Перкуссия легких",
+    "palpation_abdomen": "Пальпация живота", "throat_inspection": "Осмотр зева", "tongue_appearance": "Язык",
+    "skin_appearance": "Кожные покровы", "skin_mucous_membranes": "Кожа и слизистые", "lymph_nodes": "Лимфоузлы",
+    "thyroid_palpation": "Щитовидная железа", "joints_inspection": "Суставы", "neuro_status_brief": "Неврологический статус",
+    "liver_palpation": "Печень", "spleen_palpation": "Селезенка", "edema_check": "Отеки", "peripheral_pulses": "Периферическая пульсация",
+    "ear_inspection": "Уши", "nose_inspection": "Нос",
+}
+# Быстрые действия физикального осмотра: подпись кнопки -> текст врача.
+QUICK_EXAM_ACTIONS = {
+    "t°": "Измеряю температуру.", "АД": "Измеряю АД.", "ЧСС": "Измеряю ЧСС.", "SpO2": "Проверяю SpO2.",
+    "Лёгкие": "Слушаю лёгкие.", "Живот": "Пальпирую живот.", "Горло": "Осматриваю горло.",
+    "Кожа": "Осмотр кожных покровов.", "Л/У": "Пальпация лимфоузлов.", "Щитовидка": "Пальпация щитовидной железы.",
+    "Суставы": "Осмотр и пальпация суставов.", "Невро-С (кр)": "Краткий неврологический осмотр.",
+    "Печень/Сел": "Пальпация печени и селезенки.", "Отеки": "Проверка на отеки.", "Пульс (периф)": "Проверка периферической пульсации.",
+    "Уши": "Осмотр ушей.", "Нос": "Осмотр носа."
+}
+# Подпись кнопки -> возможные ключи physical_exam_findings_prompt_details (кнопка показывается, если ключ есть в сценарии).
+QUICK_EXAM_ACTION_KEYS = {
+    "t°": ["temperature", "температура"], "АД": ["blood_pressure", "давление", "ад"],
+    "ЧСС": ["heart_rate", "pulse", "чсс"], "SpO2": ["spo2", "сатурация"],
+    "Лёгкие": ["auscultation_lungs", "легкие", "дыхание", "перкуссия легких", "percussion_lungs"],
+    "Живот": ["palpation_abdomen", "живот", "абдоминальная пальпация"],
+    "Горло": ["throat_inspection", "throat", "горло", "зев", "миндалины", "осмотр рта", "tongue_appearance"],
+    "Кожа": ["skin_appearance", "skin_general", "кожные покровы", "осмотр кожи"],
+    "Л/У": ["lymph_nodes", "peripheral_lymph_nodes", "лимфоузлы"],
+    "Щитовидка": ["thyroid_palpation", "щитовидная железа"],
+    "Суставы": ["joints_inspection", "joints_palpation", "суставы"],
+    "Невро-С (кр)": ["neuro_status_brief", "neurological_status_brief", "неврологический статус кратко", "сознание", "зрачки", "речь"],
+    "Печень/Сел": ["liver_palpation", "spleen_palpation", "печень", "селезенка"],
+    "Отеки": ["edema_check", "peripheral_edema", "отеки"],
+    "Пульс (периф)": ["peripheral_pulses", "периферическая пульсация"],
+    "Уши": ["ear_inspection", "otoscopy", "уши", "осмотр ушей"],
+    "Нос": ["nose_inspection", "rhinoscopy", "нос", "осмотр носа"]
+}
+QUICK_INVESTIGATION_ACTIONS = {
+    "ЭКГ": "Назначаю ЭКГ.",
+    "Рентген ОГК": "Назначаю рентген органов грудной клетки.",
+    "УЗИ ОБП": "Назначаю УЗИ органов брюшной полости.",
+    "ОАМ": "Назначаю общий анализ мочи.",
+    "Глюкоза (экспр)": "Проверить глюкозу крови экспресс-методом."
+}
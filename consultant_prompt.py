@@ -0,0 +1,28 @@
+from dialogue_history import render_dialogue_transcript
+
+# --- Промпт врача-консультанта ---
+# Общий для приложения и симулятора сессий (benchmarks/simulate_sessions.py).
+
+CONSULTANT_MAX_TOKENS = 500
+CONSULTANT_TEMPERATURE = 0.5
+
+
+def build_consultant_messages(patient_dialogue_history, user_question_to_consultant, specialist_type, main_scenario_info, history_view=None):
+    system_prompt = f"""Ты — опытный врач-консультант, специалист в области {specialist_type}.
+К тебе обратился коллега за советом по клиническому случаю.
+Он предоставит тебе краткую информацию о пациенте, историю общения с пациентом и свой конкретный вопрос.
+Твоя задача — дать краткий, но емкий и полезный совет, основанный на представленной информации.
+Сосредоточься на ответе на вопрос коллеги. Не повторяй всю информацию, которую он тебе дал.
+Помни, что окончательное решение принимает лечащий врач. Будь профессионален и лаконичен.
+"""
+    dialogue_history_str = "Диалог с пациентом:\n" + render_dialogue_transcript(patient_dialogue_history, history_view, user_label="Врач (коллега)")
+
+    user_content = f"""Информация о пациенте: {main_scenario_info}
+
+{dialogue_history_str}
+
+Вопрос от коллеги: {user_question_to_consultant}
+
+Твой совет:
+"""
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}]
@@ -0,0 +1,22 @@
+import os
+import time
+
+import streamlit.components.v1 as components
+
+# --- Таймер сессии в браузере ---
+# Отсчет идет в браузере (frontend/countdown_timer/index.html), поэтому скрипт не перезапускается
+# ради обновления цифр. Сервер передает только срок; по его истечении компонент один раз
+# возвращает значение, что вызывает единственный перезапуск скрипта.
+
+# Часы браузера поправляются по времени сервера, но допускаем небольшое расхождение.
+EXPIRY_TOLERANCE_SECONDS = 2.0
+
+_countdown_timer = components.declare_component("countdown_timer", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "frontend", "countdown_timer"))
+
+
+def countdown_timer(deadline, key, label="⏱️ Осталось:", report_expiry=True):
+    # deadline — time.time() окончания. Возвращает True, если браузер сообщил об истечении именно этого срока.
+    deadline_ms = int(deadline * 1000)
+    value = _countdown_timer(deadline_ms=deadline_ms, server_now_ms=int(time.time() * 1000), label=label, expired_text="Истекло!",
+                             report_expiry=report_expiry, key=key, default=None)
+    return bool(isinstance(value, dict) and value.get("expired") and value.get("deadline_ms") == deadline_ms and time.time() >= deadline - EXPIRY_TOLERANCE_SECONDS)
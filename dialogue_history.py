@@ -0,0 +1,138 @@
+import threading
+
+from llm_scheduler import PRIORITY_PATIENT
+import telemetry
+
+# --- Сжатие истории диалога по бюджету токенов ---
+# Токены каждого сообщения считаются один раз. Пока история укладывается в бюджет, она
+# передается LLM целиком. При превышении бюджета ранние реплики сворачиваются в краткий
+# протокол, который составляет сама LLM: протокол хранится и дополняется только новыми
+# свернутыми репликами, а история сокращается с запасом (до target_ratio бюджета), чтобы
+# префикс промпта (и KV-кэш сервера) менялся лишь изредка. Сообщения с "pinned": True
+# (результаты исследований, реплики триггеров) никогда не сворачиваются.
+
+DEFAULT_HISTORY_TOKEN_BUDGET = 3000
+COMPACTION_TARGET_RATIO = 0.6
+MIN_RECENT_MESSAGES = 6
+MESSAGE_TOKEN_OVERHEAD = 4
+SUMMARY_MAX_TOKENS = 400
+
+SUMMARY_SYSTEM_PROMPT = "Ты ведешь краткий протокол врачебного приема. Сохраняй все клинически значимые факты: жалобы, анамнез, данные осмотра, назначения, ответы пациента. Пиши сжато, без оценок и рекомендаций."
+
+
+def _ignore_notice(level, message):
+    pass
+
+def estimate_tokens(text):
+    # Без токенизатора модели: для русского текста словари llama дают в среднем ~3 символа на токен.
+    return len(text) // 3 + 1
+
+def is_pinned(message):
+    return bool(message.get("pinned"))
+
+
+class DialogueHistory:
+    def __init__(self, budget_tokens=DEFAULT_HISTORY_TOKEN_BUDGET, target_ratio=COMPACTION_TARGET_RATIO, min_recent_messages=MIN_RECENT_MESSAGES, count_tokens=None):
+        self.budget_tokens = max(1, int(budget_tokens))
+        self.target_ratio = target_ratio
+        self.min_recent_messages = max(1, int(min_recent_messages))
+        self.count_tokens = count_tokens or estimate_tokens
+        self.summary = ""
+        self.summary_upto = 0  # протокол покрывает messages[:summary_upto], кроме закрепленных
+        self._token_cache = []  # [(content, tokens)] по индексам сообщений
+        self._lock = threading.Lock()
+        self.counters = {"compactions": 0, "summary_failures": 0, "folded_messages": 0}
+
+    def _message_tokens(self, messages):
+        for i, message in enumerate(messages):
+            content = message["content"]
+            if i < len(self._token_cache) and self._token_cache[i][0] == content: continue
+            entry = (content, self.count_tokens(content) + MESSAGE_TOKEN_OVERHEAD)
+            if i < len(self._token_cache): self._token_cache[i] = entry
+            else: self._token_cache.append(entry)
+        del self._token_cache[len(messages):]
+        return [tokens for _, tokens in self._token_cache]
+
+    def _live_tokens(self, messages, counts, start_index):
+        pinned_tokens = sum(counts[i] for i in range(start_index) if is_pinned(messages[i]))
+        summary_tokens = self.count_tokens(self.summary) + MESSAGE_TOKEN_OVERHEAD if self.summary else 0
+        return sum(counts[start_index:]) + pinned_tokens + summary_tokens
+
+    def needs_compaction(self, messages):
+        with self._lock:
+            counts = self._message_tokens(messages)
+            return self._live_tokens(messages, counts, min(self.summary_upto, len(messages))) > self.budget_tokens
+
+    def compact(self, messages, summarize_fn=None, notify=None):
+        # summarize_fn(предыдущий протокол, сворачиваемые сообщения) -> новый протокол.
+        # Возвращает представление истории для построения промптов (см. iter_visible_messages).
+        notify = notify or _ignore_notice
+        with self._lock:
+            if self.summary_upto > len(messages): self.summary, self.summary_upto = "", 0  # история начата заново
+            counts = self._message_tokens(messages)
+            start_index = self.summary_upto
+            if self._live_tokens(messages, counts, start_index) > self.budget_tokens:
+                target_tokens = int(self.budget_tokens * self.target_ratio)
+                limit = max(start_index, len(messages) - self.min_recent_messages)
+                new_start, live = start_index, self._live_tokens(messages, counts, start_index)
+                while new_start < limit and live > target_tokens:
+                    if not is_pinned(messages[new_start]): live -= counts[new_start]
+                    new_start += 1
+                # Сворачиваем целыми ходами: видимая часть начинается с реплики врача.
+                while new_start < limit and messages[new_start]["role"] != "user": new_start += 1
+                messages_to_fold = [m for m in messages[start_index:new_start] if not is_pinned(m)]
+                if messages_to_fold:
+                    new_summary = ""
+                    if summarize_fn:
+                        try: new_summary = (summarize_fn(self.summary, messages_to_fold) or "").strip()
+                        except Exception as e: notify("warning", f"Не удалось сжать раннюю часть диалога: {e}")
+                    if not new_summary:
+                        self.counters["summary_failures"] += 1
+                        new_summary = (self.summary + "\n" if self.summary else "") + f"(Реплики ходов {start_index + 1}–{new_start} опущены.)"
+                    self.summary = new_summary
+                    self.counters["compactions"] += 1; self.counters["folded_messages"] += len(messages_to_fold)
+                self.summary_upto = new_start
+            return {"summary": self.summary, "start_index": self.summary_upto,
+                    "pinned_indices": [i for i in range(self.summary_upto) if is_pinned(messages[i])]}
+
+    def stats(self):
+        with self._lock:
+            return {"summary_upto": self.summary_upto, "summary_tokens": self.count_tokens(self.summary) if self.summary else 0,
+                    "budget_tokens": self.budget_tokens, **self.counters}
+
+
+def iter_visible_messages(messages, history_view=None):
+    # (индекс, сообщение) для сообщений, которые передаются LLM дословно.
+    start_index = history_view["start_index"] if history_view else 0
+    pinned_indices = set(history_view["pinned_indices"]) if history_view else set()
+    for i, message in enumerate(messages):
+        if i < start_index and i not in pinned_indices: continue
+        yield i, message
+
+def render_dialogue_transcript(messages, history_view=None, user_label="Врач", assistant_label="Пациент"):
+    lines = ""
+    if history_view and history_view["summary"]:
+        lines += f"Краткое содержание ходов 1–{history_view['start_index']}: {history_view['summary']}\n"
+    for i, m in iter_visible_messages(messages, history_view):
+        role_translated = user_label if m['role'] == 'user' else assistant_label
+        lines += f"Ход {i+1} {role_translated}: {m['content']}\n"
+    return lines
+
+@telemetry.traced("history_summary")
+def summarize_with_llm(llm_client, previous_summary, messages_to_fold, priority=PRIORITY_PATIENT, user_id=None, timeout=60.0, use_cache=False):
+    transcript = "\n".join(f"{'Врач' if m['role'] == 'user' else 'Пациент'}: {m['content']}" for m in messages_to_fold)
+    user_prompt = f"Текущий протокол приема:\n{previous_summary or '(пока пуст)'}\n\nНовые реплики:\n{transcript}\n\n" \
+                  f"Перепиши протокол целиком, дополнив его фактами из новых реплик. Ответь только текстом протокола."
+    response = llm_client.create_chat_completion(
+        priority=priority,
+        user_id=user_id,
+        model="local-model",
+        messages=[{"role": "system", "content": SUMMARY_SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
+        max_tokens=SUMMARY_MAX_TOKENS,
+        temperature=0.2,
+        timeout=timeout,
+        **({"use_cache": True} if use_cache else {})
+    )
+    if response.choices and response.choices[0].message.content:
+        return response.choices[0].message.content.strip()
+    return ""
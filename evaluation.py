@@ -0,0 +1,289 @@
+import json
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from dialogue_history import render_dialogue_transcript, summarize_with_llm
+from json_parsing import TolerantJSONParser, consume_json_stream, extract_and_parse_json
+from llm_grammar import CONSTRAINED_OFF, create_constrained_completion, object_schema
+from llm_pool import iter_completion_text
+from llm_scheduler import PRIORITY_EVALUATION
+import telemetry
+
+# --- Оценка действий врача LLM-преподавателем ---
+# Модуль не зависит от Streamlit: оценка может выполняться в фоновом потоке.
+
+SCORE_CATEGORIES = ["anamnesis_collection", "physical_examination", "diagnostic_reasoning", "final_diagnosis_accuracy", "treatment_and_management_plan", "communication_skills"]
+DEFAULT_ERROR_RESULT = {"overall_score": 0, "score_breakdown": {}, "general_feedback": {"positive_aspects": [], "areas_for_improvement": ["Произошла ошибка при обработке ответа от LLM-оценщика."]}, "time_management_comment": "Ошибка оценки времени.", "consultation_impact_comment": "Ошибка оценки влияния консультаций.", "evaluation_failed": True}
+
+_SCORE_SCHEMA = {"type": "integer", "minimum": 0, "maximum": 10}
+_STRING_LIST_SCHEMA = {"type": "array", "items": {"type": "string"}}
+EVALUATION_JSON_SCHEMA = object_schema({
+    "overall_score": _SCORE_SCHEMA,
+    "score_breakdown": object_schema({cat: object_schema({"score": dict(_SCORE_SCHEMA, type=["integer", "null"]) if cat == "communication_skills" else _SCORE_SCHEMA,
+                                                          "comments": {"type": "string"}}) for cat in SCORE_CATEGORIES}),
+    "identified_scenario_mistakes_ids": _STRING_LIST_SCHEMA,
+    "general_feedback": object_schema({"positive_aspects": _STRING_LIST_SCHEMA, "areas_for_improvement": _STRING_LIST_SCHEMA}),
+    "time_management_comment": {"type": "string"}, "consultation_impact_comment": {"type": "string"}})
+
+# Режим "по частям": несколько коротких запросов (частей) выполняются параллельно, каждая часть
+# оценивает свои категории; при raters > 1 каждую часть независимо оценивают несколько "оценщиков"
+# с разной температурой, итоговый балл категории — медиана. Сбой одной части не отменяет остальные.
+EVALUATION_SINGLE = "single"
+EVALUATION_SHARDED = "sharded"
+EVALUATION_MODES = [EVALUATION_SINGLE, EVALUATION_SHARDED]
+SHARD_MAX_TOKENS = 900
+RATER_BASE_TEMPERATURE = 0.3
+RATER_TEMPERATURE_STEP = 0.2
+# Снижение общей оценки за каждую консультацию (нижняя граница из _consultation_instruction): в режиме
+# "по частям" overall_score — среднее категорий, и штраф, который в полной оценке применяет LLM, применяется здесь.
+CONSULTATION_PENALTY = 0.5
+CATEGORY_TITLES = {"anamnesis_collection": "сбор анамнеза", "physical_examination": "физикальный осмотр",
+                   "diagnostic_reasoning": "диагностическое мышление, включая диф. диагноз", "final_diagnosis_accuracy": "точность окончательного диагноза",
+                   "treatment_and_management_plan": "план обследования и лечения", "communication_skills": "коммуникативные навыки"}
+# Части оценки: категории, эталонные поля сценария и дополнительные поля ответа.
+EVALUATION_SHARDS = [
+    {"name": "anamnesis", "categories": ["anamnesis_collection"], "reference_fields": ["key_anamnesis_points"], "extra_fields": {}},
+    {"name": "examination", "categories": ["physical_examination"], "reference_fields": ["physical_exam_findings_prompt_details"], "extra_fields": {}},
+    {"name": "diagnosis", "categories": ["diagnostic_reasoning", "final_diagnosis_accuracy"],
+     "reference_fields": ["true_diagnosis_detailed", "expected_differential_diagnoses", "correct_diagnosis_keywords_for_check"],
+     "extra_fields": {"consultation_impact_comment": "str (влияние консультаций на оценку; если их не было — 'Консультации не использовались.')"}},
+    {"name": "plan", "categories": ["treatment_and_management_plan"], "reference_fields": ["correct_plan_detailed", "correct_plan_keywords_for_check", "common_mistakes"],
+     "extra_fields": {"identified_scenario_mistakes_ids": "list_of_str (ID допущенных типичных ошибок из сценария)"}},
+    {"name": "communication", "categories": ["communication_skills"], "reference_fields": ["communication_focus_points"],
+     "extra_fields": {"time_management_comment": "str (комментарий по управлению временем, если применимо)"}},
+]
+_REFERENCE_FIELD_TITLES = {"key_anamnesis_points": "Ключевые моменты анамнеза (эталон)", "physical_exam_findings_prompt_details": "Данные физикального осмотра (эталон)", "true_diagnosis_detailed": "Истинный диагноз (детально)",
+                           "expected_differential_diagnoses": "Ожидаемые дифференциальные диагнозы (эталон)", "correct_plan_detailed": "Правильный план (эталон)",
+                           "correct_diagnosis_keywords_for_check": "Ключевые слова для проверки диагноза (эталон)",
+                           "correct_plan_keywords_for_check": "Ключевые слова для проверки плана (эталон)",
+                           "common_mistakes": "Типичные ошибки для данного сценария", "communication_focus_points": "На что обратить внимание в общении"}
+
+def _ignore_notice(level, message):
+    pass
+
+EVALUATOR_SYSTEM_PROMPT = "Ты — строгий, но справедливый медицинский преподаватель-эксперт. Твоя задача — оценить работу врача по предоставленному клиническому случаю и его действиям. Предоставь свой ответ СТРОГО в формате JSON. Оценивай объективно, сравнивая действия врача с эталонными данными сценария. Учитывай выбранный уровень сложности сценария."
+
+def _consultation_instruction(consultations_count):
+    return f"ВАЖНО ПО КОНСУЛЬТАЦИЯМ: Если врач использовал консультации ({consultations_count} раз(а)), учти это. Каждая консультация, особенно если случай не был чрезмерно сложным, может свидетельствовать о недостаточной самостоятельности и должна немного снизить оценку за диагностическое мышление (diagnostic_reasoning) и/или общую оценку (overall_score), например, на 0.5-1 балл за каждую использованную консультацию из 10. Отрази это в 'consultation_impact_comment'."
+
+def _parse_score(score, notify, label):
+    # Балл 0-10 (целое) или None, если оценка не выставлена.
+    if score is None: return None
+    try: return max(0, min(10, int(float(str(score).replace(",", ".")))))
+    except (ValueError, TypeError): notify("warning", f"Некорректное значение оценки для категории '{label}'."); return 0
+
+def _is_score(value):
+    if value is None or isinstance(value, (bool, dict, list)): return False
+    try: float(str(value).replace(",", ".")); return True
+    except ValueError: return False
+
+def _string_list(value):
+    return [str(v) for v in value if isinstance(v, (str, int, float))] if isinstance(value, list) else []
+
+def build_evaluation_scenario_info(scenario_data):
+    # Эталонные данные сценария для оценщика; не зависят от хода сессии, поэтому строятся один раз на сценарий.
+    return f"Сценарий: {scenario_data.get('name', 'N/A')} (Сложность: {scenario_data.get('difficulty_level_tag', 'N/A')})\n" \
+           f"Первичная информация о пациенте: {scenario_data.get('patient_initial_info_display', 'N/A')}\n" \
+           f"Истинный диагноз (детально): {scenario_data.get('true_diagnosis_detailed', 'N/A')}\n" \
+           f"Ключевые моменты анамнеза (эталон): {'; '.join(scenario_data.get('key_anamnesis_points', ['N/A']))}\n" \
+           f"Ожидаемые дифференциальные диагнозы (эталон): {', '.join(scenario_data.get('expected_differential_diagnoses', ['N/A']))}\n" \
+           f"Правильный план (эталон): {scenario_data.get('correct_plan_detailed', 'N/A')}\n" \
+           f"Ключевые слова для проверки диагноза (эталон): {', '.join(scenario_data.get('correct_diagnosis_keywords_for_check', ['N/A']))}\n" \
+           f"Ключевые слова для проверки плана (эталон): {', '.join(scenario_data.get('correct_plan_keywords_for_check', ['N/A']))}\n" \
+           f"Типичные ошибки для данного сценария: {'; '.join([m.get('description', 'N/A') for m in scenario_data.get('common_mistakes', []) if isinstance(m, dict)])}\n"
+
+@telemetry.traced("evaluation")
+def evaluate_with_llm(llm_client, scenario_data, user_dialogue_msgs, user_dx, user_plan, user_diff_dx="", time_taken_seconds=None, timer_was_active=False, consultations_count=0, user_id=None, timeout=300.0, notify=None, constrained_mode=CONSTRAINED_OFF, dialogue_history=None, use_cache=False, refresh_cache=False, scenario_info=None, evaluation_mode=EVALUATION_SINGLE, raters=1):
+    # Возвращает (результат оценки, необработанный ответ LLM); сообщения для пользователя передаются через notify.
+    notify = notify or _ignore_notice
+    notify("info", "Отправка данных LLM-оценщику для анализа..."); raw_text = ""
+    telemetry.current_span().set(mode=evaluation_mode, raters=raters, constrained_mode=constrained_mode, dialogue_messages=len(user_dialogue_msgs))
+
+    history_view = None
+    if dialogue_history is not None:
+        history_view = dialogue_history.compact(user_dialogue_msgs, notify=notify, summarize_fn=lambda previous_summary, messages_to_fold: summarize_with_llm(
+            llm_client, previous_summary, messages_to_fold, priority=PRIORITY_EVALUATION, user_id=user_id, timeout=timeout, use_cache=use_cache))
+    dialogue_history_str = render_dialogue_transcript(user_dialogue_msgs, history_view)
+
+    physician_summary = f"Предложенный врачом дифференциальный диагноз: {user_diff_dx or '[Не указан]'}\n" \
+                        f"Предложенный врачом окончательный диагноз: {user_dx or '[Отсутствует]'}\n" \
+                        f"Предложенный врачом план обследования и лечения: {user_plan or '[Отсутствует]'}\n" \
+                        f"Использовано консультаций со специалистом: {consultations_count}\n"
+    if timer_was_active and time_taken_seconds is not None: physician_summary += f"Затраченное время: {int(time_taken_seconds // 60)} мин {int(time_taken_seconds % 60)} сек\n"
+
+    if evaluation_mode == EVALUATION_SHARDED:
+        return _evaluate_sharded(llm_client, scenario_data, dialogue_history_str + physician_summary, consultations_count, max(1, int(raters)),
+                                 user_id, timeout, notify, constrained_mode, use_cache, refresh_cache)
+
+    scenario_info = scenario_info or build_evaluation_scenario_info(scenario_data)
+    user_prompt = f"ДАННЫЕ ЭТАЛОННОГО СЦЕНАРИЯ:\n{scenario_info}\n\nДЕЙСТВИЯ ВРАЧА (ДИАЛОГ И РЕШЕНИЯ):\n{dialogue_history_str}{physician_summary}\n\nЗАДАЧА: Предоставь детальную оценку работы врача в формате JSON. JSON должен иметь следующую структуру:\n" \
+                  f"{{\"overall_score\": \"int (общая оценка от 0 до 10)\", \"score_breakdown\": {{\"anamnesis_collection\": {{\"score\": \"int (0-10)\", \"comments\": \"str (комментарии по сбору анамнеза)\"}}, " \
+                  f"\"physical_examination\": {{\"score\": \"int (0-10)\", \"comments\": \"str (комментарии по физикальному осмотру)\"}}, \"diagnostic_reasoning\": {{\"score\": \"int (0-10)\", \"comments\": \"str (комментарии по диагностическому мышлению, включая диф.диагноз)\"}}, " \
+                  f"\"final_diagnosis_accuracy\": {{\"score\": \"int (0-10)\", \"comments\": \"str (комментарии по точности окончательного диагноза)\"}}, \"treatment_and_management_plan\": {{\"score\": \"int (0-10)\", \"comments\": \"str (комментарии по плану обследования и лечения)\"}}, " \
+                  f"\"communication_skills\": {{\"score\": \"int (0-10)|null (если не оценивалось отдельно)\", \"comments\": \"str (комментарии по коммуникативным навыкам)\"}}}}, " \
+                  f"\"identified_scenario_mistakes_ids\": [\"list_of_str (ID типичных ошибок из сценария, если были допущены)\"], \"general_feedback\": {{\"positive_aspects\": [\"list_of_str (что было сделано хорошо)\"], \"areas_for_improvement\": [\"list_of_str (что можно улучшить)\"]}}, " \
+                  f"\"time_management_comment\": \"str (комментарий по управлению временем, если применимо)\", \"consultation_impact_comment\": \"str (комментарий по влиянию консультаций на оценку, если были использованы. Если консультаций не было, укажи 'Консультации не использовались.')\"}}" \
+                  f"\n\n{_consultation_instruction(consultations_count)}"
+
+    default_error_result = dict(DEFAULT_ERROR_RESULT)
+    json_parser = TolerantJSONParser()  # его состояние подтверждает кэшу полноту ответа, если поток закрыт после конца JSON
+    try:
+        response_stream = create_constrained_completion(
+            llm_client, constrained_mode, EVALUATION_JSON_SCHEMA, "physician_evaluation", notify,
+            priority=PRIORITY_EVALUATION,
+            user_id=user_id,
+            model="local-model", 
+            messages=[{"role":"system", "content":EVALUATOR_SYSTEM_PROMPT}, {"role":"user", "content":user_prompt}], 
+            max_tokens=4000, 
+            temperature=0.3,
+            timeout=timeout,
+            stream=True,
+            **({"use_cache": True, "refresh_cache": refresh_cache, "stream_complete": lambda: json_parser.done} if use_cache else {})
+        )
+        raw_text = consume_json_stream(iter_completion_text(response_stream), json_parser)
+        if not raw_text:
+            notify("error", "LLM-оценщик не вернул контент."); return default_error_result, raw_text
+        eval_obj = extract_and_parse_json(raw_text, notify, parser=json_parser)
+        if not isinstance(eval_obj, dict) or not isinstance(eval_obj.get("score_breakdown"), dict) or not _is_score(eval_obj.get("overall_score")):
+            notify("error", "Ответ LLM-оценщика не содержит оценки (overall_score и score_breakdown)."); return default_error_result, raw_text
+
+        final_eval = {"overall_score": _parse_score(eval_obj["overall_score"], notify, "overall_score") or 0}
+
+        final_eval["score_breakdown"] = {}
+        for cat in SCORE_CATEGORIES:
+            cat_data = eval_obj["score_breakdown"].get(cat)
+            if not isinstance(cat_data, dict): cat_data = {}
+            val = _parse_score(cat_data.get("score"), notify, cat)
+            if val is None and cat != "communication_skills": val = 0
+            final_eval["score_breakdown"][cat] = {"score": val, "comments": str(cat_data.get("comments", "Комментарии отсутствуют."))}
+
+        final_eval["identified_scenario_mistakes_ids"] = _string_list(eval_obj.get("identified_scenario_mistakes_ids", []))
+
+        fb_raw = eval_obj.get("general_feedback", {})
+        final_eval["general_feedback"] = {"positive_aspects": _string_list(fb_raw.get("positive_aspects")), "areas_for_improvement": _string_list(fb_raw.get("areas_for_improvement"))}
+        final_eval["time_management_comment"] = str(eval_obj.get("time_management_comment", "Комментарий по тайм-менеджменту отсутствует."))
+        final_eval["consultation_impact_comment"] = str(eval_obj.get("consultation_impact_comment", "Комментарий по использованию консультаций отсутствует."))
+        notify("success", "Оценка успешно получена от LLM!"); return final_eval, raw_text
+    except (json.JSONDecodeError, ValueError) as e: notify("error", f"Ошибка парсинга JSON от LLM-оценщика: {e}"); return default_error_result, raw_text
+    except Exception as e: notify("error", f"Произошла общая ошибка при оценке LLM: {e}"); return default_error_result, raw_text
+
+
+# --- Оценка по частям ---
+def _shard_scenario_info(scenario_data, shard):
+    lines = [f"Сценарий: {scenario_data.get('name', 'N/A')} (Сложность: {scenario_data.get('difficulty_level_tag', 'N/A')})",
+             f"Первичная информация о пациенте: {scenario_data.get('patient_initial_info_display', 'N/A')}"]
+    for field in shard["reference_fields"]:
+        value = scenario_data.get(field)
+        if field == "common_mistakes": value = "; ".join(f"{m.get('id', 'N/A')}: {m.get('description', 'N/A')}" for m in value or [] if isinstance(m, dict))
+        elif isinstance(value, dict): value = "; ".join(f"{k}: {v}" for k, v in value.items())
+        elif isinstance(value, list): value = "; ".join(str(v) for v in value)
+        lines.append(f"{_REFERENCE_FIELD_TITLES[field]}: {value or 'N/A'}")
+    return "\n".join(lines) + "\n"
+
+def _shard_json_schema(shard):
+    properties = {cat: object_schema({"score": dict(_SCORE_SCHEMA, type=["integer", "null"]) if cat == "communication_skills" else _SCORE_SCHEMA,
+                                      "comments": {"type": "string"}}) for cat in shard["categories"]}
+    properties.update({"positive_aspects": _STRING_LIST_SCHEMA, "areas_for_improvement": _STRING_LIST_SCHEMA})
+    for field in shard["extra_fields"]:
+        properties[field] = _STRING_LIST_SCHEMA if field == "identified_scenario_mistakes_ids" else {"type": "string"}
+    return object_schema(properties)
+
+def _shard_user_prompt(scenario_data, shard, physician_actions, consultations_count):
+    # Общая часть (диалог и решения врача) идет первой и одинакова во всех частях: сервер переиспользует ее KV-кэш.
+    template = {cat: {"score": "int (0-10)|null (если не оценивалось)" if cat == "communication_skills" else "int (0-10)", "comments": f"str (комментарии: {CATEGORY_TITLES[cat]})"}
+                for cat in shard["categories"]}
+    template.update({"positive_aspects": ["list_of_str (что было сделано хорошо в этих аспектах)"], "areas_for_improvement": ["list_of_str (что можно улучшить)"]})
+    template.update(shard["extra_fields"])
+    task = f"ЗАДАЧА: Оцени ТОЛЬКО следующие аспекты работы врача: {', '.join(CATEGORY_TITLES[cat] for cat in shard['categories'])}. " \
+           f"Ответь кратко, строго в формате JSON следующей структуры:\n{json.dumps(template, ensure_ascii=False)}"
+    if "consultation_impact_comment" in shard["extra_fields"]: task += f"\n\n{_consultation_instruction(consultations_count)}"
+    return f"ДЕЙСТВИЯ ВРАЧА (ДИАЛОГ И РЕШЕНИЯ):\n{physician_actions}\n\nДАННЫЕ ЭТАЛОННОГО СЦЕНАРИЯ:\n{_shard_scenario_info(scenario_data, shard)}\n{task}"
+
+def _run_shard(llm_client, shard, rater_index, user_prompt, user_id, timeout, notify, constrained_mode, use_cache, refresh_cache):
+    response = create_constrained_completion(
+        llm_client, constrained_mode, _shard_json_schema(shard), f"physician_evaluation_{shard['name']}", notify,
+        priority=PRIORITY_EVALUATION,
+        user_id=user_id,
+        model="local-model",
+        messages=[{"role": "system", "content": EVALUATOR_SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
+        max_tokens=SHARD_MAX_TOKENS,
+        temperature=RATER_BASE_TEMPERATURE + RATER_TEMPERATURE_STEP * rater_index,  # разные оценщики не совпадают и в кэше ответов
+        timeout=timeout,
+        **({"use_cache": True, "refresh_cache": refresh_cache} if use_cache else {})
+    )
+    raw_text = response.choices[0].message.content if response.choices and response.choices[0].message.content else ""
+    parsed = extract_and_parse_json(raw_text, notify)
+    if not isinstance(parsed, dict): raise ValueError("ответ не является JSON-объектом")
+    return parsed, raw_text
+
+def _merge_unique(lists):
+    merged, seen = [], set()
+    for items in lists:
+        for item in items:
+            key = " ".join(item.lower().split())
+            if key and key not in seen: seen.add(key); merged.append(item)
+    return merged
+
+def _category_data(rater_result, cat):
+    # Модель иногда повторяет структуру полной оценки и вкладывает категории в score_breakdown.
+    cat_data = rater_result.get(cat)
+    if not isinstance(cat_data, dict) and isinstance(rater_result.get("score_breakdown"), dict): cat_data = rater_result["score_breakdown"].get(cat)
+    return cat_data if isinstance(cat_data, dict) else {}
+
+def _aggregate_category(cat, rater_results, notify):
+    # Медиана баллов оценщиков; комментарий — от оценщика, чей балл ближе всего к медиане.
+    scored = [(_parse_score(_category_data(r, cat).get("score"), notify, cat), _category_data(r, cat)) for r in rater_results]
+    scores = [score for score, _ in scored if score is not None]
+    if not scores:
+        comments = next((str(d["comments"]) for _, d in scored if d.get("comments")), "Комментарии отсутствуют.")
+        return {"score": None if cat == "communication_skills" else 0, "comments": comments}
+    median_score = statistics.median(scores)
+    closest = min((item for item in scored if item[0] is not None), key=lambda item: abs(item[0] - median_score))[1]
+    result = {"score": int(median_score + 0.5), "comments": str(closest.get("comments", "Комментарии отсутствуют."))}
+    if len(scores) > 1:
+        result["rater_scores"] = scores
+        result["rater_mean"] = round(statistics.mean(scores), 2); result["rater_variance"] = round(statistics.pvariance(scores), 2)
+    return result
+
+def _evaluate_sharded(llm_client, scenario_data, physician_actions, consultations_count, raters, user_id, timeout, notify, constrained_mode, use_cache, refresh_cache):
+    tasks = [(shard, rater_index) for shard in EVALUATION_SHARDS for rater_index in range(raters)]
+    shard_results = {shard["name"]: [] for shard in EVALUATION_SHARDS}; raw_parts = []
+    with ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="evaluation-shard") as executor:
+        futures = [(shard, rater_index, executor.submit(_run_shard, llm_client, shard, rater_index,
+                                                        _shard_user_prompt(scenario_data, shard, physician_actions, consultations_count),
+                                                        user_id, timeout, notify, constrained_mode, use_cache, refresh_cache))
+                   for shard, rater_index in tasks]
+        for shard, rater_index, future in futures:
+            try:
+                parsed, raw_text = future.result()
+                shard_results[shard["name"]].append(parsed); raw_parts.append(f"[{shard['name']} #{rater_index + 1}]\n{raw_text}")
+            except Exception as e:
+                notify("warning", f"Часть оценки '{shard['name']}' (оценщик {rater_index + 1}) не получена: {e}")
+    if not any(shard_results.values()):
+        notify("error", "LLM-оценщик не вернул ни одной части оценки."); return dict(DEFAULT_ERROR_RESULT), "\n\n".join(raw_parts)
+
+    final_eval = {"score_breakdown": {}, "identified_scenario_mistakes_ids": [], "general_feedback": {"positive_aspects": [], "areas_for_improvement": []},
+                  "time_management_comment": "Комментарий по тайм-менеджменту отсутствует.", "consultation_impact_comment": "Комментарий по использованию консультаций отсутствует."}
+    positive_lists, improvement_lists = [], []
+    for shard in EVALUATION_SHARDS:
+        rater_results = shard_results[shard["name"]]
+        for cat in shard["categories"]:
+            final_eval["score_breakdown"][cat] = _aggregate_category(cat, rater_results, notify) if rater_results else \
+                {"score": None, "comments": "Оценка по этой категории недоступна: LLM-оценщик не ответил."}
+        positive_lists += [_string_list(r.get("positive_aspects", (r.get("general_feedback") or {}).get("positive_aspects"))) for r in rater_results]
+        improvement_lists += [_string_list(r.get("areas_for_improvement", (r.get("general_feedback") or {}).get("areas_for_improvement"))) for r in rater_results]
+        for field in shard["extra_fields"]:
+            values = [r.get(field) for r in rater_results if r.get(field) is not None]
+            if field == "identified_scenario_mistakes_ids":
+                # Ошибка засчитывается, если ее отметили не меньше половины оценщиков части.
+                votes = {}
+                for ids in values:
+                    for mistake_id in set(_string_list(ids)): votes[mistake_id] = votes.get(mistake_id, 0) + 1
+                final_eval[field] = [m for m, count in votes.items() if count * 2 >= len(rater_results)]
+            elif values:
+                final_eval[field] = str(values[0])
+    final_eval["general_feedback"] = {"positive_aspects": _merge_unique(positive_lists), "areas_for_improvement": _merge_unique(improvement_lists)}
+    category_scores = [v["score"] for v in final_eval["score_breakdown"].values() if v["score"] is not None]
+    final_eval["overall_score"] = max(0, int(statistics.mean(category_scores) - CONSULTATION_PENALTY * consultations_count + 0.5)) if category_scores else 0
+    notify("success", "Оценка успешно получена от LLM!" if all(shard_results.values()) else "Оценка получена частично: см. предупреждения выше.")
+    return final_eval, "\n\n".join(raw_parts)
@@ -0,0 +1,128 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Фоновое выполнение оценки ---
+# Оценка запускается в пуле потоков процесса, а не в скрипте Streamlit. Запись о задаче
+# (контекст сессии, статус, результат) сохраняется на диск, поэтому пользователь,
+# обновивший страницу, получает готовый результат по job_id без повторной генерации.
+# on_finished(запись) вызывается после сохранения завершенной задачи — например, чтобы записать
+# оценку в хранилище сессий, даже если вкладка браузера уже закрыта.
+#
+# Каталог результатов может быть общим для нескольких процессов приложения. Запись хранит
+# worker_id процесса-исполнителя, а каждый процесс обновляет файл-пульс в workers/: незавершенная
+# задача чужого живого процесса отдается как есть, а не как прерванная.
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_INTERRUPTED = "interrupted"
+FINISHED_JOB_STATUSES = {JOB_DONE, JOB_FAILED, JOB_INTERRUPTED}
+WORKER_HEARTBEAT_INTERVAL = 15.0
+WORKER_HEARTBEAT_TIMEOUT = 60.0
+
+
+class EvaluationJobManager:
+    def __init__(self, results_dir, max_workers=2, max_age_days=7, on_finished=None, worker_id=None):
+        self.results_dir = results_dir
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._workers_dir = os.path.join(results_dir, "workers")
+        os.makedirs(self._workers_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="evaluation-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._finished_counts = {JOB_DONE: 0, JOB_FAILED: 0}
+        self._on_finished = on_finished
+        self._prune_old_records(max_age_days)
+        self._touch_heartbeat()
+        threading.Thread(target=self._heartbeat_loop, name="evaluation-job-heartbeat", daemon=True).start()
+
+    def _record_path(self, job_id):
+        return os.path.join(self.results_dir, f"{job_id}.json")
+
+    def _persist(self, record):
+        path = self._record_path(record["job_id"]); tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _heartbeat_path(self, worker_id):
+        return os.path.join(self._workers_dir, worker_id)
+
+    def _touch_heartbeat(self):
+        try:
+            with open(self._heartbeat_path(self.worker_id), "a"): pass
+            os.utime(self._heartbeat_path(self.worker_id))
+        except OSError:
+            pass
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(WORKER_HEARTBEAT_INTERVAL); self._touch_heartbeat()
+
+    def _worker_alive(self, worker_id):
+        if not worker_id or worker_id == self.worker_id: return False  # своих задач нет в памяти — процесс перезапускался
+        try: return time.time() - os.path.getmtime(self._heartbeat_path(worker_id)) < WORKER_HEARTBEAT_TIMEOUT
+        except OSError: return False
+
+    def _prune_old_records(self, max_age_days):
+        if not max_age_days: return
+        cutoff = time.time() - max_age_days * 86400
+        for name in os.listdir(self.results_dir) + [os.path.join("workers", n) for n in os.listdir(self._workers_dir)]:
+            path = os.path.join(self.results_dir, name)
+            try:
+                if (name.endswith((".json", ".tmp")) or name.startswith("workers" + os.sep)) and os.path.getmtime(path) < cutoff: os.remove(path)
+            except OSError:
+                continue
+
+    def submit(self, evaluate_fn, evaluate_kwargs, context=None):
+        # evaluate_fn(notify=..., **evaluate_kwargs) -> (результат, необработанный ответ LLM)
+        job_id = uuid.uuid4().hex
+        record = {"job_id": job_id, "status": JOB_PENDING, "created_at": time.time(), "finished_at": None,
+                  "result": None, "raw_text": "", "notices": [], "context": context or {}, "worker_id": self.worker_id}
+        with self._lock: self._jobs[job_id] = record
+        self._persist(record)
+        self._executor.submit(self._run, job_id, evaluate_fn, evaluate_kwargs)
+        return job_id
+
+    def _run(self, job_id, evaluate_fn, evaluate_kwargs):
+        with self._lock: record = self._jobs[job_id]; record["status"] = JOB_RUNNING
+        notices = []
+        try:
+            result, raw_text = evaluate_fn(notify=lambda level, message: notices.append([level, message]), **evaluate_kwargs)
+            status = JOB_DONE
+        except Exception as e:
+            result, raw_text, status = None, "", JOB_FAILED
+            notices.append(["error", f"Произошла общая ошибка при оценке LLM: {e}"])
+        with self._lock:
+            record.update({"status": status, "result": result, "raw_text": raw_text, "notices": notices, "finished_at": time.time()})
+            snapshot = dict(record)
+        self._persist(snapshot)
+        if self._on_finished is not None:
+            try: self._on_finished(snapshot)
+            except Exception: pass  # сбой получателя не должен терять результат оценки
+        # Завершенная задача читается с диска, в памяти процесса остаются только активные.
+        with self._lock: self._jobs.pop(job_id, None); self._finished_counts[status] += 1
+
+    def get(self, job_id):
+        if not job_id: return None
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is not None: return dict(record)
+        try:
+            with open(self._record_path(job_id), encoding="utf-8") as f: record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("status") not in FINISHED_JOB_STATUSES and not self._worker_alive(record.get("worker_id")):
+            # Задача с диска, которой нет в памяти живого процесса: сервер перезапускался во время оценки.
+            record["status"] = JOB_INTERRUPTED
+        return record
+
+    def stats(self):
+        with self._lock:
+            statuses = [r["status"] for r in self._jobs.values()]
+            return {JOB_PENDING: statuses.count(JOB_PENDING), JOB_RUNNING: statuses.count(JOB_RUNNING), **self._finished_counts}
@@ -0,0 +1,70 @@
+from constants import PHYSICAL_EXAM_KEYWORDS, PHYSICAL_EXAM_LABELS, QUICK_EXAM_ACTION_KEYS, QUICK_EXAM_ACTIONS
+from keyword_matcher import KeywordMatcher, normalize_text, split_words
+
+# --- Ответы на команды физикального осмотра без LLM ---
+# Результаты осмотра уже есть в physical_exam_findings_prompt_details. Кнопки быстрых действий
+# и короткие текстовые команды ("Измеряю АД и пульс.") разрешаются прямо в эти данные.
+# Ответ дается мгновенно и записывается в диалог как обычная реплика, так что его видят и
+# пациент-LLM на следующих ходах, и оценщик. LLM вызывается, если в сообщении есть
+# что-то кроме команды осмотра (вопрос, пояснение) или в сценарии нет данных для какого-то из осмотров.
+# Показатели, измененные сработавшими триггерами (vitals_update), передаются в respond и заменяют
+# исходные значения сценария.
+
+EXAM_COMMAND_WORDS = [
+    "измеряю", "измерю", "измерение", "слушаю", "послушаю", "выслушиваю", "аускультирую", "аускультация", "пальпирую",
+    "пропальпирую", "пальпация", "осматриваю", "осмотрю", "осмотр", "проверяю", "проверю", "проверка", "оцениваю",
+    "оценка", "смотрю", "посмотрю", "определяю", "провожу", "проведу", "перкуссия", "перкутирую", "наличие",
+    "и", "а", "также", "еще", "теперь", "сейчас", "давайте", "у", "вас", "ваш", "вашу", "ваше", "ваши", "пациента",
+    "пациентки", "на", "с", "в", "обеих", "сторон",
+]
+EXAM_RESULTS_HEADER = "🩺 **Результаты осмотра:**"
+
+
+def exam_label(exam_key):
+    return PHYSICAL_EXAM_LABELS.get(exam_key, str(exam_key).replace("_", " ").capitalize())
+
+
+class ExamResponder:
+    def __init__(self, exam_details, quick_exam_actions=()):
+        # quick_exam_actions — кнопки CompiledScenario: (подпись, текст, ключ виджета, ключи осмотра сценария).
+        self.exam_details = exam_details or {}
+        scenario_keys = {str(k).lower().strip(): k for k in self.exam_details}
+        self._quick_action_keys = {normalize_text(text).strip(): exam_keys for _, text, _, exam_keys in quick_exam_actions if exam_keys}
+        # Канонический ключ осмотра -> ключи сценария: сам ключ, а если его нет — ключи кнопки, в списке которой он указан.
+        canonical_to_scenario = {}
+        for canonical_key in PHYSICAL_EXAM_KEYWORDS:
+            if canonical_key in scenario_keys: canonical_to_scenario[canonical_key] = [scenario_keys[canonical_key]]; continue
+            for label, approx_keys in QUICK_EXAM_ACTION_KEYS.items():
+                if canonical_key in approx_keys:
+                    found = [scenario_keys[k] for k in approx_keys if k in scenario_keys]
+                    if found: canonical_to_scenario[canonical_key] = found; break
+        self._canonical_to_scenario = canonical_to_scenario
+        self._exam_matcher = KeywordMatcher((keyword, key) for key, keywords in PHYSICAL_EXAM_KEYWORDS.items() for keyword in keywords)
+        vocabulary = set(EXAM_COMMAND_WORDS)
+        for keywords in PHYSICAL_EXAM_KEYWORDS.values():
+            for keyword in keywords: vocabulary.update(split_words(keyword))
+        for text in QUICK_EXAM_ACTIONS.values(): vocabulary.update(split_words(text))
+        self._command_vocabulary = KeywordMatcher((word, True) for word in vocabulary)
+
+    def resolve(self, text):
+        # Ключи сценария для команды осмотра; None, если сообщение нельзя надежно разрешить без LLM.
+        if not self.exam_details or not text: return None
+        normalized = normalize_text(text).strip()
+        if normalized in self._quick_action_keys: return self._quick_action_keys[normalized]
+        if "?" in normalized: return None
+        words = split_words(normalized)
+        if not words or not all(self._command_vocabulary.match(word) for word in words): return None
+        canonical_keys = self._exam_matcher.match(normalized)
+        if not canonical_keys or any(key not in self._canonical_to_scenario for key in canonical_keys): return None
+        scenario_keys = []
+        for canonical_key in PHYSICAL_EXAM_KEYWORDS:  # порядок вывода — как в справочнике
+            for key in self._canonical_to_scenario.get(canonical_key, []) if canonical_key in canonical_keys else []:
+                if key not in scenario_keys: scenario_keys.append(key)
+        return scenario_keys
+
+    def respond(self, text, overrides=None):
+        # overrides — {показатель: значение} из TriggerEngine.vitals_overrides(); ключи сравниваются без учета регистра.
+        exam_keys = self.resolve(text)
+        if not exam_keys: return None
+        current = {str(k).lower().strip(): v for k, v in (overrides or {}).items()}
+        return EXAM_RESULTS_HEADER + "\n" + "\n".join(f"- **{exam_label(key)}:** {current.get(str(key).lower().strip(), self.exam_details[key])}" for key in exam_keys)
@@ -0,0 +1,295 @@
+import copy
+import json
+import re
+
+import telemetry
+
+# --- Вспомогательные функции для парсинга JSON ---
+# notify(level, message) получает сообщения о ходе восстановления JSON (level: "info" / "warning"),
+# чтобы модуль можно было использовать вне Streamlit, например в фоновых задачах.
+#
+# TolerantJSONParser разбирает ответ LLM за один проход и принимает текст по частям (stream=True):
+# отслеживает вложенность скобок и состояние строк, на лету исправляет известные ошибки
+# и достраивает оборванную структуру. Коды ремонтов совпадают с прежним каскадом A–D.
+# Блок ```json ... ``` имеет приоритет: если он открывается после объекта, перед которым был текст
+# (например, «Пример {...}»), разбор начинается заново внутри блока. Поэтому такой объект
+# не считается окончательным (done), пока ответ не закончится или не откроется блок.
+# Объект после текста, который удалось закрыть только с ремонтами (например, «в формате {score}»),
+# считается частью текста: он отбрасывается, и разбор начинается заново со следующей '{'.
+
+REPAIR_DESCRIPTIONS = {
+    "A": "исправлены ключи без кавычек или с неправильными кавычками (например, 'key\":' -> '\"key\":')",
+    "B": "отброшен текст после завершенного JSON-объекта",
+    "C": "добавлены недостающие закрывающие символы оборванной структуры",
+    "D": "добавлен отсутствующий ключ 'description' (например, в 'common_mistakes')",
+    "E": "исправлены запятые (лишние перед закрывающей скобкой или пропущенные между элементами)",
+    "F": "удалены комментарии /* ... */ и // ...",
+    "G": "экранированы переводы строк и недопустимые управляющие последовательности внутри строк",
+    "H": "нестандартные значения (True/False/None, текст без кавычек) приведены к JSON",
+}
+
+_LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+_NUMBER_RE = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?$")
+_VALID_ESCAPES = set('"\\/bfnrtu')
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+_KEY_STATES = ("key_first", "key_after_comma")
+_FENCE = "```json"
+
+def _ignore_notice(level, message):
+    pass
+
+def _is_bareword_char(ch):
+    return ch.isalnum() or ch in "_+-."
+
+
+class _Container:
+    __slots__ = ("kind", "state", "keys", "pending_key", "pending_key_after_comma")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.state = "key_first" if kind == "{" else "value_first"
+        self.keys = set(); self.pending_key = None; self.pending_key_after_comma = False
+
+
+class TolerantJSONParser:
+    def __init__(self):
+        self._out = []
+        self._stack = []
+        self._started = False
+        self.done = False
+        self._mode = None
+        self._buf = []
+        self._escape = False
+        self._comment_star = False
+        self._trailing_text = False
+        self._closed = False
+        self._fenced = False
+        self._prose = False
+        self._tail = ""
+        self._error = None
+        self.repairs = []
+
+    # --- Прием текста ---
+    def feed(self, chunk):
+        for ch in chunk:
+            self._consume(ch)
+        return self.done
+
+    def _repair(self, code):
+        if code not in self.repairs: self.repairs.append(code)
+
+    def _restart_in_fence(self):
+        self.__init__(); self._fenced = True
+
+    def _restart_after_prose(self):
+        tail = self._tail; self.__init__(); self._prose = True; self._tail = tail
+
+    def _fail(self, message):
+        # Разбор не удался; объект вне блока ```json еще может быть заменен блоком.
+        self._error = message; self.done = self._fenced or not self._prose
+
+    def _consume(self, ch):
+        if not self._fenced and self._mode != "string":
+            self._tail = (self._tail + ch)[-len(_FENCE):]
+            if self._tail == _FENCE: self._restart_in_fence(); return
+        if self._error: return
+        if self._closed:
+            if not ch.isspace() and ch != "`": self._trailing_text = True
+            return
+        if not self._started:
+            if ch == "{": self._started = True; self._out.append("{"); self._stack.append(_Container("{"))
+            elif not ch.isspace() and ch != "`": self._prose = True
+            return
+        mode = self._mode
+        if mode == "string": self._string_char(ch); return
+        if mode == "comment_line":
+            if ch == "\n": self._mode = None
+            return
+        if mode == "comment_block":
+            if self._comment_star and ch == "/": self._mode = None
+            self._comment_star = ch == "*"
+            return
+        if mode == "slash":
+            self._mode = None
+            if ch in "*/":
+                self._mode = "comment_block" if ch == "*" else "comment_line"; self._comment_star = False; self._repair("F"); return
+            self._fail(f"неожиданный символ '/' перед '{ch}'"); return
+        if mode == "bareword":
+            if _is_bareword_char(ch): self._buf.append(ch); return
+            if ch == '"' and self._in_key_position():
+                self._end_bareword(); return  # key": — ключ без открывающей кавычки
+            self._end_bareword()
+        self._structural(ch)
+
+    def _structural(self, ch):
+        if ch.isspace(): return
+        if ch == '"': self._mode = "string"; self._buf = []; self._escape = False
+        elif ch == "/": self._mode = "slash"
+        elif ch in "{[": self._open(ch)
+        elif ch in "}]": self._close(ch)
+        elif ch == ":": self._colon()
+        elif ch == ",": self._comma()
+        elif _is_bareword_char(ch): self._mode = "bareword"; self._buf = [ch]
+
+    def _string_char(self, ch):
+        if self._escape:
+            self._escape = False
+            if ch in _VALID_ESCAPES: self._buf.append("\\" + ch)
+            elif ch == "'": self._buf.append("'"); self._repair("G")
+            else: self._buf.append("\\\\" + _CONTROL_ESCAPES.get(ch, ch)); self._repair("G")
+            return
+        if ch == "\\": self._escape = True
+        elif ch == '"': self._mode = None; self._value_token('"' + "".join(self._buf) + '"', is_string=True)
+        elif ch < " ": self._buf.append(_CONTROL_ESCAPES.get(ch, f"\\u{ord(ch):04x}")); self._repair("G")
+        else: self._buf.append(ch)
+
+    def _end_bareword(self):
+        word = "".join(self._buf); self._mode = None; self._buf = []
+        if self._in_key_position():
+            self._repair("A"); self._value_token(json.dumps(word, ensure_ascii=False), is_string=True); return
+        if word in _LITERALS:
+            if _LITERALS[word] != word: self._repair("H")
+            self._value_token(_LITERALS[word])
+        elif _NUMBER_RE.match(word): self._value_token(word)
+        else:
+            self._repair("H"); self._value_token(json.dumps(word, ensure_ascii=False))
+
+    # --- Структура ---
+    def _in_key_position(self):
+        return bool(self._stack) and self._stack[-1].kind == "{" and self._stack[-1].state in _KEY_STATES
+
+    def _emit_pending_key(self, top):
+        if top.pending_key_after_comma: self._out.append(",")
+        self._out.append(top.pending_key + ":")
+        try: top.keys.add(json.loads(top.pending_key))
+        except ValueError: pass
+        top.pending_key = None
+
+    def _insert_missing_key(self, top):
+        # {"id": "x", "текст ошибки", "penalty": 1} -> строка без ключа становится значением 'description'
+        key_name = "description" if "description" not in top.keys else f"text_{len(top.keys)}"
+        value_token = top.pending_key
+        top.pending_key = json.dumps(key_name); self._emit_pending_key(top)
+        self._out.append(value_token); top.state = "after_value"; self._repair("D")
+
+    def _before_value(self):
+        # Готовит место под значение: ставит отложенную запятую и переводит контейнер в after_value.
+        top = self._stack[-1]
+        if top.kind == "{":
+            if top.state == "colon":
+                self._emit_pending_key(top); self._repair("A")
+            elif top.state != "value":
+                return False
+        else:
+            if top.state == "after_value": self._out.append(","); self._repair("E")
+            elif top.state == "value_after_comma": self._out.append(",")
+        top.state = "after_value"
+        return True
+
+    def _value_token(self, token, is_string=False):
+        top = self._stack[-1]
+        if top.kind == "{" and is_string and top.state in _KEY_STATES + ("after_value",):
+            if top.state == "after_value": self._repair("E")
+            top.pending_key = token; top.pending_key_after_comma = top.state != "key_first"; top.state = "colon"
+            return
+        if self._before_value(): self._out.append(token)
+
+    def _open(self, ch):
+        if not self._before_value(): return
+        self._out.append(ch); self._stack.append(_Container(ch))
+
+    def _colon(self):
+        top = self._stack[-1]
+        if top.kind == "{" and top.state == "colon":
+            self._emit_pending_key(top); top.state = "value"
+
+    def _comma(self):
+        top = self._stack[-1]
+        if top.kind == "{":
+            if top.state == "colon": self._insert_missing_key(top)
+            elif top.state == "value": self._out.append("null"); self._repair("H")
+            elif top.state != "after_value": self._repair("E"); return
+            top.state = "key_after_comma"
+        else:
+            if top.state != "after_value": self._repair("E"); return
+            top.state = "value_after_comma"
+
+    def _close_top(self, truncated=False):
+        top = self._stack[-1]
+        if top.kind == "{":
+            if top.state == "colon":
+                if truncated: self._emit_pending_key(top); self._out.append("null")
+                else: self._insert_missing_key(top)
+            elif top.state == "value": self._out.append("null")
+            elif top.state == "key_after_comma": self._repair("E")
+        elif top.state == "value_after_comma": self._repair("E")
+        self._out.append("}" if top.kind == "{" else "]"); self._stack.pop()
+        if not self._stack: self._closed = True; self.done = self._fenced or not self._prose
+
+    def _close(self, ch):
+        expected_kind = "{" if ch == "}" else "["
+        if not any(c.kind == expected_kind for c in self._stack): return
+        while self._stack[-1].kind != expected_kind:
+            self._close_top(truncated=True); self._repair("C")
+        self._close_top()
+        if self._closed and self._prose and not self._fenced and self.repairs: self._restart_after_prose()
+
+    # --- Результат ---
+    def finish(self):
+        if not self._started:
+            raise ValueError("JSON структура не найдена в ответе LLM. Детали: валидная структура '{...}' не найдена.")
+        if self._error:
+            json_text = "".join(self._out)
+            raise json.JSONDecodeError(f"Не удалось разобрать JSON ('{json_text[-100:].strip().replace(chr(10), ' ')}...'). Ошибка: {self._error}", doc=json_text, pos=len(json_text))
+        if self._mode == "string":
+            self._mode = None; self._repair("C"); self._value_token('"' + "".join(self._buf) + '"', is_string=True)
+        elif self._mode == "bareword": self._end_bareword()
+        self._mode = None
+        while self._stack:
+            self._close_top(truncated=True); self._repair("C")
+        if self._trailing_text: self._repair("B")
+        json_text = "".join(self._out)
+        try:
+            return json.loads(json_text)
+        except json.JSONDecodeError as e:
+            raise json.JSONDecodeError(f"Не удалось восстановить JSON ('{json_text[:100].strip().replace(chr(10), ' ')}...'). Исходная ошибка: {e.msg}",
+                                       doc=json_text, pos=e.pos)
+
+    def partial(self):
+        # Текущий разобранный префикс как объект (оборванная структура достраивается), без изменения состояния.
+        if not self._started: return None
+        try: return copy.deepcopy(self).finish()
+        except ValueError: return None
+
+
+def report_json_repairs(repairs, notify=None):
+    notify = notify or _ignore_notice
+    for code in repairs:
+        notify("info", f"Ремонт {code}: {REPAIR_DESCRIPTIONS[code]}.")
+
+def consume_json_stream(text_chunks, parser):
+    # Подает поток текста в парсер и прекращает чтение, как только JSON-объект закрыт:
+    # продолжение генерации после JSON не нужно. Возвращает полученный текст.
+    raw_parts = []
+    for text in text_chunks:
+        raw_parts.append(text)
+        if parser.feed(text): break
+    close_stream = getattr(text_chunks, "close", None)
+    if close_stream: close_stream()
+    return "".join(raw_parts).strip()
+
+def extract_and_parse_json(raw_text, notify=None, parser=None):
+    notify = notify or _ignore_notice
+    with telemetry.span("json_parse", chars=len(raw_text or ""), streamed=parser is not None) as parse_span:
+        if not raw_text or not raw_text.strip():
+            telemetry.metrics.inc("vp_json_parse_total", status="empty")
+            raise ValueError("Ответ LLM пуст или отсутствует.")
+        if parser is None:
+            parser = TolerantJSONParser(); parser.feed(raw_text)
+        try: parsed = parser.finish()
+        except ValueError:
+            telemetry.metrics.inc("vp_json_parse_total", status="failed"); parse_span.set(repairs=",".join(parser.repairs) or None); raise
+        for code in parser.repairs: telemetry.metrics.inc("vp_json_repairs_total", code=code)
+        telemetry.metrics.inc("vp_json_parse_total", status="repaired" if parser.repairs else "clean"); parse_span.set(repairs=",".join(parser.repairs) or None)
+    report_json_repairs(parser.repairs, notify)
+    return parsed
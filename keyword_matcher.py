@@ -0,0 +1,72 @@
+import re
+
+# --- Сопоставление ключевых слов с текстом врача ---
+# Ключевые фразы (например, request_keywords исследований) разбиваются на слова, слова
+# приводятся к основе простым отсечением русских окончаний. Индекс строится один раз на
+# сценарий: первая основа фразы -> фразы. Слово сообщения совпадает с основой, если
+# начинается с нее ("анализ крови" находит "анализа крови", "рентген" — "рентгенографию");
+# короткие сокращения ("ад", "оак", "экг") должны совпадать со словом целиком.
+# Для каждого слова сообщения проверяются только его префиксы, поэтому стоимость хода
+# зависит от длины сообщения, а не от числа исследований и ключевых слов в сценарии.
+
+_WORD_RE = re.compile(r"[0-9a-zа-я]+")
+_MIN_STEM_LENGTH = 3
+_MAX_EXACT_WORD_LENGTH = 3
+_RU_ENDINGS = sorted([
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ых", "их", "ой", "ей", "ий", "ый", "ая", "яя",
+    "ое", "ее", "ые", "ие", "ую", "юю", "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев", "ию", "ия", "ье", "ья",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+
+
+def normalize_text(text):
+    return text.lower().replace("ё", "е")
+
+def stem_word(word):
+    for suffix in ("ся", "сь"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= _MIN_STEM_LENGTH: word = word[:-len(suffix)]; break
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM_LENGTH: return word[:-len(ending)]
+    return word
+
+def split_words(text):
+    return _WORD_RE.findall(normalize_text(text))
+
+def _keyword_stem(word):
+    # (основа, только точное совпадение): короткие слова без окончания — сокращения.
+    stem = stem_word(word)
+    return stem, len(word) <= _MAX_EXACT_WORD_LENGTH and stem == word
+
+
+class KeywordMatcher:
+    def __init__(self, keyword_targets=()):
+        # keyword_targets: пары (ключевая фраза, цель); одна цель может иметь много фраз.
+        self._index = {}  # первая основа -> [(основы фразы, цели)]
+        self._phrases = {}
+        for keyword, target in keyword_targets:
+            stems = tuple(_keyword_stem(w) for w in split_words(str(keyword)))
+            if not stems: continue
+            if stems not in self._phrases:
+                self._phrases[stems] = set(); self._index.setdefault(stems[0][0], []).append((stems, self._phrases[stems]))
+            self._phrases[stems].add(target)
+        self._max_stem_length = max((len(s) for s in self._index), default=0)
+
+    def __len__(self):
+        return len(self._phrases)
+
+    def match(self, text):
+        # Все цели, ключевые фразы которых встречаются в тексте, за один проход по словам.
+        found = set()
+        if not self._index or not text: return found
+        words = split_words(text)
+        for i, word in enumerate(words):
+            for prefix_length in range(1, min(len(word), self._max_stem_length) + 1):
+                for stems, targets in self._index.get(word[:prefix_length], ()):
+                    if i + len(stems) <= len(words) and all(words[i + j] == stem if exact else words[i + j].startswith(stem) for j, (stem, exact) in enumerate(stems)):
+                        found |= targets
+        return found
+
+
+def build_investigation_matcher(scenario):
+    return KeywordMatcher((keyword, inv_key) for inv_key, inv_details in scenario.get("available_investigations", {}).items()
+                          if isinstance(inv_details, dict) for keyword in inv_details.get("request_keywords", []))
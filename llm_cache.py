@@ -0,0 +1,151 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+# --- Кэш ответов LLM по содержимому запроса ---
+# Ключ — хэш модели, сообщений, temperature, max_tokens и параметров формата ответа.
+# Два уровня: LRU в памяти процесса и SQLite на диске (переживает перезапуск), оба с TTL;
+# диск дополнительно ограничен по объему. Кэширование включается для каждого вызова отдельно
+# (use_cache=True): оно уместно для оценки, консультаций и сжатия истории, но не для
+# "живых" ответов пациента и генерации сценариев, где ценится разнообразие.
+# Потоковый ответ сохраняется, только если поток дочитан до конца или потребитель, закрывший его
+# раньше, подтвердил полноту ответа (stream_complete(), например JSON уже получен целиком).
+
+CACHE_KEY_FIELDS = ["model", "messages", "temperature", "max_tokens", "response_format", "extra_body"]
+
+
+def make_cache_key(request_kwargs):
+    key_data = {field: request_kwargs.get(field) for field in CACHE_KEY_FIELDS}
+    return hashlib.sha256(json.dumps(key_data, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, db_path=None, memory_items=256, ttl_seconds=7 * 86400, max_disk_bytes=50 * 1024 * 1024):
+        self.db_path = db_path
+        self.memory_items = max(0, int(memory_items))
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> (created_at, text)
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._db = None
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            # Файл кэша может быть общим для нескольких процессов приложения.
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL, size INTEGER NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used_at)")
+            self._db.commit()
+
+    def _expired(self, created_at, now):
+        return bool(self.ttl_seconds) and now - created_at > self.ttl_seconds
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0], now):
+                self._memory.move_to_end(key); self._counters["memory_hits"] += 1
+                return entry[1]
+            self._memory.pop(key, None)
+            if self._db is not None:
+                row = self._db.execute("SELECT text, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self._db.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key)); self._db.commit()
+                    self._remember(key, row[1], row[0]); self._counters["disk_hits"] += 1
+                    return row[0]
+            self._counters["misses"] += 1
+            return None
+
+    def _remember(self, key, created_at, text):
+        if not self.memory_items: return
+        self._memory[key] = (created_at, text); self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items: self._memory.popitem(last=False)
+
+    def put(self, key, text):
+        if not text: return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, text); self._counters["stores"] += 1
+            if self._db is None: return
+            self._db.execute("INSERT OR REPLACE INTO responses (key, text, created_at, last_used_at, size) VALUES (?, ?, ?, ?, ?)",
+                             (key, text, now, now, len(text.encode("utf-8"))))
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        evicted = 0
+        if self.ttl_seconds:
+            evicted += self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)).rowcount
+        if self.max_disk_bytes:
+            total_size, count = self._db.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM responses").fetchone()
+            if total_size > self.max_disk_bytes:
+                # Давно не использованные записи удаляются одним запросом по индексу; их число — по среднему размеру записи.
+                limit = math.ceil((total_size - self.max_disk_bytes) * count / total_size)
+                evicted += self._db.execute("DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY last_used_at LIMIT ?)", (limit,)).rowcount
+        self._counters["evictions"] += evicted
+
+    def stats(self):
+        with self._lock:
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]; lookups = hits + self._counters["misses"]
+            disk_items = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] if self._db is not None else 0
+            return {"memory_items": len(self._memory), "disk_items": disk_items, **self._counters, "hit_rate": hits / lookups if lookups else 0.0}
+
+
+def _cached_completion(text):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=text), finish_reason="stop")], usage=None, cached=True)
+
+def _cached_stream(text):
+    yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text), finish_reason="stop")], usage=None, cached=True)
+
+
+class CachingLLMClient:
+    # Обертка над планировщиком (или пулом) с тем же create_chat_completion. Попадание в кэш
+    # не занимает место в очереди LLM. Остальные атрибуты (stats, pool, ...) берутся у обернутого клиента.
+    def __init__(self, llm_client, cache):
+        self.llm_client = llm_client
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.llm_client, name)
+
+    def create_chat_completion(self, use_cache=False, refresh_cache=False, stream_complete=None, **kwargs):
+        # refresh_cache=True: не читать кэш (повторный запрос по просьбе пользователя), но сохранить новый ответ.
+        # stream_complete() — для stream=True: вызывается, если поток закрыт до конца или завершился не по "stop";
+        # True — ответ полон и его можно сохранить.
+        if not use_cache or self.cache is None: return self.llm_client.create_chat_completion(**kwargs)
+        key = make_cache_key(kwargs)
+        cached_text = None if refresh_cache else self.cache.get(key)
+        if cached_text is not None:
+            return _cached_stream(cached_text) if kwargs.get("stream") else _cached_completion(cached_text)
+        response = self.llm_client.create_chat_completion(**kwargs)
+        if kwargs.get("stream"): return self._caching_stream(key, response, stream_complete)
+        # Сохраняется только ответ, завершенный моделью (finish_reason "stop"), а не обрезанный по max_tokens ("length").
+        if response.choices and response.choices[0].message.content and getattr(response.choices[0], "finish_reason", None) == "stop":
+            self.cache.put(key, response.choices[0].message.content)
+        return response
+
+    def _caching_stream(self, key, stream, stream_complete=None):
+        parts = []; completed = False; finish_reason = None
+        try:
+            for chunk in stream:
+                if chunk.choices and getattr(chunk.choices[0].delta, "content", None): parts.append(chunk.choices[0].delta.content)
+                if chunk.choices and getattr(chunk.choices[0], "finish_reason", None): finish_reason = chunk.choices[0].finish_reason
+                yield chunk
+            completed = finish_reason == "stop" or bool(stream_complete and stream_complete())
+        except GeneratorExit:
+            # Поток закрыт раньше конца (пользователь ушел со страницы, ошибка выше по стеку) — это не полный ответ,
+            # если только потребитель не подтвердил обратное.
+            completed = bool(stream_complete and stream_complete())
+            raise
+        finally:
+            close_stream = getattr(stream, "close", None)
+            if close_stream: close_stream()
+            if completed and parts: self.cache.put(key, "".join(parts))
@@ -0,0 +1,155 @@
+import functools
+import json
+import re
+import threading
+
+from openai import BadRequestError, UnprocessableEntityError
+
+# --- Ограниченная генерация (constrained decoding) для JSON-ответов LLM ---
+# Из JSON-схемы ответа строится GBNF-грамматика (или схема передается как response_format),
+# и сервер (KoboldCpp / llama.cpp) на этапе сэмплирования допускает только токены,
+# дающие валидный JSON нужной структуры. Если сервер отклоняет параметр, запрос повторяется
+# без ограничений, а ответ, как и раньше, проходит через TolerantJSONParser.
+#
+# Поддерживаемое подмножество JSON Schema: type (в том числе список типов), properties
+# (все свойства обязательны и идут в порядке объявления), additionalProperties со схемой,
+# items, enum, const, anyOf, minimum/maximum для целых чисел из небольшого диапазона.
+
+CONSTRAINED_OFF = "off"
+CONSTRAINED_JSON_SCHEMA = "json_schema"
+CONSTRAINED_GBNF = "gbnf"
+CONSTRAINED_MODES = [CONSTRAINED_OFF, CONSTRAINED_JSON_SCHEMA, CONSTRAINED_GBNF]
+
+_MAX_ENUMERATED_RANGE = 100
+
+# Примитивы совпадают с json.gbnf из llama.cpp; пробелы ограничены, чтобы модель не "зависала" на отступах.
+_GBNF_PRIMITIVES = {
+    "ws": r'| " " | "\n" [ \t]{0,20}',
+    "string": r'"\"" ( [^"\\\x7F\x00-\x1F] | "\\" (["\\/bfnrt] | "u" [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F] [0-9a-fA-F]) )* "\"" ws',
+    "number": r'"-"? ([0-9] | [1-9] [0-9]*) ("." [0-9]+)? ([eE] [-+]? [0-9]+)? ws',
+    "integer": r'"-"? ([0-9] | [1-9] [0-9]*) ws',
+    "boolean": r'("true" | "false") ws',
+    "null": r'"null" ws',
+}
+
+_unsupported_modes = set()
+_unsupported_lock = threading.Lock()
+# Ошибка 400/422 считается отказом от ограничений, только если в ее тексте упоминается параметр ограничения;
+# иначе (переполнение контекста, неверный параметр запроса) режим не отключается для всего процесса.
+_CONSTRAINT_ERROR_RE = re.compile(r"grammar|gbnf|response_format|json_schema", re.IGNORECASE)
+
+def _ignore_notice(level, message):
+    pass
+
+
+# --- Построение JSON-схем ---
+def object_schema(properties, additional_properties=False):
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": additional_properties}
+
+def json_schema_from_defaults(defaults, overrides=None):
+    # Схема по образцу значений по умолчанию (как required_keys_with_defaults):
+    # строки -> string, списки -> массив по первому элементу (пустой -> массив строк), словари -> объект.
+    overrides = overrides or {}
+    if isinstance(defaults, dict):
+        return object_schema({key: overrides[key] if key in overrides else json_schema_from_defaults(value) for key, value in defaults.items()})
+    if isinstance(defaults, list):
+        return {"type": "array", "items": json_schema_from_defaults(defaults[0]) if defaults else {"type": "string"}}
+    if isinstance(defaults, bool): return {"type": "boolean"}
+    if isinstance(defaults, int): return {"type": "integer"}
+    if isinstance(defaults, float): return {"type": "number"}
+    return {"type": "string"}
+
+
+# --- JSON Schema -> GBNF ---
+def _gbnf_literal(value):
+    json_text = json.dumps(value, ensure_ascii=False)
+    return '"' + json_text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+class _GBNFBuilder:
+    def __init__(self):
+        self.rules = {}
+
+    def _add(self, name, body):
+        for existing_name, existing_body in self.rules.items():
+            if existing_body == body: return existing_name
+        name = re.sub(r"[^a-zA-Z0-9]+", "-", name).strip("-").lower() or "rule"
+        unique_name, i = name, 1
+        while unique_name in self.rules: i += 1; unique_name = f"{name}-{i}"
+        self.rules[unique_name] = body
+        return unique_name
+
+    def _primitive(self, type_name):
+        if type_name not in _GBNF_PRIMITIVES: raise ValueError(f"Неподдерживаемый тип JSON-схемы: {type_name}")
+        self.rules.setdefault("ws", _GBNF_PRIMITIVES["ws"]); self.rules.setdefault(type_name, _GBNF_PRIMITIVES[type_name])
+        return type_name
+
+    def visit(self, schema, name):
+        if "anyOf" in schema:
+            return self._add(name, " | ".join(self.visit(sub, f"{name}-{i}") for i, sub in enumerate(schema["anyOf"])))
+        if "const" in schema:
+            self._primitive("ws"); return self._add(name, f"{_gbnf_literal(schema['const'])} ws")
+        if "enum" in schema:
+            self._primitive("ws"); return self._add(name, "(" + " | ".join(_gbnf_literal(v) for v in schema["enum"]) + ") ws")
+        schema_type = schema.get("type", "string")
+        if isinstance(schema_type, list):
+            return self.visit({"anyOf": [dict(schema, type=t) for t in schema_type]}, name)
+        if schema_type == "object": return self._visit_object(schema, name)
+        if schema_type == "array":
+            item_rule = self.visit(schema.get("items", {}), f"{name}-item"); self._primitive("ws")
+            return self._add(name, f'"[" ws ({item_rule} ("," ws {item_rule})*)? "]" ws')
+        if schema_type == "integer" and "minimum" in schema and "maximum" in schema and schema["maximum"] - schema["minimum"] <= _MAX_ENUMERATED_RANGE:
+            return self.visit({"enum": list(range(int(schema["minimum"]), int(schema["maximum"]) + 1))}, name)
+        return self._primitive(schema_type)
+
+    def _visit_object(self, schema, name):
+        self._primitive("ws")
+        parts = []
+        for i, (key, sub_schema) in enumerate(schema.get("properties", {}).items()):
+            value_rule = self.visit(sub_schema, f"{name}-{key}")
+            parts.append(('"," ws ' if i else "") + f'{_gbnf_literal(key)} ws ":" ws {value_rule}')
+        additional = schema.get("additionalProperties")
+        if isinstance(additional, dict):
+            extra_pair = f'{self._primitive("string")} ":" ws {self.visit(additional, f"{name}-value")}'
+            parts.append(f'("," ws {extra_pair})*' if parts else f'({extra_pair} ("," ws {extra_pair})*)?')
+        return self._add(name, f'"{{" ws {" ".join(parts)} "}}" ws')
+
+def json_schema_to_gbnf(schema):
+    builder = _GBNFBuilder()
+    root_rule = builder.visit(schema, "root")
+    if root_rule != "root": builder.rules["root"] = root_rule
+    return "\n".join(f"{name} ::= {body}" for name, body in sorted(builder.rules.items(), key=lambda item: item[0] != "root"))
+
+@functools.lru_cache(maxsize=32)
+def _gbnf_from_schema_text(schema_text):
+    return json_schema_to_gbnf(json.loads(schema_text))
+
+
+# --- Параметры запроса и откат ---
+def constrained_request_kwargs(mode, schema, schema_name="response"):
+    if mode == CONSTRAINED_JSON_SCHEMA:
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": schema_name, "schema": schema, "strict": True}}}
+    if mode == CONSTRAINED_GBNF:
+        return {"extra_body": {"grammar": _gbnf_from_schema_text(json.dumps(schema, ensure_ascii=False))}}
+    return {}
+
+def is_constrained_mode_active(mode):
+    return mode in (CONSTRAINED_JSON_SCHEMA, CONSTRAINED_GBNF) and mode not in _unsupported_modes
+
+def _is_constraint_rejection(error):
+    return bool(_CONSTRAINT_ERROR_RE.search(f"{error} {json.dumps(getattr(error, 'body', None), ensure_ascii=False, default=str)}"))
+
+def create_constrained_completion(llm_client, mode, schema, schema_name="response", notify=None, **request_kwargs):
+    # Запрос с грамматикой/схемой; если сервер отклонил именно параметр ограничения (ошибка 400/422),
+    # режим запоминается как неподдерживаемый для процесса. При любой ошибке 400/422 этот запрос
+    # повторяется без ограничений.
+    notify = notify or _ignore_notice
+    if is_constrained_mode_active(mode):
+        try:
+            return llm_client.create_chat_completion(**request_kwargs, **constrained_request_kwargs(mode, schema, schema_name))
+        except (BadRequestError, UnprocessableEntityError) as e:
+            if _is_constraint_rejection(e):
+                with _unsupported_lock: _unsupported_modes.add(mode)
+                notify("warning", f"LLM-сервер не поддерживает ограниченную генерацию ({mode}): {e}. Ответ будет разобран с восстановлением JSON.")
+            else:
+                notify("warning", f"LLM-сервер отклонил запрос с ограниченной генерацией ({mode}): {e}. Запрос повторяется без ограничений.")
+    return llm_client.create_chat_completion(**request_kwargs)
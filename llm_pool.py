@@ -0,0 +1,219 @@
+import threading
+import time
+from collections import OrderedDict
+
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError
+
+import telemetry
+
+# --- Пул LLM-бэкендов (несколько узлов KoboldCpp / OpenAI-совместимых серверов) ---
+# Маршрутизация по наименьшему числу выполняющихся запросов, лимит параллельных
+# запросов на узел, периодические проверки доступности и автоматический failover.
+# Запросы с affinity_key (id сессии) по возможности идут на тот же узел, что и раньше:
+# там в KV-кэше уже лежит префикс диалога этой сессии.
+
+HEALTH_CHECK_TIMEOUT = 5.0
+AFFINITY_HEADER = "X-Session-Affinity"
+MAX_AFFINITY_KEYS = 4096
+
+
+class NoAvailableBackendError(RuntimeError):
+    pass
+
+
+class OpenAICompatibleBackend:
+    # Один узел с OpenAI-совместимым API. Любой объект с теми же методами
+    # (create_chat_completion, check_health) и атрибутами может быть добавлен в пул.
+    def __init__(self, base_url, max_concurrency=1, api_key="sk-not-needed"):
+        self.base_url = base_url
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.last_error = None
+        self.last_checked_at = None
+
+    def create_chat_completion(self, **kwargs):
+        return self.client.chat.completions.create(**kwargs)
+
+    def check_health(self):
+        self.client.models.list(timeout=HEALTH_CHECK_TIMEOUT)
+
+
+def iter_completion_text(stream):
+    # Текст из потока chat.completions (stream=True); закрытие генератора закрывает и сам поток.
+    try:
+        for chunk in stream:
+            if chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+                yield chunk.choices[0].delta.content
+    finally:
+        close_stream = getattr(stream, "close", None)
+        if close_stream: close_stream()
+
+
+class ReleasingStream:
+    # Поток ответа, занимающий слот (узла пула или очереди планировщика). Слот освобождается ровно один раз:
+    # в конце чтения, при ошибке, при close() или при сборке мусора, если поток так и не прочитали.
+    def __init__(self, stream, release):
+        self._stream = stream; self._iterator = None; self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._release is None: raise StopIteration
+        try:
+            if self._iterator is None: self._iterator = iter(self._stream)
+            return next(self._iterator)
+        except StopIteration:
+            self.close(); raise
+        except Exception as e:
+            self.close(e); raise
+
+    def close(self, error=None):
+        release, self._release = self._release, None
+        if release is None: return
+        try:
+            close_stream = getattr(self._stream, "close", None)
+            if close_stream: close_stream()
+        finally:
+            release(error)
+
+    def __del__(self):
+        self.close()
+
+
+def _is_failover_error(exc):
+    # Таймаут длинной генерации не повторяем на другом узле: это удвоило бы ожидание.
+    if isinstance(exc, APITimeoutError): return False
+    return isinstance(exc, (APIConnectionError, InternalServerError))
+
+
+class LLMBackendPool:
+    def __init__(self, backends, failure_threshold=2, health_check_interval=30.0):
+        if not backends: raise ValueError("Список LLM-бэкендов пуст.")
+        self.backends = list(backends)
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.health_check_interval = health_check_interval
+        self._condition = threading.Condition()
+        self._health_thread = None
+        self._stop_event = threading.Event()
+        self._affinity = OrderedDict()  # affinity_key -> узел, обслуживший последний запрос сессии
+        self._affinity_counters = {"hits": 0, "misses": 0}
+
+    @classmethod
+    def from_urls(cls, base_urls, max_concurrency_per_backend=1, **pool_kwargs):
+        return cls([OpenAICompatibleBackend(url, max_concurrency_per_backend) for url in base_urls], **pool_kwargs)
+
+    @property
+    def total_capacity(self):
+        return sum(b.max_concurrency for b in self.backends if b.healthy) or sum(b.max_concurrency for b in self.backends)
+
+    def _pick_backend(self, exclude, affinity_key=None):
+        candidates = [b for b in self.backends if b not in exclude]
+        healthy_candidates = [b for b in candidates if b.healthy]
+        # Если все узлы помечены недоступными, пробуем их всё равно: статус мог устареть.
+        candidates = healthy_candidates or candidates
+        if not candidates: return None, False
+        free = [b for b in candidates if b.outstanding < b.max_concurrency]
+        if not free: return None, True
+        preferred = self._affinity.get(affinity_key) if affinity_key is not None else None
+        if preferred in free: return preferred, True
+        return min(free, key=lambda b: (b.outstanding / b.max_concurrency, b.total_requests)), True
+
+    def _remember_affinity(self, affinity_key, backend):
+        if affinity_key is None: return
+        self._affinity_counters["hits" if self._affinity.get(affinity_key) is backend else "misses"] += 1
+        self._affinity[affinity_key] = backend; self._affinity.move_to_end(affinity_key)
+        while len(self._affinity) > MAX_AFFINITY_KEYS: self._affinity.popitem(last=False)
+
+    def _acquire(self, exclude, wait_timeout, affinity_key=None):
+        deadline = None if wait_timeout is None else time.monotonic() + wait_timeout
+        with self._condition:
+            while True:
+                backend, any_candidates = self._pick_backend(exclude, affinity_key)
+                if backend is not None:
+                    backend.outstanding += 1; backend.total_requests += 1
+                    self._remember_affinity(affinity_key, backend)
+                    return backend
+                if not any_candidates:
+                    raise NoAvailableBackendError("Нет доступных LLM-бэкендов для выполнения запроса.")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise NoAvailableBackendError("Все LLM-бэкенды заняты: истекло время ожидания свободного узла.")
+                self._condition.wait(remaining)
+
+    def _release(self, backend, error=None):
+        with self._condition:
+            backend.outstanding = max(0, backend.outstanding - 1)
+            if error is None:
+                backend.consecutive_failures = 0; backend.healthy = True
+            elif _is_failover_error(error):
+                telemetry.metrics.inc("vp_llm_backend_failures_total", backend=backend.base_url, error=type(error).__name__)
+                backend.total_failures += 1; backend.consecutive_failures += 1; backend.last_error = str(error)
+                if backend.consecutive_failures >= self.failure_threshold: backend.healthy = False
+            self._condition.notify_all()
+
+    def create_chat_completion(self, affinity_key=None, **kwargs):
+        # Тот же контракт, что у client.chat.completions.create; при stream=True
+        # узел остается занятым, пока поток не будет прочитан до конца или закрыт.
+        wait_timeout = kwargs.get("timeout")
+        if affinity_key is not None:
+            # Заголовок позволяет и внешнему балансировщику направлять сессию на один узел.
+            kwargs["extra_headers"] = dict(kwargs.get("extra_headers") or {}, **{AFFINITY_HEADER: str(affinity_key)})
+        tried = []; last_error = None
+        for _ in range(len(self.backends)):
+            try: backend = self._acquire(tried, wait_timeout, affinity_key)
+            except NoAvailableBackendError:
+                if last_error is not None: raise last_error
+                raise
+            tried.append(backend)
+            if last_error is not None:
+                telemetry.metrics.inc("vp_llm_retries_total", backend=backend.base_url); telemetry.current_span().add("retries")
+            telemetry.current_span().set(backend=backend.base_url)
+            try:
+                response = backend.create_chat_completion(**kwargs)
+            except Exception as e:
+                self._release(backend, e)
+                if not _is_failover_error(e): raise
+                last_error = e
+                continue
+            if kwargs.get("stream"): return ReleasingStream(response, lambda error: self._release(backend, error))
+            self._release(backend)
+            return response
+        raise last_error or NoAvailableBackendError("Не удалось выполнить запрос ни на одном LLM-бэкенде.")
+
+    def check_backends(self):
+        for backend in self.backends:
+            try:
+                backend.check_health(); ok, error_text = True, None
+            except Exception as e:
+                ok, error_text = False, str(e)
+            with self._condition:
+                backend.last_checked_at = time.time()
+                if ok: backend.healthy = True; backend.consecutive_failures = 0
+                else: backend.healthy = False; backend.last_error = error_text
+                self._condition.notify_all()
+
+    def start_health_checks(self):
+        if self._health_thread is not None or not self.health_check_interval: return
+        def _loop():
+            while not self._stop_event.wait(self.health_check_interval): self.check_backends()
+        self._health_thread = threading.Thread(target=_loop, name="llm-pool-health", daemon=True)
+        self._health_thread.start()
+
+    def stop_health_checks(self):
+        self._stop_event.set()
+
+    def affinity_stats(self):
+        with self._condition:
+            lookups = self._affinity_counters["hits"] + self._affinity_counters["misses"]
+            return {"sessions": len(self._affinity), **self._affinity_counters, "hit_rate": self._affinity_counters["hits"] / lookups if lookups else 0.0}
+
+    def stats(self):
+        with self._condition:
+            return [{"base_url": b.base_url, "healthy": b.healthy, "outstanding": b.outstanding, "max_concurrency": b.max_concurrency,
+                     "total_requests": b.total_requests, "total_failures": b.total_failures, "last_error": b.last_error} for b in self.backends]
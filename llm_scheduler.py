@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from llm_pool import ReleasingStream
+import telemetry
+
+# --- Приоритетный планировщик запросов к LLM ---
+# Стоит перед пулом бэкендов: интерактивные запросы (ответ пациента, консультация)
+# обгоняют в очереди генерацию сценариев и оценку. Внутри одного класса запросы
+# разных пользователей обслуживаются по кругу, чтобы один пользователь не занял всю очередь.
+
+PRIORITY_PATIENT = "patient"
+PRIORITY_CONSULTANT = "consultant"
+PRIORITY_GENERATION = "generation"
+PRIORITY_EVALUATION = "evaluation"
+PRIORITY_ORDER = [PRIORITY_PATIENT, PRIORITY_CONSULTANT, PRIORITY_GENERATION, PRIORITY_EVALUATION]
+INTERACTIVE_PRIORITIES = {PRIORITY_PATIENT, PRIORITY_CONSULTANT}
+
+DEFAULT_MAX_QUEUE_WAIT = {PRIORITY_PATIENT: 120.0, PRIORITY_CONSULTANT: 120.0, PRIORITY_GENERATION: 600.0, PRIORITY_EVALUATION: 900.0}
+
+
+class SchedulerRejectedError(RuntimeError):
+    pass
+
+
+class _Ticket:
+    __slots__ = ("priority", "user_id", "enqueued_at", "granted", "queue_wait_s")
+
+    def __init__(self, priority, user_id):
+        self.priority = priority; self.user_id = user_id
+        self.enqueued_at = time.monotonic(); self.granted = False; self.queue_wait_s = None
+
+
+class PriorityLLMScheduler:
+    def __init__(self, pool, max_queue_per_class=64, reserved_interactive_slots=1, max_in_flight=None, max_queue_wait=None):
+        self.pool = pool
+        self.max_queue_per_class = max(1, int(max_queue_per_class))
+        self.reserved_interactive_slots = max(0, int(reserved_interactive_slots))
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = dict(DEFAULT_MAX_QUEUE_WAIT, **(max_queue_wait or {}))
+        self._condition = threading.Condition()
+        # priority -> OrderedDict(user_id -> deque[_Ticket]); порядок ключей задает очередность пользователей.
+        self._queues = {p: OrderedDict() for p in PRIORITY_ORDER}
+        self._queued = {p: 0 for p in PRIORITY_ORDER}
+        self._in_flight = {p: 0 for p in PRIORITY_ORDER}
+        self._counters = {p: {"dispatched": 0, "rejected": 0, "timed_out": 0, "queue_wait_total_s": 0.0, "queue_wait_max_s": 0.0} for p in PRIORITY_ORDER}
+
+    def _capacity(self):
+        return self.max_in_flight or self.pool.total_capacity
+
+    def _can_dispatch(self, priority):
+        capacity = self._capacity(); total_in_flight = sum(self._in_flight.values())
+        if total_in_flight >= capacity: return False
+        if priority in INTERACTIVE_PRIORITIES: return True
+        # Пакетные запросы не занимают последние слоты: они остаются за интерактивными.
+        reserved = min(self.reserved_interactive_slots, capacity - 1)
+        batch_in_flight = sum(n for p, n in self._in_flight.items() if p not in INTERACTIVE_PRIORITIES)
+        return batch_in_flight < capacity - reserved
+
+    def _dispatch(self):
+        granted_any = False
+        for priority in PRIORITY_ORDER:
+            users_queue = self._queues[priority]
+            while users_queue and self._can_dispatch(priority):
+                user_id, tickets = next(iter(users_queue.items()))
+                ticket = tickets.popleft()
+                if tickets: users_queue.move_to_end(user_id)
+                else: del users_queue[user_id]
+                self._queued[priority] -= 1; self._in_flight[priority] += 1
+                ticket.granted = True; ticket.queue_wait_s = time.monotonic() - ticket.enqueued_at
+                counters = self._counters[priority]
+                counters["dispatched"] += 1; counters["queue_wait_total_s"] += ticket.queue_wait_s
+                counters["queue_wait_max_s"] = max(counters["queue_wait_max_s"], ticket.queue_wait_s)
+                granted_any = True
+            if users_queue: break  # Более низкие классы не обгоняют ожидающие запросы высокого приоритета.
+        if granted_any: self._condition.notify_all()
+
+    def _remove_ticket(self, ticket):
+        tickets = self._queues[ticket.priority].get(ticket.user_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket); self._queued[ticket.priority] -= 1
+            if not tickets: del self._queues[ticket.priority][ticket.user_id]
+
+    def _acquire(self, priority, user_id):
+        if priority not in self._queues: raise ValueError(f"Неизвестный класс приоритета: {priority}")
+        ticket = _Ticket(priority, user_id or "anonymous")
+        with self._condition:
+            if self._queued[priority] >= self.max_queue_per_class:
+                self._counters[priority]["rejected"] += 1; telemetry.metrics.inc("vp_llm_rejected_total", priority=priority, reason="queue_full")
+                raise SchedulerRejectedError(f"Очередь запросов к LLM ({priority}) переполнена. Попробуйте позже.")
+            self._queues[priority].setdefault(ticket.user_id, deque()).append(ticket); self._queued[priority] += 1
+            self._dispatch()
+            deadline = ticket.enqueued_at + self.max_queue_wait.get(priority, 600.0)
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove_ticket(ticket); self._counters[priority]["timed_out"] += 1
+                    telemetry.metrics.inc("vp_llm_rejected_total", priority=priority, reason="queue_timeout")
+                    raise SchedulerRejectedError(f"Истекло время ожидания в очереди запросов к LLM ({priority}).")
+                self._condition.wait(remaining)
+        telemetry.metrics.observe("vp_llm_queue_wait_seconds", ticket.queue_wait_s, priority=priority)
+        telemetry.current_span().set(queue_wait_s=round(ticket.queue_wait_s, 4))
+        return ticket
+
+    def _release(self, ticket):
+        with self._condition:
+            self._in_flight[ticket.priority] -= 1
+            self._dispatch()
+            self._condition.notify_all()
+
+    def create_chat_completion(self, priority=PRIORITY_PATIENT, user_id=None, **kwargs):
+        ticket = self._acquire(priority, user_id)
+        try:
+            response = self.pool.create_chat_completion(**kwargs)
+        except Exception:
+            self._release(ticket); raise
+        if kwargs.get("stream"): return ReleasingStream(response, lambda error: self._release(ticket))
+        self._release(ticket)
+        return response
+
+    def has_idle_capacity(self):
+        # Для фоновой работы (пополнение пула сценариев): никто не ждет в очереди и есть свободный пакетный слот.
+        with self._condition:
+            return not any(self._queued.values()) and self._can_dispatch(PRIORITY_GENERATION)
+
+    def stats(self):
+        with self._condition:
+            per_class = {}
+            for priority in PRIORITY_ORDER:
+                counters = self._counters[priority]
+                per_class[priority] = {"queued": self._queued[priority], "in_flight": self._in_flight[priority], "queued_users": len(self._queues[priority]),
+                                       **counters, "queue_wait_avg_s": counters["queue_wait_total_s"] / counters["dispatched"] if counters["dispatched"] else 0.0}
+            return {"capacity": self._capacity(), "classes": per_class}
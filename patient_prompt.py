@@ -0,0 +1,76 @@
+import json
+
+from constants import DIFFICULTY_LEVELS_DETAILS
+from dialogue_history import iter_visible_messages
+
+# --- Промпт LLM-пациента ---
+# Системный промпт строится один раз на сценарий и не меняется ни на байт, история диалога
+# только дописывается в конец. Модификатор состояния, появившийся по ходу сценария, добавляется
+# к следующей реплике врача (первой после сообщения с индексом message_index) и дальше
+# не сдвигается. Так запрос каждого хода продолжает предыдущий, и сервер LLM (KoboldCpp /
+# llama.cpp) переиспользует KV-кэш всего префикса, обрабатывая только новые токены.
+# Системное сообщение одно и стоит первым, дальше роли чередуются (подряд идущие реплики одной
+# роли объединяются): шаблоны чата вроде Gemma не принимают ни системные сообщения в середине
+# диалога, ни два ответа ассистента подряд. Краткое содержание свернутой части истории
+# дописывается в конец системного промпта.
+
+DEFAULT_PATIENT_PERSONA_PROMPT = "Ты пациент. Отвечай на вопросы врача."
+STATE_MODIFIERS_HEADER = "ТЕКУЩЕЕ СОСТОЯНИЕ ПАЦИЕНТА (учитывай в следующем ответе):"
+DIALOGUE_SUMMARY_HEADER = "КРАТКОЕ СОДЕРЖАНИЕ НАЧАЛА ПРИЕМА (ранние реплики свернуты):"
+
+
+def build_patient_system_prompt(scenario):
+    base_persona_prompt = scenario.get("patient_llm_persona_system_prompt", DEFAULT_PATIENT_PERSONA_PROMPT)
+    difficulty_tag = scenario.get("difficulty_level_tag", "Средний")
+    difficulty_modifier = DIFFICULTY_LEVELS_DETAILS.get(difficulty_tag, {}).get("patient_persona_modifier", "")
+
+    phys_exam_details_str = json.dumps(scenario.get("physical_exam_findings_prompt_details", {}), ensure_ascii=False)
+    avail_inv_details_str = json.dumps(scenario.get("available_investigations", {}), ensure_ascii=False)
+
+    general_simulation_instructions = f"""
+ОБЩИЕ ИНСТРУКЦИИ ПО СИМУЛЯЦИИ:
+- Твоя главная задача: отвечать на вопросы врача, предоставлять информацию о своем самочувствии, истории болезни, а также симулировать результаты осмотров и анализов, когда врач их запрашивает.
+- ФИЗИКАЛЬНЫЙ ОСМОТР: Если врач пишет что-то вроде 'измеряю АД', 'слушаю легкие', 'пальпирую живот в такой-то области', 'осматриваю горло', 'проверяю кожные покровы', 'пальпирую лимфоузлы' и т.п., ты должен СИМУЛИРОВАТЬ результат этого действия и ВКЛЮЧИТЬ ЕГО В СВОЙ ОТВЕТ. Результаты должны быть клинически правдоподобными и соответствовать твоему состоянию в сценарии. Используй следующие данные для симуляции осмотра (если врач запросит что-то из этого, предоставь соответствующее значение): {phys_exam_details_str}. Если врач просит осмотреть что-то, чего нет в этих деталях, но это логично для твоего состояния, дай правдоподобный ответ. Если врач просто пишет 'Проведу осмотр', уточни: 'Что именно Вы хотите осмотреть, доктор?' Не предлагай провести осмотр сам.
+- АНАЛИЗЫ И ИССЛЕДОВАНИЯ: Если врач ЗАПРАШИВАЕТ какое-либо исследование, название которого (или его ключевые слова) совпадает с одним из доступных исследований (см. ниже), ты должен подтвердить назначение, но НЕ сообщать результаты сразу. Результаты станут "готовы" через указанное количество ходов ('turn_to_provide_results') и будут автоматически добавлены к твоему ответу приложением. Просто подтверди, что исследование будет сделано, например: 'Хорошо, доктор, я сдам этот анализ'. Доступные исследования для этого сценария: {avail_inv_details_str}.
+- ПОМНИ: Ты не должен сам предлагать провести осмотр или назначить анализы. Реагируй только на действия врача.
+"""
+    return f"{base_persona_prompt}\n{difficulty_modifier}\n{general_simulation_instructions}"
+
+
+def make_state_modifier(text, dialogue_messages):
+    # Модификатор привязывается к текущему концу диалога.
+    return {"text": text, "message_index": len(dialogue_messages)}
+
+
+def _with_state_modifiers(content, modifier_texts):
+    return f"({STATE_MODIFIERS_HEADER}\n" + "\n".join(modifier_texts) + f")\n\n{content}"
+
+
+def _append_message(messages, role, content):
+    # Подряд идущие реплики одной роли (ответ пациента и реплика триггера) объединяются: роли должны чередоваться.
+    if messages[-1]["role"] == role: messages[-1]["content"] += f"\n\n{content}"
+    else: messages.append({"role": role, "content": content})
+
+
+def build_patient_messages(system_prompt, dialogue_messages, state_modifiers=None, history_view=None):
+    # history_view — результат DialogueHistory.compact: ранние реплики заменяются кратким протоколом.
+    modifiers_by_index = {}
+    for modifier in state_modifiers or []:
+        modifiers_by_index.setdefault(modifier["message_index"], []).append(modifier["text"])
+    if history_view and history_view["summary"]:
+        system_prompt = f"{system_prompt}\n\n{DIALOGUE_SUMMARY_HEADER}\n{history_view['summary']}"
+    messages = [{"role": "system", "content": system_prompt}]
+    visible = dict(iter_visible_messages(dialogue_messages, history_view))
+    pending_modifiers = []
+    for i in range(len(dialogue_messages) + 1):
+        pending_modifiers += modifiers_by_index.get(i, [])
+        if i in visible and visible[i]["role"] in ["user", "assistant"]:
+            content = visible[i]["content"]
+            if visible[i]["role"] == "user" and pending_modifiers:
+                content = _with_state_modifiers(content, pending_modifiers); pending_modifiers = []
+            _append_message(messages, visible[i]["role"], content)
+    if pending_modifiers:
+        # Реплики врача после модификатора еще нет (ход без нового сообщения) — модификатор идет отдельной репликой.
+        if messages[-1]["role"] == "user": messages[-1]["content"] = _with_state_modifiers(messages[-1]["content"], pending_modifiers)
+        else: messages.append({"role": "user", "content": _with_state_modifiers("", pending_modifiers).rstrip()})
+    return messages
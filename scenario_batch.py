@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from constants import AGE_RANGES, DIFFICULTY_LEVELS, GENDERS, MEDICAL_SPECIALIZATIONS
+from keyword_matcher import normalize_text
+from llm_grammar import CONSTRAINED_MODES, CONSTRAINED_OFF
+from scenario_generation import check_patient_demographics, generate_scenario
+from scenario_similarity import DEFAULT_THRESHOLD, ScenarioSimilarityIndex
+
+# --- Пакетная генерация сценариев ---
+# Генерирует банк сценариев по сетке специализация × возраст × пол × сложность (по --per-cell на
+# ячейку) параллельно, через тот же стек клиента LLM, что и приложение (пул узлов + планировщик).
+# Каждый принятый сценарий дописывается строкой в JSONL (--output) и добавляется в базу каталога
+# (ScenarioStore, --store). Задача сетки имеет постоянный id (batch_task_id в сценарии), поэтому
+# повторный запуск с тем же --output пропускает готовые задачи и продолжает с места остановки.
+# Дубликаты (тот же диагноз и та же вводная о пациенте — среди SCENARIOS, базы каталога и уже
+# сгенерированных) отбрасываются, задача повторяется до --max-attempts раз. Почти-дубликаты (индекс
+# MinHash/LSH из scenario_similarity.py, сходство не ниже --similarity-threshold) тоже отбрасываются,
+# а с --flag-similar принимаются с пометкой similar_scenarios. С --strict отбрасываются и сценарии,
+# не прошедшие проверку возраста и пола.
+#
+#   python scenario_batch.py --url http://localhost:5002/v1/ --per-cell 2 --workers 4 --output bank/generated.jsonl
+#   python scenario_batch.py --specializations Кардиология,Пульмонология --ages "Пожилой (61-80 лет)" --limit 50
+
+STATUS_ACCEPTED = "accepted"
+STATUS_DUPLICATE = "duplicate"
+STATUS_REJECTED = "rejected"
+STATUS_FAILED = "failed"
+
+
+def scenario_fingerprint(scenario):
+    # Точный дубликат: совпадают диагноз и вводная о пациенте после нормализации текста.
+    text = " | ".join(normalize_text(str(scenario.get(field) or "")) for field in ("true_diagnosis_internal", "patient_initial_info_display"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def build_generation_grid(specializations, age_ranges, genders, difficulties, per_cell=1):
+    tasks = []
+    for specialization in specializations:
+        for age_range in age_ranges:
+            for gender in genders:
+                for difficulty in difficulties:
+                    for index in range(per_cell):
+                        task_id = f"{specialization}|{age_range}|{gender}|{difficulty}|{index}"
+                        tasks.append({"task_id": task_id, "specialization": specialization, "age_range": age_range, "gender": gender, "difficulty": difficulty})
+    return tasks
+
+
+def read_batch_output(output_path):
+    # Готовые задачи и сценарии из JSONL прошлых запусков; оборванная последняя строка пропускается.
+    done_task_ids = set(); scenarios = []
+    if not os.path.exists(output_path): return done_task_ids, scenarios
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try: scenario = json.loads(line)
+            except json.JSONDecodeError: continue
+            if scenario.get("batch_task_id"): done_task_ids.add(scenario["batch_task_id"])
+            scenarios.append(scenario)
+    return done_task_ids, scenarios
+
+
+class BatchScenarioGenerator:
+    def __init__(self, llm_client, output_path, store=None, known_scenarios=(), workers=4, max_attempts=3, strict=False,
+                 constrained_mode=CONSTRAINED_OFF, timeout=300.0, on_result=None, similarity_threshold=DEFAULT_THRESHOLD, flag_similar=False):
+        self.llm_client = llm_client
+        self.output_path = output_path
+        self.store = store
+        self.workers = max(1, int(workers))
+        self.max_attempts = max(1, int(max_attempts))
+        self.strict = strict
+        self.constrained_mode = constrained_mode
+        self.timeout = timeout
+        self.on_result = on_result or (lambda task, status, detail: None)
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        self.flag_similar = flag_similar
+        self.similarity_index = ScenarioSimilarityIndex(threshold=similarity_threshold) if similarity_threshold else None
+        self.done_task_ids, previous_scenarios = read_batch_output(output_path)
+        self._fingerprints = set()
+        for scenario in [s for s in known_scenarios if isinstance(s, dict)] + previous_scenarios + (list(store.iter_scenarios()) if store is not None else []):
+            self._fingerprints.add(scenario_fingerprint(scenario))
+            if self.similarity_index is not None and scenario.get("id"): self.similarity_index.add(str(scenario["id"]), scenario)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.counters = {STATUS_ACCEPTED: 0, STATUS_DUPLICATE: 0, STATUS_REJECTED: 0, STATUS_FAILED: 0, "attempts": 0}
+
+    def pending(self, tasks):
+        return [task for task in tasks if task["task_id"] not in self.done_task_ids]
+
+    def _accept(self, task, scenario):
+        # (принят ли, пояснение). Проверка и регистрация сценария — под блокировкой: параллельные задачи не запишут
+        # один и тот же сценарий.
+        fingerprint = scenario_fingerprint(scenario)
+        with self._lock:
+            if fingerprint in self._fingerprints: return False, "точный дубликат"
+            similar = self.similarity_index.query(scenario, limit=3, exclude_id=scenario["id"]) if self.similarity_index is not None else []
+            similar_text = ", ".join(f"{scenario_id} ({similarity:.2f})" for scenario_id, similarity in similar)
+            if similar and not self.flag_similar: return False, f"похож на {similar_text}"
+            if similar: scenario["similar_scenarios"] = [{"id": scenario_id, "similarity": round(similarity, 3)} for scenario_id, similarity in similar]
+            self._fingerprints.add(fingerprint)
+            if self.similarity_index is not None: self.similarity_index.add(scenario["id"], scenario)
+            with open(self.output_path, "a", encoding="utf-8") as f: f.write(json.dumps(scenario, ensure_ascii=False) + "\n")
+            self.done_task_ids.add(task["task_id"])
+        if self.store is not None: self.store.put(scenario, source=os.path.abspath(self.output_path))
+        return True, f"похож на {similar_text}" if similar else ""
+
+    def run_task(self, task):
+        status, detail = STATUS_FAILED, ""
+        for attempt in range(self.max_attempts):
+            if self._stop.is_set(): return task, STATUS_FAILED, "остановлено"
+            with self._lock: self.counters["attempts"] += 1
+            errors = []
+            scenario, _ = generate_scenario(self.llm_client, task["age_range"], task["specialization"], task["gender"], task["difficulty"], user_id="scenario-batch",
+                                            timeout=self.timeout, notify=lambda level, message: errors.append(message) if level == "error" else None,
+                                            constrained_mode=self.constrained_mode)
+            if scenario is None:
+                status, detail = STATUS_FAILED, "; ".join(errors) or "пустой ответ"; continue
+            warnings = check_patient_demographics(scenario, task["age_range"], task["gender"])
+            if warnings and self.strict:
+                status, detail = STATUS_REJECTED, warnings[0]; continue
+            scenario.update({"id": "batch_" + hashlib.sha1(task["task_id"].encode("utf-8")).hexdigest()[:12], "specialization": task["specialization"],
+                             "batch_task_id": task["task_id"], "generation_warnings": warnings})
+            accepted, note = self._accept(task, scenario)
+            detail = scenario.get("true_diagnosis_internal", "") + (f"; {note}" if note else "")
+            if accepted: return task, STATUS_ACCEPTED, detail
+            status = STATUS_DUPLICATE
+        return task, status, detail
+
+    def run(self, tasks):
+        pending = self.pending(tasks)
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scenario-batch")
+        try:
+            futures = [executor.submit(self.run_task, task) for task in pending]
+            for future in as_completed(futures):
+                task, status, detail = future.result()
+                with self._lock: self.counters[status] += 1
+                self.on_result(task, status, detail)
+        except KeyboardInterrupt:
+            self._stop.set(); executor.shutdown(wait=False, cancel_futures=True); raise
+        executor.shutdown()
+        return dict(self.counters, skipped=len(tasks) - len(pending))
+
+
+def _split_choices(value, allowed, default):
+    if not value: return list(default)
+    choices = [v.strip() for v in value.split(",") if v.strip()]
+    unknown = [c for c in choices if c not in allowed]
+    if unknown: raise SystemExit(f"Неизвестные значения: {', '.join(unknown)}. Допустимые: {', '.join(allowed)}")
+    return choices
+
+
+def main():
+    from llm_cache import CachingLLMClient
+    from llm_pool import LLMBackendPool
+    from llm_scheduler import PriorityLLMScheduler
+    from scenario_store import ScenarioStore
+    import telemetry
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Пакетная генерация банка сценариев по сетке параметров.")
+    parser.add_argument("--url", action="append", help="OpenAI-совместимый адрес LLM (можно несколько); по умолчанию KOBOLD_API_URLS / KOBOLD_API_URL")
+    parser.add_argument("--backend-concurrency", type=int, default=int(os.getenv("LLM_BACKEND_MAX_CONCURRENCY", "1")), help="одновременных запросов на узел")
+    parser.add_argument("--workers", type=int, default=4, help="одновременно генерируемых сценариев")
+    parser.add_argument("--specializations", help="через запятую; по умолчанию все")
+    parser.add_argument("--ages", help="возрастные группы через запятую; по умолчанию все")
+    parser.add_argument("--genders", help="через запятую; по умолчанию Мужской,Женский")
+    parser.add_argument("--difficulties", help="через запятую; по умолчанию все")
+    parser.add_argument("--per-cell", type=int, default=1, help="сценариев на комбинацию параметров")
+    parser.add_argument("--limit", type=int, help="не больше стольких задач за запуск")
+    parser.add_argument("--output", default=os.path.join(base_dir, "generated_scenarios", "scenarios.jsonl"), help="JSONL с принятыми сценариями (и прогрессом)")
+    parser.add_argument("--store", default=os.getenv("SCENARIO_INDEX_PATH", os.path.join(base_dir, ".scenario_index", "scenarios.sqlite3")), help="база каталога сценариев")
+    parser.add_argument("--no-store", action="store_true", help="только JSONL, без записи в базу каталога")
+    parser.add_argument("--max-attempts", type=int, default=3, help="попыток на задачу (ошибка разбора, дубликат, отклонение)")
+    parser.add_argument("--similarity-threshold", type=float, default=DEFAULT_THRESHOLD, help="порог сходства почти-дубликатов (0 — проверять только точные)")
+    parser.add_argument("--flag-similar", action="store_true", help="принимать почти-дубликаты с пометкой similar_scenarios вместо повторной генерации")
+    parser.add_argument("--strict", action="store_true", help="отклонять сценарии с несоответствием возраста или пола")
+    parser.add_argument("--constrained-mode", choices=CONSTRAINED_MODES, default=os.getenv("LLM_CONSTRAINED_DECODING", CONSTRAINED_OFF))
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--telemetry-log", help="JSON-лог спанов: stderr или путь к файлу")
+    args = parser.parse_args()
+    telemetry.configure_json_logs(args.telemetry_log)
+
+    tasks = build_generation_grid(_split_choices(args.specializations, MEDICAL_SPECIALIZATIONS, MEDICAL_SPECIALIZATIONS),
+                                  _split_choices(args.ages, list(AGE_RANGES), list(AGE_RANGES)),
+                                  _split_choices(args.genders, GENDERS, [g for g in GENDERS if g != "Любой"]),
+                                  _split_choices(args.difficulties, DIFFICULTY_LEVELS, DIFFICULTY_LEVELS), args.per_cell)
+    base_urls = args.url or [u.strip() for u in os.getenv("KOBOLD_API_URLS", os.getenv("KOBOLD_API_URL", "http://localhost:5002/v1/")).split(",") if u.strip()]
+    pool = LLMBackendPool.from_urls(base_urls, args.backend_concurrency, health_check_interval=0)
+    llm_client = telemetry.InstrumentedLLMClient(CachingLLMClient(PriorityLLMScheduler(pool), None))
+    try: from scenarios_data import SCENARIOS
+    except ImportError: SCENARIOS = []
+    store = None if args.no_store else ScenarioStore(args.store)
+
+    started_at = time.perf_counter(); progress = {"finished": 0}
+    def report(task, status, detail):
+        progress["finished"] += 1
+        print(f"[{progress['finished']}/{total}] {status:9} {task['task_id']}" + (f" — {detail}" if detail else ""), flush=True)
+    generator = BatchScenarioGenerator(llm_client, args.output, store, SCENARIOS, workers=args.workers, max_attempts=args.max_attempts, strict=args.strict,
+                                       constrained_mode=args.constrained_mode, timeout=args.timeout, on_result=report,
+                                       similarity_threshold=args.similarity_threshold, flag_similar=args.flag_similar)
+    pending = generator.pending(tasks)[:args.limit] if args.limit else generator.pending(tasks)
+    total = len(pending)
+    print(f"Задач в сетке: {len(tasks)}, уже готово: {len(tasks) - len(generator.pending(tasks))}, к генерации: {total}; узлов LLM: {len(base_urls)}")
+    try:
+        counters = generator.run(pending)
+    except KeyboardInterrupt:
+        print("Остановлено; повторный запуск продолжит с невыполненных задач."); return
+    elapsed = time.perf_counter() - started_at
+    print(f"Принято: {counters[STATUS_ACCEPTED]}, дубликатов: {counters[STATUS_DUPLICATE]}, отклонено: {counters[STATUS_REJECTED]}, ошибок: {counters[STATUS_FAILED]}; "
+          f"запросов: {counters['attempts']}, {elapsed:.0f} с ({counters[STATUS_ACCEPTED] / elapsed * 3600 if elapsed else 0:.0f} сценариев/ч). Файл: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
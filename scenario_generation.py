@@ -0,0 +1,227 @@
+import json
+import random
+import re
+from datetime import datetime
+
+from constants import AGE_RANGES, DIFFICULTY_LEVELS_DETAILS, MEDICAL_SPECIALIZATIONS
+from json_parsing import TolerantJSONParser, consume_json_stream, extract_and_parse_json
+from llm_grammar import CONSTRAINED_OFF, create_constrained_completion, json_schema_from_defaults, object_schema
+from llm_pool import iter_completion_text
+from llm_scheduler import PRIORITY_GENERATION
+import telemetry
+
+# --- Генерация сценариев с помощью LLM ---
+# Модуль не зависит от Streamlit: генерация может выполняться в фоновом потоке или из пакетного
+# генератора (scenario_batch.py). Шаги доступны по отдельности: промпт генератора
+# (build_generation_messages), приведение ответа к структуре сценария (normalize_scenario,
+# merge_common_mistakes) и проверка возраста и пола пациента (check_patient_demographics).
+
+DEFAULT_MISTAKES = {"empty_dx": {"description": "Диагноз не был поставлен.", "penalty": 5}, "empty_plan": {"description": "План не был предложен.", "penalty": 5}}
+_AGE_IN_INFO_RE = re.compile(r'\b(\d+)\s*(год|года|лет)?\b', re.IGNORECASE)
+
+def _ignore_notice(level, message):
+    pass
+
+def scenario_defaults(difficulty_str="Средний"):
+    # Обязательные поля сценария со значениями по умолчанию; по ним же строится JSON-схема для ограниченной генерации.
+    return {
+        "id": None, "name": "Сгенерированный сценарий (название не указано)", "difficulty_level_tag": difficulty_str,
+        "patient_initial_info_display": "Информация о пациенте отсутствует.",
+        "patient_llm_persona_system_prompt": "Вы пациент. Опишите свои жалобы. Ваше поведение и ответы должны соответствовать заданному уровню сложности.",
+        "initial_patient_greeting": "Здравствуйте, доктор.", "true_diagnosis_internal": "Диагноз не указан.", "true_diagnosis_detailed": "Подробное описание диагноза отсутствует.",
+        "key_anamnesis_points": [], "correct_plan_detailed": "Описание правильного плана отсутствует.",
+        "common_mistakes": [{"id": "empty_dx", "description": "Диагноз не был поставлен.", "penalty": 5}, {"id": "empty_plan", "description": "План не был предложен.", "penalty": 5}],
+        "key_diagnostic_questions_keywords": [], "correct_diagnosis_keywords_for_check": [], "correct_plan_keywords_for_check": [],
+        "available_investigations": {},
+        "physical_exam_findings_prompt_details": { 
+            "temperature": "36.6°C", "blood_pressure": "120/80 мм рт.ст.", "pulse": "70 уд/мин", "spo2": "98%",
+            "auscultation_lungs": "дыхание везикулярное, хрипов нет", "palpation_abdomen": "живот мягкий, безболезненный",
+            "throat_inspection": "зев спокоен, налетов нет",
+            "skin_appearance": "Кожные покровы обычной окраски и влажности, высыпаний нет.",
+            "lymph_nodes": "Периферические лимфоузлы не увеличены, безболезненны.",
+            "thyroid_palpation": "Щитовидная железа не увеличена, мягко-эластической консистенции, безболезненна.",
+            "joints_inspection": "Суставы внешне не изменены, движения в полном объеме.",
+            "neuro_status_brief": "Сознание ясное, ориентирован. Зрачки D=S, фотореакция живая. Речь внятная.",
+            "liver_palpation": "Край печени по краю реберной дуги, безболезненный.",
+            "spleen_palpation": "Селезенка не пальпируется.",
+            "edema_check": "Отеков нет.",
+            "peripheral_pulses": "Пульсация на периферических артериях удовлетворительная, симметричная.",
+            "ear_inspection": "Наружные слуховые проходы свободны, барабанные перепонки серые, опознавательные знаки четкие.",
+            "nose_inspection": "Слизистая носа розовая, влажная, носовые ходы свободны.",
+            "heart_rate": "ЧСС 70 уд/мин, ритмичный." 
+        },
+        "expected_differential_diagnoses": [],
+        "communication_focus_points": [], "dynamic_state_triggers": []
+    }
+
+def scenario_json_schema(difficulty_str="Средний"):
+    # Схема выводится из scenario_defaults; поля с пустыми значениями по умолчанию описаны явно.
+    defaults = scenario_defaults(difficulty_str)
+    string_list = {"type": "array", "items": {"type": "string"}}
+    return json_schema_from_defaults(defaults, overrides={
+        "id": {"type": "string"}, "difficulty_level_tag": {"const": difficulty_str},
+        "common_mistakes": {"type": "array", "items": object_schema({"id": {"type": "string"}, "description": {"type": "string"}, "penalty": {"type": "integer", "minimum": 0, "maximum": 10}})},
+        "available_investigations": {"type": "object", "properties": {}, "additionalProperties": object_schema({
+            "request_keywords": string_list, "results_text": {"type": "string"}, "turn_to_provide_results": {"type": "integer", "minimum": 0, "maximum": 20}})},
+        "physical_exam_findings_prompt_details": dict(json_schema_from_defaults(defaults["physical_exam_findings_prompt_details"]), additionalProperties={"type": "string"}),
+        "dynamic_state_triggers": {"type": "array", "items": object_schema({
+            "condition_type": {"type": "string"}, "key_question_keyword": {"type": "string"}, "turns_to_trigger": {"type": "integer", "minimum": 0, "maximum": 50}, "patient_response_cue": {"type": "string"}})},
+    })
+
+def build_generation_messages(age_range_str=None, specialization_str=None, gender_str=None, difficulty_str=None):
+    # Возвращает (сообщения для LLM, уровень сложности, специализация); "Любая" специализация выбирается случайно.
+    customization_prompt_parts = []
+    if age_range_str and age_range_str != "Любой" and age_range_str in AGE_RANGES:
+        min_a, max_a = AGE_RANGES[age_range_str]; customization_prompt_parts.append(f"Возраст пациента: от {min_a} до {max_a} лет.")
+    elif age_range_str == "Любой": customization_prompt_parts.append("Возраст пациента: любой.")
+    if gender_str and gender_str != "Любой": customization_prompt_parts.append(f"Пол пациента: {gender_str}.")
+    elif gender_str == "Любой": customization_prompt_parts.append("Пол пациента: любой.")
+
+    actual_difficulty_str = difficulty_str if difficulty_str and difficulty_str in DIFFICULTY_LEVELS_DETAILS else "Средний"
+    difficulty_details = DIFFICULTY_LEVELS_DETAILS[actual_difficulty_str]
+    patient_persona_modifier_prompt = difficulty_details['patient_persona_modifier']
+    customization_prompt_parts.append(f"Уровень сложности: {actual_difficulty_str}. {difficulty_details['description']}")
+
+    actual_specialization_str = specialization_str
+    if not specialization_str or specialization_str == "Любая": actual_specialization_str = random.choice(MEDICAL_SPECIALIZATIONS)
+    customization_prompt_parts.append(f"Медицинская область: {actual_specialization_str}.")
+
+    customization_instructions_str = f"ОСОБЫЕ ТРЕБОВАНИЯ К СЦЕНАРИЮ: {' '.join(customization_prompt_parts)}"
+    system_prompt_for_generator = "Ты — эксперт по созданию детализированных медицинских обучающих симуляций. Твоя задача — сгенерировать полный сценарий для платформы 'Виртуальный Пациент'. Предоставь ответ СТРОГО в формате JSON. Не добавляй никакого другого текста до или после JSON. Убедись, что JSON валиден."
+    user_prompt_for_generator = f"""
+{customization_instructions_str}
+Сценарий должен быть реалистичным и клинически правдоподобным. JSON должен иметь следующую структуру:
+{{
+  "id": "llm_gen_YYYYMMDDHHMMSS",
+  "name": "str: Краткое, интригующее название сценария (например, 'Пациент с болью в груди', 'Загадочный случай кашля'). НАЗВАНИЕ НЕ ДОЛЖНО СОДЕРЖАТЬ ИЛИ НАМЕКАТЬ НА ДИАГНОЗ.",
+  "difficulty_level_tag": "{actual_difficulty_str}",
+  "patient_initial_info_display": "str: Инфо для врача (возраст, пол, краткая основная жалоба). Соответствует параметрам.",
+  "patient_llm_persona_system_prompt": "str: Подробный системный промпт для LLM-пациента, описывающий его личность, предысторию болезни, манеру общения, детали текущего состояния, но НЕ включая общие инструкции по обработке команд осмотра или анализов (они будут добавлены приложением).
+    - Этот промпт должен фокусироваться на уникальных аспектах пациента в данном сценарии.
+    - Например: 'Ты 45-летний мужчина, работаешь строителем. Последние 3 дня тебя беспокоит кашель...'
+    - ДОБАВЬ СЮДА ЭТУ ИНСТРУКЦИЮ ДЛЯ СЕБЯ (LLM-ГЕНЕРАТОРА): '{patient_persona_modifier_prompt}' в описание личности пациента.",
+  "initial_patient_greeting": "str: Первая фраза пациента.",
+  "true_diagnosis_internal": "str: Краткий истинный диагноз (например, 'Острый бронхит').",
+  "true_diagnosis_detailed": "str: Подробное описание истинного диагноза, включая патогенез, ключевые клинические признаки и критерии диагностики.",
+  "key_anamnesis_points": ["list", "of", "str: 5-7 КЛЮЧЕВЫХ моментов, которые врач должен выяснить из анамнеза для постановки диагноза."],
+  "correct_plan_detailed": "str: ПОЛНЫЙ правильный план обследования и лечения, соответствующий диагнозу и стандартам.",
+  "common_mistakes": [
+    {{ "id": "empty_dx", "description": "Диагноз не был поставлен.", "penalty": 5 }},
+    {{ "id": "empty_plan", "description": "План не был предложен.", "penalty": 5 }},
+    {{ "id": "custom_mistake_1", "description": "str: Частая ошибка, специфичная для этого сценария (например, 'Недооценка красного флага X').", "penalty": "int (1-3)"}},
+    {{ "id": "custom_mistake_2", "description": "str: Другая частая ошибка для этого сценария.", "penalty": "int (1-3)"}}
+  ],
+  "key_diagnostic_questions_keywords": ["list", "of", "str: 3-5 групп ключевых слов или фраз, относящихся к важным вопросам для сбора анамнеза (например, 'характер боли', 'когда началось')."],
+  "correct_diagnosis_keywords_for_check": ["list", "of", "str: 2-4 ключевых слова из истинного диагноза для автоматической проверки (например, 'бронхит', 'острый')."],
+  "correct_plan_keywords_for_check": ["list", "of", "str: 3-5 ключевых слов из правильного плана для автоматической проверки (например, 'оак', 'рентген', 'антибиотик')."],
+  "available_investigations": {{
+    "OAK": {{ "request_keywords": ["оак", "общий анализ крови", "клинический анализ крови"], "results_text": "Гемоглобин: 130 г/л, Эритроциты: 4.5х10^12/л, Лейкоциты: 9.5х10^9/л (палочкоядерные 8%, сегментоядерные 60%, лимфоциты 25%, моноциты 7%), СОЭ: 15 мм/ч", "turn_to_provide_results": 1 }},
+    "Биохимия крови (базовая)": {{ "request_keywords": ["биохимия", "бх", "биохимический анализ"], "results_text": "Глюкоза: 5.0 ммоль/л, Креатинин: 80 мкмоль/л, Мочевина: 5.5 ммоль/л, Общий билирубин: 15 мкмоль/л, АЛТ: 25 Ед/л, АСТ: 30 Ед/л", "turn_to_provide_results": 2 }}
+    /* Добавь 1-3 других РЕЛЕВАНТНЫХ для сценария исследования (например, ОАМ, ЭКГ, Рентген ОГК, УЗИ ОБП и т.д.) с их ключевыми словами для запроса, текстом результатов и задержкой предоставления. */
+  }},
+  "physical_exam_findings_prompt_details": {{
+    "temperature": "37.2°C", "blood_pressure": "120/80 мм рт.ст.", "pulse": "78 уд/мин", "respiratory_rate": "16 в мин", "spo2": "98%",
+    "general_condition": "удовлетворительное", "skin_mucous_membranes": "обычной окраски, чистые, влажные",
+    "auscultation_lungs": "дыхание везикулярное, хрипов нет", "palpation_abdomen": "живот мягкий, безболезненный",
+    "throat_inspection": "зев спокоен, миндалины не увеличены"
+    /* Добавь или измени 2-4 других РЕЛЕВАНТНЫХ для сценария параметра физикального осмотра и их значения, которые пациент сообщит при соответствующем действии врача. Убедись, что есть данные для стандартных быстрых действий: температура, АД, SpO2, легкие, живот, горло. Также добавь поля для: 'skin_appearance', 'lymph_nodes', 'thyroid_palpation', 'joints_inspection', 'neuro_status_brief', 'liver_palpation', 'spleen_palpation', 'edema_check', 'peripheral_pulses', 'ear_inspection', 'nose_inspection', 'heart_rate' (может быть синонимом pulse). */
+  }},
+  "expected_differential_diagnoses": ["list", "of", "str: 2-3 наиболее вероятных дифференциальных диагноза для данного случая."],
+  "communication_focus_points": ["list", "of", "str: (Для уровня 'Экспертный' или 'Тяжелый') 1-2 специфические коммуникативные задачи или вызова (например, 'Сообщение плохих новостей', 'Работа с недоверчивым пациентом'). Для 'Легкий' и 'Средний' оставь пустым."],
+  "dynamic_state_triggers": [
+    /* Пример: {{ "condition_type": "missed_key_question", "key_question_keyword": "аллергия", "turns_to_trigger": 5, "patient_response_cue": "Кстати, доктор, я вспомнил, у меня же аллергия на пенициллин!" }} */
+    /* Добавь 0-1 динамический триггер, если это уместно для сценария. */
+  ]
+}}
+Убедись, что ВСЕ поля JSON заполнены правдоподобной и клинически релевантной информацией. `patient_llm_persona_system_prompt` должен быть достаточно подробным, чтобы передать характер пациента и его историю, но БЕЗ общих инструкций по симуляции, так как они добавляются отдельно. Поле `name` НЕ должно раскрывать диагноз.
+"""
+    messages = [{"role": "system", "content": system_prompt_for_generator}, {"role": "user", "content": user_prompt_for_generator}]
+    return messages, actual_difficulty_str, actual_specialization_str
+
+def normalize_scenario(scenario, difficulty_str="Средний", notify=None):
+    # Дополняет отсутствующие поля значениями по умолчанию и исправляет типы; None — если сценарий непригоден.
+    notify = notify or _ignore_notice
+    if not isinstance(scenario, dict): notify("error", "Ответ LLM не является объектом JSON."); return None
+    for key, default_value in scenario_defaults(difficulty_str).items():
+        is_list_default, is_dict_default, is_str_default = isinstance(default_value, list), isinstance(default_value, dict), isinstance(default_value, str)
+        if key not in scenario:
+            if default_value is not None: scenario[key] = default_value; notify("warning", f"Поле '{key}' отсутствовало в генерации LLM, установлено значение по умолчанию.")
+            elif key != "id": notify("error", f"Критическое поле '{key}' отсутствует в генерации LLM. Сценарий не может быть использован."); return None
+        current_val = scenario.get(key)
+        if is_list_default and not isinstance(current_val, list): scenario[key] = default_value; notify("warning", f"Поле '{key}' должно быть списком, исправлено на значение по умолчанию.")
+        elif is_dict_default and not isinstance(current_val, dict): scenario[key] = default_value; notify("warning", f"Поле '{key}' должно быть словарем, исправлено на значение по умолчанию.")
+        elif is_str_default and not isinstance(current_val, str): scenario[key] = str(current_val); notify("warning", f"Поле '{key}' должно быть строкой, преобразовано в строку.")
+    scenario["common_mistakes"] = merge_common_mistakes(scenario.get("common_mistakes", []))
+    return scenario
+
+def merge_common_mistakes(llm_common_mistakes):
+    # Обязательные ошибки (нет диагноза, нет плана) — первыми; ошибки от LLM с уникальными id и строки без id — следом.
+    final_common_mistakes = []; ids_added = set()
+    for m_id_default, m_data_default in DEFAULT_MISTAKES.items():
+        m_llm = next((m for m in llm_common_mistakes if isinstance(m, dict) and m.get("id") == m_id_default), None)
+        if m_llm is not None:
+            try: penalty_val = int(m_llm.get("penalty", m_data_default["penalty"]))
+            except (ValueError, TypeError): penalty_val = m_data_default["penalty"]
+            final_common_mistakes.append({"id": m_id_default, "description": m_llm.get("description", m_data_default["description"]), "penalty": penalty_val})
+        else: final_common_mistakes.append({"id": m_id_default, **m_data_default})
+        ids_added.add(m_id_default)
+    for mistake in llm_common_mistakes:
+        if isinstance(mistake, dict) and mistake.get("id") and mistake.get("id") not in ids_added:
+            try: penalty_val = int(mistake.get("penalty", 1))
+            except (ValueError, TypeError): penalty_val = 1
+            final_common_mistakes.append({"id": mistake["id"], "description": mistake.get("description", "Нет описания ошибки"), "penalty": penalty_val}); ids_added.add(mistake["id"])
+        elif isinstance(mistake, str) and mistake not in [m["description"] for m in final_common_mistakes]:
+            final_common_mistakes.append({"id": f"custom_text_mistake_{len(final_common_mistakes)}", "description": mistake, "penalty": 1})
+    return final_common_mistakes
+
+def check_patient_demographics(scenario, age_range_str=None, gender_str=None):
+    # Список предупреждений о несоответствии возраста и пола в patient_initial_info_display запрошенным.
+    warnings = []; info = scenario.get("patient_initial_info_display")
+    if not isinstance(info, str): return warnings
+    if age_range_str and age_range_str != "Любой" and age_range_str in AGE_RANGES:
+        min_a, max_a = AGE_RANGES[age_range_str]
+        age_match = _AGE_IN_INFO_RE.search(info)
+        if age_match and not (min_a <= int(age_match.group(1)) <= max_a): warnings.append(f"Возраст пациента ({age_match.group(1)}), сгенерированный LLM, не соответствует запрошенному диапазону ({age_range_str}).")
+        elif not age_match: warnings.append(f"Не удалось извлечь возраст из информации о пациенте ('{info}'). Запрошенный диапазон: {age_range_str}.")
+    if gender_str and gender_str != "Любой":
+        info_l = info.lower()
+        gender_terms_male = ["мужск", "мужчин", "мальчик", "пациент "]
+        gender_terms_female = ["женск", "женщин", "девочка", "пациентка"]
+        found_gender = (gender_str == "Мужской" and any(term in info_l for term in gender_terms_male)) or \
+                       (gender_str == "Женский" and any(term in info_l for term in gender_terms_female))
+        if not found_gender and not (gender_str.lower()[:3] in info_l):
+            warnings.append(f"Запрошенный пол ('{gender_str}') может не соответствовать информации о пациенте, сгенерированной LLM ('{info}').")
+    return warnings
+
+@telemetry.traced("scenario_generation")
+def generate_scenario(llm_client, age_range_str=None, specialization_str=None, gender_str=None, difficulty_str=None, user_id=None, timeout=300.0, notify=None, constrained_mode=CONSTRAINED_OFF):
+    # Возвращает (сценарий или None, необработанный ответ LLM); сообщения для пользователя передаются через notify.
+    notify = notify or _ignore_notice
+    notify("info", "Запрос на генерацию нового сценария отправлен LLM. Это может занять некоторое время...")
+    messages_for_scenario_gen, actual_difficulty_str, actual_specialization_str = build_generation_messages(age_range_str, specialization_str, gender_str, difficulty_str)
+    raw_text = ""
+    try:
+        response_stream = create_constrained_completion(
+            llm_client, constrained_mode, scenario_json_schema(actual_difficulty_str), "clinical_scenario", notify,
+            priority=PRIORITY_GENERATION,
+            user_id=user_id,
+            model="local-model", 
+            messages=messages_for_scenario_gen, 
+            max_tokens=8192, 
+            temperature=0.7,
+            timeout=timeout,
+            stream=True
+        )
+        json_parser = TolerantJSONParser()
+        raw_text = consume_json_stream(iter_completion_text(response_stream), json_parser)
+        if not raw_text:
+            notify("error", "LLM не вернул контент для генерации сценария."); return None, raw_text
+        generated_scenario = extract_and_parse_json(raw_text, notify, parser=json_parser)
+        generated_scenario = normalize_scenario(generated_scenario, actual_difficulty_str, notify)
+        if generated_scenario is None: return None, raw_text
+        generated_scenario['id'] = f"llm_gen_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        generated_scenario.setdefault("specialization", actual_specialization_str)
+        for warning in check_patient_demographics(generated_scenario, age_range_str, gender_str): notify("warning", warning)
+        notify("success", "Сценарий успешно сгенерирован LLM!"); return generated_scenario, raw_text
+    except (json.JSONDecodeError, ValueError) as e: notify("error", f"Ошибка парсинга JSON от LLM: {e}"); return None, raw_text
+    except Exception as e: notify("error", f"Произошла общая ошибка при генерации сценария: {e}"); return None, raw_text
@@ -0,0 +1,189 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+# --- Пул заранее сгенерированных сценариев ---
+# Ключ пула: (возрастная группа, пол, специализация, сложность) — те же значения, что
+# выбираются в боковой панели. Фоновый поток пополняет "теплые" ключи (недавно
+# запрошенные или заданные при запуске), когда их запас опускается ниже нижней границы,
+# и только пока LLM простаивает. Выдача сценария — извлечение из очереди без обращения к LLM.
+#
+# Хранилище готовых сценариев сменное: в памяти процесса (по умолчанию) или в файле SQLite,
+# общем для нескольких процессов приложения. С общим хранилищем сценарий, сгенерированный
+# одним процессом, выдается пользователю любого другого, а пополнение ключа захватывается
+# одним процессом на время генерации, чтобы процессы не генерировали одно и то же.
+
+ANY_VALUES = {None, "", "Любой", "Любая"}
+
+
+def make_pool_key(age_range_str=None, gender_str=None, specialization_str=None, difficulty_str=None):
+    return (age_range_str or "Любой", gender_str or "Любой", specialization_str or "Любая", difficulty_str or "Средний")
+
+
+def _key_satisfies(pool_key, requested_key):
+    # Сценарий с конкретным значением подходит для запроса "Любой"/"Любая", но не наоборот.
+    return all(requested in ANY_VALUES or requested == pooled for pooled, requested in zip(pool_key, requested_key))
+
+
+class InMemoryPoolStorage:
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def put(self, pool_key, scenario):
+        with self._lock: self._items.setdefault(pool_key, deque()).append(scenario)
+
+    def pop(self, requested_key):
+        with self._lock:
+            exact_items = self._items.get(requested_key)
+            if exact_items: return exact_items.popleft()
+            for candidate_key, candidate_items in self._items.items():
+                if candidate_items and _key_satisfies(candidate_key, requested_key): return candidate_items.popleft()
+        return None
+
+    def sizes(self):
+        with self._lock: return {k: len(v) for k, v in self._items.items() if v}
+
+    def try_claim(self, pool_key, owner, ttl):
+        return True
+
+    def release_claim(self, pool_key, owner):
+        pass
+
+
+class SQLitePoolStorage:
+    # Общий для процессов пул: сценарий извлекается удалением строки, поэтому два процесса не получат один и тот же.
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pooled_scenarios (id INTEGER PRIMARY KEY AUTOINCREMENT, pool_key TEXT NOT NULL, body TEXT NOT NULL, created_at REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pooled_scenarios_key ON pooled_scenarios (pool_key, id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS refill_claims (pool_key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def put(self, pool_key, scenario):
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO pooled_scenarios (pool_key, body, created_at) VALUES (?, ?, ?)", (json.dumps(pool_key, ensure_ascii=False), json.dumps(scenario, ensure_ascii=False), time.time()))
+
+    def _oldest(self, pool_key):
+        return self._db.execute("SELECT id, body FROM pooled_scenarios WHERE pool_key = ? ORDER BY id LIMIT 1", (pool_key,)).fetchone()
+
+    def pop(self, requested_key):
+        # Выборка по индексу (pool_key, id); для запроса с "Любой"/"Любая" перебираются только ключи (DISTINCT по индексу).
+        exact_key = json.dumps(requested_key, ensure_ascii=False)
+        with self._lock:
+            while True:
+                row = self._oldest(exact_key)
+                if row is None and any(value in ANY_VALUES for value in requested_key):
+                    for (candidate_key,) in self._db.execute("SELECT DISTINCT pool_key FROM pooled_scenarios").fetchall():
+                        if candidate_key != exact_key and _key_satisfies(tuple(json.loads(candidate_key)), requested_key):
+                            row = self._oldest(candidate_key)
+                            if row is not None: break
+                if row is None: return None
+                with self._db: taken = self._db.execute("DELETE FROM pooled_scenarios WHERE id = ?", (row[0],)).rowcount
+                if taken: return json.loads(row[1])
+                # Сценарий только что забрал другой процесс — выбираем снова.
+
+    def sizes(self):
+        with self._lock:
+            return {tuple(json.loads(k)): n for k, n in self._db.execute("SELECT pool_key, COUNT(*) FROM pooled_scenarios GROUP BY pool_key")}
+
+    def try_claim(self, pool_key, owner, ttl):
+        # Захват пополнения ключа; просроченный захват (процесс упал во время генерации) переходит к другому.
+        key = json.dumps(pool_key, ensure_ascii=False); now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO refill_claims (pool_key, owner, expires_at) VALUES (?, ?, ?) "
+                             "ON CONFLICT(pool_key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                             "WHERE refill_claims.owner = excluded.owner OR refill_claims.expires_at < ?", (key, owner, now + ttl, now))
+            return self._db.execute("SELECT owner FROM refill_claims WHERE pool_key = ?", (key,)).fetchone()[0] == owner
+
+    def release_claim(self, pool_key, owner):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM refill_claims WHERE pool_key = ? AND owner = ?", (json.dumps(pool_key, ensure_ascii=False), owner))
+
+
+class ScenarioPool:
+    def __init__(self, generate_fn, target_size=2, low_watermark=1, max_warm_keys=16, idle_check=None, poll_interval=5.0, storage=None, claim_ttl=600.0):
+        # generate_fn(pool_key) -> проверенный сценарий (dict) или None
+        self.generate_fn = generate_fn
+        self.target_size = max(1, int(target_size))
+        self.low_watermark = max(0, min(int(low_watermark), self.target_size))
+        self.max_warm_keys = max(1, int(max_warm_keys))
+        self.idle_check = idle_check or (lambda: True)
+        self.poll_interval = poll_interval
+        self.storage = storage or InMemoryPoolStorage()
+        self.claim_ttl = claim_ttl
+        self._owner = f"{os.getpid()}-{id(self):x}"
+        self._warm_keys = OrderedDict()
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._worker = None
+        self._counters = {"hits": 0, "misses": 0, "generated": 0, "generation_failures": 0}
+
+    def _touch_key(self, pool_key):
+        self._warm_keys[pool_key] = time.time(); self._warm_keys.move_to_end(pool_key)
+        while len(self._warm_keys) > self.max_warm_keys:
+            evicted_key, _ = self._warm_keys.popitem(last=False); self._refilling.discard(evicted_key)
+
+    def warm(self, pool_key):
+        with self._lock: self._touch_key(pool_key)
+        self._wakeup.set()
+
+    def pop(self, pool_key):
+        with self._lock: self._touch_key(pool_key)
+        scenario = self.storage.pop(pool_key)
+        with self._lock: self._counters["hits" if scenario is not None else "misses"] += 1
+        self._wakeup.set()
+        return scenario
+
+    def put(self, pool_key, scenario):
+        self.storage.put(pool_key, scenario)
+
+    def _next_key_to_refill(self):
+        sizes = self.storage.sizes()
+        with self._lock:
+            for pool_key in reversed(self._warm_keys):
+                size = sizes.get(pool_key, 0)
+                if size < self.low_watermark: self._refilling.add(pool_key)
+                if pool_key in self._refilling:
+                    if size < self.target_size: return pool_key
+                    self._refilling.discard(pool_key)
+        return None
+
+    def _worker_loop(self):
+        while not self._stop_event.is_set():
+            pool_key = self._next_key_to_refill()
+            if pool_key is None or not self.idle_check() or not self.storage.try_claim(pool_key, self._owner, self.claim_ttl):
+                self._wakeup.wait(self.poll_interval); self._wakeup.clear(); continue
+            try: scenario = self.generate_fn(pool_key)
+            except Exception: scenario = None
+            finally: self.storage.release_claim(pool_key, self._owner)
+            if scenario is None:
+                with self._lock: self._counters["generation_failures"] += 1
+                self._stop_event.wait(self.poll_interval)
+                continue
+            self.put(pool_key, scenario)
+            with self._lock: self._counters["generated"] += 1
+
+    def start(self):
+        if self._worker is not None: return
+        self._worker = threading.Thread(target=self._worker_loop, name="scenario-pool-refill", daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        self._stop_event.set(); self._wakeup.set()
+
+    def stats(self):
+        sizes = self.storage.sizes()
+        with self._lock:
+            per_key = {" / ".join(k): n for k, n in sizes.items()}
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {"size": sum(per_key.values()), "per_key": per_key, "warm_keys": len(self._warm_keys), **self._counters,
+                    "hit_rate": self._counters["hits"] / lookups if lookups else 0.0}
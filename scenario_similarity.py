@@ -0,0 +1,199 @@
+import argparse
+import threading
+import zlib
+
+import numpy as np
+
+from keyword_matcher import split_words, stem_word
+
+# --- Поиск похожих сценариев (MinHash + LSH) ---
+# Сценарий описывается двумя множествами основ слов: диагноза (true_diagnosis_internal) и текста
+# (вводная о пациенте и промпт пациента). Для каждого строится подпись MinHash — минимумы хэш-функций
+# по множеству, доля совпавших минимумов оценивает коэффициент Жаккара. Сходство сценариев —
+# взвешенная сумма сходства диагнозов (DIAGNOSIS_SHARE) и текстов: один и тот же «учебный» диагноз
+# с похожей подачей близок, разные диагнозы с общими словами жалоб — нет.
+# Подпись разбита на полосы (диагноз — по 2 значения, текст — по 4); сценарии с совпавшей полосой
+# становятся кандидатами (LSH), поэтому проверка нового сценария сравнивает его только с кандидатами,
+# а не со всем банком, и поиск групп дубликатов обходится без перебора всех пар. Сценарий с тем же
+# диагнозом всегда попадает в кандидаты, с половиной общих слов диагноза — с вероятностью ~0.99.
+# Полосы рассчитаны на порог около DEFAULT_THRESHOLD: при меньшем пороге похожие сценарии без общей
+# полосы были бы пропущены, поэтому запрос с таким порогом сравнивает подпись со всеми сценариями.
+# Поиск групп всегда идет по корзинам LSH.
+
+DIAGNOSIS_FIELD = "true_diagnosis_internal"
+TEXT_FIELDS = ("patient_initial_info_display", "patient_llm_persona_system_prompt")
+DIAGNOSIS_SHARE = 0.6
+DEFAULT_THRESHOLD = 0.55
+_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+
+
+def _stems(text):
+    return {stem_word(w) for w in split_words(str(text or "")) if len(w) > 2}
+
+
+def scenario_features(scenario):
+    # (основы диагноза, основы текста); без диагноза сценарий сравнивается только по тексту.
+    text_stems = set()
+    for field in TEXT_FIELDS: text_stems |= _stems(scenario.get(field))
+    return _stems(scenario.get(DIAGNOSIS_FIELD)) or text_stems, text_stems
+
+
+class ScenarioSimilarityIndex:
+    def __init__(self, threshold=DEFAULT_THRESHOLD, diagnosis_perm=32, text_perm=96, diagnosis_rows=2, text_rows=4, diagnosis_share=DIAGNOSIS_SHARE, seed=1):
+        if diagnosis_perm % diagnosis_rows or text_perm % text_rows: raise ValueError("diagnosis_perm и text_perm должны делиться на число строк полосы")
+        self.threshold = threshold
+        self.diagnosis_perm = diagnosis_perm
+        self._band_bounds = [(i, i + diagnosis_rows) for i in range(0, diagnosis_perm, diagnosis_rows)] + \
+                            [(i, i + text_rows) for i in range(diagnosis_perm, diagnosis_perm + text_perm, text_rows)]
+        self.bands = len(self._band_bounds)
+        self.diagnosis_share = diagnosis_share
+        generator = np.random.RandomState(seed)
+        self._a = [generator.randint(1, 1 << 31, size=n).astype(np.uint64) for n in (diagnosis_perm, text_perm)]
+        self._b = [generator.randint(0, 1 << 31, size=n).astype(np.uint64) for n in (diagnosis_perm, text_perm)]
+        self._signatures = {}  # id -> подпись (uint32[diagnosis_perm + text_perm])
+        self._matrix = None  # (ids, подписи всех сценариев) для полного сравнения; сбрасывается при изменении
+        self._names = {}
+        self._buckets = [{} for _ in range(self.bands)]  # полоса -> {байты полосы: set(id)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def _minhash(self, features, part):
+        if not features: return np.full(len(self._a[part]), 0xFFFFFFFF, dtype=np.uint32)
+        hashes = np.array([zlib.crc32(f.encode("utf-8")) for f in features], dtype=np.uint64)
+        # (a·h + b) mod p для всех хэш-функций сразу; переполнение uint64 допустимо — это тоже хэш.
+        return (((np.outer(self._a[part], hashes) + self._b[part][:, None]) % _PRIME) & _MAX_HASH).min(axis=1).astype(np.uint32)
+
+    def signature(self, scenario):
+        diagnosis_stems, text_stems = scenario_features(scenario)
+        if not diagnosis_stems and not text_stems: return None
+        return np.concatenate([self._minhash(diagnosis_stems, 0), self._minhash(text_stems, 1)])
+
+    def _pairwise_similarity(self, signatures):
+        matches = signatures[:, None, :] == signatures[None, :, :]
+        return self.diagnosis_share * matches[:, :, :self.diagnosis_perm].mean(axis=2) + (1 - self.diagnosis_share) * matches[:, :, self.diagnosis_perm:].mean(axis=2)
+
+    def similarity(self, first_signature, second_signature):
+        matches = first_signature == second_signature
+        return float(self.diagnosis_share * matches[:self.diagnosis_perm].mean() + (1 - self.diagnosis_share) * matches[self.diagnosis_perm:].mean())
+
+    def _band_keys(self, signature):
+        return [signature[start:end].tobytes() for start, end in self._band_bounds]
+
+    def add(self, scenario_id, scenario, signature=None):
+        signature = self.signature(scenario) if signature is None else signature
+        with self._lock:
+            self._remove(scenario_id)
+            if signature is None: return
+            self._signatures[scenario_id] = signature; self._matrix = None
+            self._names[scenario_id] = (str(scenario.get("name") or ""), str(scenario.get(DIAGNOSIS_FIELD) or ""))
+            for band, key in zip(self._buckets, self._band_keys(signature)): band.setdefault(key, set()).add(scenario_id)
+
+    def _remove(self, scenario_id):
+        signature = self._signatures.pop(scenario_id, None)
+        if signature is None: return
+        self._names.pop(scenario_id, None); self._matrix = None
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            ids = band.get(key)
+            if ids is not None:
+                ids.discard(scenario_id)
+                if not ids: del band[key]
+
+    def remove(self, scenario_id):
+        with self._lock: self._remove(scenario_id)
+
+    def _all_similarities(self, signature):
+        if self._matrix is None: self._matrix = (list(self._signatures), np.stack(list(self._signatures.values())))
+        ids, signatures = self._matrix
+        matches = signatures == signature
+        scores = self.diagnosis_share * matches[:, :self.diagnosis_perm].mean(axis=1) + (1 - self.diagnosis_share) * matches[:, self.diagnosis_perm:].mean(axis=1)
+        return zip(ids, scores.tolist())
+
+    def _query_signature(self, signature, threshold, limit, exclude_id):
+        with self._lock:
+            if not self._signatures: return []
+            if threshold < DEFAULT_THRESHOLD:
+                matches = [m for m in self._all_similarities(signature) if m[0] != exclude_id]
+            else:
+                candidates = set()
+                for band, key in zip(self._buckets, self._band_keys(signature)): candidates.update(band.get(key, ()))
+                candidates.discard(exclude_id)
+                matches = [(candidate_id, self.similarity(self._signatures[candidate_id], signature)) for candidate_id in candidates]
+        matches = sorted((m for m in matches if m[1] >= threshold), key=lambda m: -m[1])
+        return matches[:limit] if limit else matches
+
+    def query(self, scenario, threshold=None, limit=10, exclude_id=None):
+        # [(id, оценка сходства)] по убыванию сходства, не ниже threshold.
+        signature = self.signature(scenario)
+        if signature is None: return []
+        return self._query_signature(signature, self.threshold if threshold is None else threshold, limit, exclude_id)
+
+    def similar_to(self, scenario_id, threshold=None, limit=10):
+        signature = self._signatures.get(scenario_id)
+        if signature is None: return []
+        return self._query_signature(signature, self.threshold if threshold is None else threshold, limit, scenario_id)
+
+    def describe(self, scenario_id):
+        return self._names.get(scenario_id, ("", ""))
+
+    def near_duplicate_groups(self, threshold=None):
+        # Группы сценариев, связанных сходством не ниже threshold; пары проверяются только внутри общих корзин LSH.
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            parent = {}
+            def find(x):
+                while parent.setdefault(x, x) != x: x = parent[x]
+                return x
+            for band in self._buckets:
+                for ids in band.values():
+                    if len(ids) < 2: continue
+                    ordered = sorted(ids)
+                    similarities = self._pairwise_similarity(np.stack([self._signatures[scenario_id] for scenario_id in ordered]))
+                    for i, j in zip(*np.nonzero(np.triu(similarities >= threshold, k=1))): parent[find(ordered[j])] = find(ordered[i])
+            groups = {}
+            for scenario_id in parent: groups.setdefault(find(scenario_id), set()).add(scenario_id)
+        return sorted((sorted(g) for g in groups.values() if len(g) > 1), key=len, reverse=True)
+
+    def stats(self):
+        with self._lock:
+            return {"scenarios": len(self._signatures), "bands": self.bands, "threshold": self.threshold,
+                    "largest_bucket": max((len(ids) for band in self._buckets for ids in band.values()), default=0)}
+
+
+def build_similarity_index(scenarios, **index_kwargs):
+    index = ScenarioSimilarityIndex(**index_kwargs)
+    for scenario in scenarios:
+        if isinstance(scenario, dict) and scenario.get("id"): index.add(str(scenario["id"]), scenario)
+    return index
+
+
+def main():
+    from scenario_store import ScenarioStore
+    try: from scenarios_data import SCENARIOS
+    except ImportError: SCENARIOS = []
+
+    parser = argparse.ArgumentParser(description="Похожие сценарии и группы почти-дубликатов в каталоге.")
+    parser.add_argument("paths", nargs="*", help="файлы .json/.jsonl или каталоги (в дополнение к scenarios_data.py)")
+    parser.add_argument("--store", help="база каталога сценариев (SCENARIO_INDEX_PATH) вместо путей")
+    parser.add_argument("--similar-to", help="id сценария: вывести похожие на него")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+    store = ScenarioStore(args.store)
+    if not args.store: store.sync(SCENARIOS, args.paths, notify=lambda level, message: print(message))
+    index = build_similarity_index(store.iter_scenarios(), threshold=args.threshold)
+    print(f"Сценариев в индексе: {len(index)}")
+    if args.similar_to:
+        for scenario_id, similarity in index.similar_to(args.similar_to, limit=args.limit):
+            name, diagnosis = index.describe(scenario_id); print(f"{similarity:.2f}  {scenario_id}  {name} — {diagnosis}")
+        return
+    groups = index.near_duplicate_groups()
+    print(f"Групп почти-дубликатов (сходство ≥ {args.threshold:g}): {len(groups)}")
+    for group in groups[:args.limit]:
+        print("; ".join(f"{scenario_id} ({index.describe(scenario_id)[1]})" for scenario_id in group))
+
+
+if __name__ == "__main__":
+    main()
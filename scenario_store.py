@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from keyword_matcher import normalize_text, split_words, stem_word
+
+# --- Каталог готовых сценариев ---
+# Сценарии хранятся в SQLite: в памяти держится только легкий индекс (id, название, сложность,
+# специализация, возраст, пол), полный текст сценария читается из базы при выборе.
+# Источники: список SCENARIOS из scenarios_data.py (для совместимости), файлы .json (сценарий
+# или список сценариев) и .jsonl (сценарий на строку) — по отдельности или каталогом.
+# С файловой базой (db_path) файлы переимпортируются только при изменении размера или времени
+# правки, поэтому запуск с неизменным каталогом не разбирает JSON заново.
+# id уникален во всем каталоге: при синхронизации побеждает первый источник (сначала SCENARIOS, затем
+# файлы по порядку), дубликаты пропускаются с предупреждением, а файл с дубликатами перечитывается
+# при каждом запуске — так выбор версии не зависит от того, какие файлы переимпортированы.
+# Полнотекстовый поиск (FTS5, если доступен) идет по названию, жалобам, специализации и сложности;
+# диагноз в поиск не попадает, чтобы не подсказывать его.
+
+BUILTIN_SOURCE = "builtin"
+BODY_CACHE_ITEMS = 32
+SCENARIO_FILE_EXTENSIONS = (".json", ".jsonl")
+
+_AGE_RE = re.compile(r"(\d{1,3})\s*(год|лет|мес|нед|дн)")
+_FEMALE_TERMS = ["женщин", "девочк", "девушк", "пациентка"]
+_MALE_TERMS = ["мужчин", "мальчик", "юноша", "парень"]
+
+def _ignore_notice(level, message):
+    pass
+
+
+def scenario_metadata(scenario):
+    # Поля индекса; возраст и пол, если не заданы явно, берутся из patient_initial_info_display.
+    info = normalize_text(str(scenario.get("patient_initial_info_display", "")))
+    age = scenario.get("patient_age")
+    if not isinstance(age, int):
+        age_match = _AGE_RE.search(info)
+        age = (int(age_match.group(1)) if age_match.group(2) in ("год", "лет") else 0) if age_match else None
+    gender = scenario.get("patient_gender") or ""
+    if not gender:
+        first_female = min((info.find(t) for t in _FEMALE_TERMS if t in info), default=-1)
+        first_male = min((info.find(t) for t in _MALE_TERMS if t in info), default=-1)
+        if first_female >= 0 and (first_male < 0 or first_female < first_male): gender = "Женский"
+        elif first_male >= 0: gender = "Мужской"
+    return {"id": str(scenario.get("id") or ""), "name": str(scenario.get("name") or "Без названия"),
+            "difficulty": str(scenario.get("difficulty_level_tag") or ""), "specialization": str(scenario.get("specialization") or ""),
+            "age": age, "gender": gender}
+
+def scenario_search_text(scenario):
+    fields = [scenario.get("name"), scenario.get("patient_initial_info_display"), scenario.get("specialization"), scenario.get("difficulty_level_tag")]
+    return normalize_text(" ".join(str(f) for f in fields if f))
+
+def _fallback_scenario_id(scenario):
+    return "scn_" + hashlib.sha1(json.dumps(scenario, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+
+def iter_scenario_files(path):
+    if os.path.isfile(path):
+        yield path; return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            if file_name.lower().endswith(SCENARIO_FILE_EXTENSIONS): yield os.path.join(root, file_name)
+
+def read_scenario_file(path, notify=None):
+    notify = notify or _ignore_notice
+    scenarios = []
+    with open(path, encoding="utf-8") as f:
+        if path.lower().endswith(".jsonl"):
+            for line_number, line in enumerate(f, 1):
+                if not line.strip(): continue
+                try: scenarios.append(json.loads(line))
+                except json.JSONDecodeError as e: notify("warning", f"{path}:{line_number}: пропущена строка с некорректным JSON ({e}).")
+        else:
+            try: data = json.load(f)
+            except json.JSONDecodeError as e: notify("warning", f"{path}: некорректный JSON ({e})."); return []
+            scenarios = data if isinstance(data, list) else [data]
+    return [s for s in scenarios if isinstance(s, dict)]
+
+
+class ScenarioStore:
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        if db_path: os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path or ":memory:", check_same_thread=False)
+        self._lock = threading.Lock()
+        self._bodies = OrderedDict()  # небольшой LRU полных сценариев
+        self._entries = []
+        self._positions = {}  # id -> индекс в _entries
+        self.version = 0  # растет при каждом изменении каталога (sync, put): по нему перестраиваются производные индексы
+        self._db.execute("CREATE TABLE IF NOT EXISTS scenarios (id TEXT PRIMARY KEY, source TEXT NOT NULL, name TEXT, difficulty TEXT, specialization TEXT, age INTEGER, gender TEXT, search_text TEXT NOT NULL, body TEXT NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS scenarios_source ON scenarios (source)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS scenario_sources (path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL)")
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS scenario_search USING fts5(id UNINDEXED, text)")
+            self.full_text_search = True
+        except sqlite3.OperationalError:
+            self.full_text_search = False  # SQLite без FTS5: поиск через LIKE по search_text
+        self._db.commit()
+        self._reload_index()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # --- Наполнение ---
+    def sync(self, builtin_scenarios=None, paths=(), notify=None):
+        # builtin_scenarios — список SCENARIOS; paths — файлы и каталоги со сценариями.
+        notify = notify or _ignore_notice
+        with self._lock:
+            self._delete_source(BUILTIN_SOURCE)
+            synced_sources = {BUILTIN_SOURCE}  # источники, уже пройденные в этой синхронизации (по порядку приоритета)
+            for scenario in builtin_scenarios or []:
+                if isinstance(scenario, dict): self._insert(scenario, BUILTIN_SOURCE, notify=notify, synced_sources=synced_sources)
+            seen_files = set()
+            for path in paths:
+                if not os.path.exists(path): notify("warning", f"Каталог сценариев не найден: {path}"); continue
+                for file_path in iter_scenario_files(path):
+                    file_path = os.path.abspath(file_path); seen_files.add(file_path); synced_sources.add(file_path)
+                    file_stat = os.stat(file_path)
+                    known = self._db.execute("SELECT mtime, size FROM scenario_sources WHERE path = ?", (file_path,)).fetchone()
+                    if known and known[0] == file_stat.st_mtime and known[1] == file_stat.st_size: continue
+                    self._delete_source(file_path)
+                    try: scenarios = read_scenario_file(file_path, notify)
+                    except (OSError, UnicodeDecodeError) as e: notify("warning", f"Не удалось прочитать {file_path}: {e}"); continue
+                    has_duplicates = False
+                    for scenario in scenarios: has_duplicates |= self._insert(scenario, file_path, notify=notify, synced_sources=synced_sources) is None
+                    self._db.execute("INSERT OR REPLACE INTO scenario_sources (path, mtime, size) VALUES (?, ?, ?)",
+                                     (file_path, -1 if has_duplicates else file_stat.st_mtime, file_stat.st_size))
+            for (stale_path,) in self._db.execute("SELECT path FROM scenario_sources").fetchall():
+                if stale_path not in seen_files:
+                    self._delete_source(stale_path); self._db.execute("DELETE FROM scenario_sources WHERE path = ?", (stale_path,))
+            self._db.commit()
+            self._bodies.clear()
+            self._reload_index()
+            self.version += 1
+
+    def put(self, scenario, source="manual"):
+        # Добавление одного сценария (например, из пакетной генерации); id — существующий или производный от содержимого.
+        with self._lock:
+            scenario_id = self._insert(scenario, source, replace=True)
+            self._db.commit()
+            self._bodies.pop(scenario_id, None)
+            entry = dict(scenario_metadata(scenario), id=scenario_id)
+            position = self._positions.get(scenario_id)
+            if position is not None: self._entries[position] = entry
+            else: self._positions[scenario_id] = len(self._entries); self._entries.append(entry)
+            self.version += 1
+        return scenario_id
+
+    def _insert(self, scenario, source, replace=False, notify=None, synced_sources=()):
+        # Без replace сценарий с уже занятым id не записывается (возвращается None). Исключение — id из файла
+        # каталога, который в этой синхронизации еще не пройден (загружен в прошлый раз): файл ниже по приоритету
+        # уступает id и помечается для повторного чтения.
+        meta = scenario_metadata(scenario)
+        scenario_id = meta["id"] or _fallback_scenario_id(scenario)
+        if not replace:
+            existing = self._db.execute("SELECT source FROM scenarios WHERE id = ?", (scenario_id,)).fetchone()
+            if existing is not None and (existing[0] in synced_sources or
+                                         not self._db.execute("UPDATE scenario_sources SET mtime = -1 WHERE path = ?", (existing[0],)).rowcount):
+                (notify or _ignore_notice)("warning", f"{source}: сценарий с id '{scenario_id}' уже загружен из {existing[0]}, дубликат пропущен.")
+                return None
+        search_text = scenario_search_text(scenario)
+        if self.full_text_search:  # строки поиска связаны со сценариями по rowid
+            self._db.execute("DELETE FROM scenario_search WHERE rowid IN (SELECT rowid FROM scenarios WHERE id = ?)", (scenario_id,))
+        cursor = self._db.execute("INSERT OR REPLACE INTO scenarios (id, source, name, difficulty, specialization, age, gender, search_text, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (scenario_id, source, meta["name"], meta["difficulty"], meta["specialization"], meta["age"], meta["gender"], search_text,
+                          json.dumps(dict(scenario, id=scenario_id), ensure_ascii=False)))
+        if self.full_text_search:
+            self._db.execute("INSERT INTO scenario_search (rowid, id, text) VALUES (?, ?, ?)", (cursor.lastrowid, scenario_id, search_text))
+        return scenario_id
+
+    def _delete_source(self, source):
+        if self.full_text_search:
+            self._db.execute("DELETE FROM scenario_search WHERE rowid IN (SELECT rowid FROM scenarios WHERE source = ?)", (source,))
+        self._db.execute("DELETE FROM scenarios WHERE source = ?", (source,))
+
+    def _reload_index(self):
+        columns = ["id", "name", "difficulty", "specialization", "age", "gender"]
+        self._entries = [dict(zip(columns, row)) for row in self._db.execute(f"SELECT {', '.join(columns)} FROM scenarios ORDER BY rowid")]
+        self._positions = {entry["id"]: i for i, entry in enumerate(self._entries)}
+
+    # --- Выборка ---
+    def entries(self):
+        return list(self._entries)
+
+    def search_ids(self, query):
+        # id сценариев, в тексте которых есть все слова запроса (по основам, с учетом окончаний).
+        stems = [stem_word(w) for w in split_words(query or "")]
+        if not stems: return None
+        with self._lock:
+            if self.full_text_search:
+                fts_query = " ".join(f'"{stem}"*' for stem in stems)
+                rows = self._db.execute("SELECT id FROM scenario_search WHERE scenario_search MATCH ?", (fts_query,)).fetchall()
+            else:
+                rows = self._db.execute("SELECT id FROM scenarios WHERE " + " AND ".join("search_text LIKE ?" for _ in stems),
+                                        [f"%{stem}%" for stem in stems]).fetchall()
+        return {row[0] for row in rows}
+
+    def filter(self, difficulty=None, specialization=None, gender=None, age_range=None, query=None):
+        matching_ids = self.search_ids(query)
+        result = []
+        for entry in self._entries:
+            if difficulty and entry["difficulty"] != difficulty: continue
+            if specialization and entry["specialization"] != specialization: continue
+            if gender and entry["gender"] != gender: continue
+            if age_range and (entry["age"] is None or not age_range[0] <= entry["age"] <= age_range[1]): continue
+            if matching_ids is not None and entry["id"] not in matching_ids: continue
+            result.append(entry)
+        return result
+
+    def get(self, scenario_id):
+        with self._lock:
+            if scenario_id in self._bodies:
+                self._bodies.move_to_end(scenario_id); return json.loads(self._bodies[scenario_id])
+            row = self._db.execute("SELECT body FROM scenarios WHERE id = ?", (scenario_id,)).fetchone()
+            if row is None: return None
+            self._bodies[scenario_id] = row[0]
+            while len(self._bodies) > BODY_CACHE_ITEMS: self._bodies.popitem(last=False)
+            return json.loads(row[0])  # каждый раз новая копия: сессия может менять сценарий
+
+    def iter_scenarios(self, batch_size=200):
+        # Все сценарии базы по порядку добавления, порциями (для пакетной обработки: проверка дубликатов и т. п.).
+        last_rowid = 0
+        while True:
+            with self._lock: rows = self._db.execute("SELECT rowid, body FROM scenarios WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_rowid, batch_size)).fetchall()
+            if not rows: return
+            for last_rowid, body in rows: yield json.loads(body)
+
+    def stats(self):
+        difficulties = {}
+        for entry in self._entries: difficulties[entry["difficulty"]] = difficulties.get(entry["difficulty"], 0) + 1
+        return {"scenarios": len(self._entries), "by_difficulty": difficulties, "cached_bodies": len(self._bodies), "full_text_search": self.full_text_search}
@@ -0,0 +1,203 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# --- Постоянное хранилище сессий ---
+# Сессии (сценарий, время, консультации, итог оценки), реплики диалога, консультации и
+# результаты оценки сохраняются в SQLite (режим WAL: чтение не ждет записи). Запись идет
+# через очередь в фоновом потоке пачками в одной транзакции, поэтому отрисовка страницы не
+# ждет диска. Чтение истории — индексированными запросами по страницам.
+#
+# SessionStore описывает интерфейс; SQLiteSessionStore — локальная реализация. Другое
+# хранилище (например, сервер БД для нескольких процессов) реализует те же методы.
+
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 0.5  # секунд между сбросами очереди на диск
+
+SESSION_STARTED = "started"
+SESSION_SUBMITTED = "submitted"
+SESSION_EVALUATED = "evaluated"
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, learner_id TEXT NOT NULL, scenario_id TEXT, scenario_name TEXT, difficulty TEXT,"
+    " status TEXT NOT NULL, started_at REAL NOT NULL, submitted_at REAL, evaluated_at REAL, time_taken_seconds REAL, time_taken_display TEXT,"
+    " timer_active INTEGER, consultations_used INTEGER, overall_score INTEGER, evaluation_json TEXT)",
+    "CREATE INDEX IF NOT EXISTS sessions_learner ON sessions (learner_id, submitted_at)",
+    "CREATE INDEX IF NOT EXISTS sessions_scenario ON sessions (scenario_id)",
+    "CREATE TABLE IF NOT EXISTS messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL,"
+    " PRIMARY KEY (session_id, seq))",
+    "CREATE TABLE IF NOT EXISTS consultations (session_id TEXT NOT NULL, seq INTEGER NOT NULL, specialist TEXT, request TEXT, response TEXT, created_at REAL NOT NULL,"
+    " PRIMARY KEY (session_id, seq))",
+    "CREATE TABLE IF NOT EXISTS evaluations (job_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, created_at REAL NOT NULL, overall_score INTEGER, result_json TEXT)",
+    "CREATE INDEX IF NOT EXISTS evaluations_session ON evaluations (session_id)",
+    # Баллы по категориям и ошибки сценария в отдельных строках — для аналитики без разбора evaluation_json.
+    "CREATE TABLE IF NOT EXISTS session_scores (session_id TEXT NOT NULL, category TEXT NOT NULL, score INTEGER, PRIMARY KEY (session_id, category))",
+    "CREATE TABLE IF NOT EXISTS session_mistakes (session_id TEXT NOT NULL, mistake_id TEXT NOT NULL, PRIMARY KEY (session_id, mistake_id))",
+    "CREATE INDEX IF NOT EXISTS sessions_evaluated ON sessions (status, evaluated_at)",
+]
+COHORT_SESSION_COLUMNS = ["session_id", "learner_id", "scenario_id", "scenario_name", "difficulty", "submitted_at", "time_taken_seconds",
+                          "timer_active", "consultations_used", "overall_score", "evaluated_at"]
+HISTORY_COLUMNS = ["name", "score", "difficulty", "date", "time_taken", "timer_active", "consultations_used"]
+
+
+class SessionStore:
+    def start_session(self, session_id, learner_id, scenario): raise NotImplementedError
+    def append_messages(self, session_id, first_seq, messages): raise NotImplementedError
+    def append_consultations(self, session_id, first_seq, consultations): raise NotImplementedError
+    def submit_session(self, session_id, time_taken_seconds, time_taken_display, timer_active, consultations_used): raise NotImplementedError
+    def record_evaluation(self, session_id, job_id, result): raise NotImplementedError
+    def count_history(self, learner_id): raise NotImplementedError
+    def list_history(self, learner_id, limit=20, offset=0): raise NotImplementedError
+    def clear_history(self, learner_id): raise NotImplementedError
+    def data_version(self): raise NotImplementedError
+    def cohort_rows(self, after_evaluation=None): raise NotImplementedError
+    def flush(self, timeout=None): pass
+    def close(self): pass
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, db_path, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._counters = {"writes": 0, "batches": 0, "write_errors": 0}
+        self._stopping = threading.Event()
+        writer_db = self._connect()
+        for statement in _SCHEMA: writer_db.execute(statement)
+        writer_db.commit()
+        self._read_db = self._connect()
+        self._read_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_loop, args=(writer_db,), name="session-store-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL"); db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    # --- Запись (асинхронно) ---
+    def _enqueue(self, sql, params):
+        self._queue.put([(sql, params)])
+
+    def _enqueue_group(self, statements):
+        # Группа операторов попадает в одну транзакцию: читатель не увидит ее наполовину.
+        self._queue.put(list(statements))
+
+    def _write_loop(self, db):
+        while not self._stopping.is_set() or not self._queue.empty():
+            try: batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty: continue
+            while len(batch) < self.batch_size:
+                try: batch.append(self._queue.get_nowait())
+                except queue.Empty: break
+            writes = [statement for item in batch if isinstance(item, list) for statement in item]
+            try:
+                with db:
+                    for sql, params in writes: db.execute(sql, params)
+                self._counters["writes"] += len(writes); self._counters["batches"] += 1
+            except sqlite3.Error:
+                self._counters["write_errors"] += 1
+            for item in batch:
+                if isinstance(item, threading.Event): item.set()
+        db.close()
+
+    def start_session(self, session_id, learner_id, scenario):
+        self._enqueue("INSERT OR REPLACE INTO sessions (session_id, learner_id, scenario_id, scenario_name, difficulty, status, started_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (session_id, learner_id, str(scenario.get("id", "")), scenario.get("name", "N/A"), scenario.get("difficulty_level_tag", "N/A"), SESSION_STARTED, time.time()))
+
+    def append_messages(self, session_id, first_seq, messages):
+        now = time.time()
+        for i, message in enumerate(messages):
+            self._enqueue("INSERT OR REPLACE INTO messages (session_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                          (session_id, first_seq + i, message.get("role", ""), str(message.get("content", "")), now))
+
+    def append_consultations(self, session_id, first_seq, consultations):
+        now = time.time()
+        for i, consultation in enumerate(consultations):
+            self._enqueue("INSERT OR REPLACE INTO consultations (session_id, seq, specialist, request, response, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                          (session_id, first_seq + i, consultation.get("specialist"), consultation.get("request"), consultation.get("response"), now))
+
+    def submit_session(self, session_id, time_taken_seconds, time_taken_display, timer_active, consultations_used):
+        self._enqueue("UPDATE sessions SET status = ?, submitted_at = ?, time_taken_seconds = ?, time_taken_display = ?, timer_active = ?, consultations_used = ? WHERE session_id = ?",
+                      (SESSION_SUBMITTED, time.time(), time_taken_seconds, time_taken_display, int(bool(timer_active)), consultations_used, session_id))
+
+    def record_evaluation(self, session_id, job_id, result):
+        # Повторная запись той же задачи оценки ничего не меняет (job_id — ключ).
+        now = time.time(); score = result.get("overall_score") if isinstance(result, dict) else None
+        result_json = json.dumps(result, ensure_ascii=False)
+        statements = [("UPDATE sessions SET status = ?, evaluated_at = ?, overall_score = ?, evaluation_json = ? WHERE session_id = ?",
+                       (SESSION_EVALUATED, now, score, result_json, session_id)),
+                      ("DELETE FROM session_scores WHERE session_id = ?", (session_id,)),
+                      ("DELETE FROM session_mistakes WHERE session_id = ?", (session_id,))]
+        breakdown = result.get("score_breakdown") if isinstance(result, dict) else None
+        for category, category_data in (breakdown or {}).items():
+            if isinstance(category_data, dict):
+                statements.append(("INSERT INTO session_scores (session_id, category, score) VALUES (?, ?, ?)", (session_id, category, category_data.get("score"))))
+        mistake_ids = result.get("identified_scenario_mistakes_ids") if isinstance(result, dict) else None
+        for mistake_id in sorted(set(str(m) for m in mistake_ids or [])):
+            statements.append(("INSERT INTO session_mistakes (session_id, mistake_id) VALUES (?, ?)", (session_id, mistake_id)))
+        # rowid оценок растет с каждой записью — по нему аналитика догружает только новое.
+        statements.append(("INSERT OR REPLACE INTO evaluations (job_id, session_id, created_at, overall_score, result_json) VALUES (?, ?, ?, ?, ?)",
+                           (job_id, session_id, now, score, result_json)))
+        self._enqueue_group(statements)
+
+    def clear_history(self, learner_id):
+        self._enqueue_group([(f"DELETE FROM {table} WHERE session_id IN (SELECT session_id FROM sessions WHERE learner_id = ?)", (learner_id,))
+                             for table in ["messages", "consultations", "evaluations", "session_scores", "session_mistakes"]] +
+                            [("DELETE FROM sessions WHERE learner_id = ?", (learner_id,))])
+
+    def flush(self, timeout=None):
+        # Дождаться записи всего, что поставлено в очередь до вызова.
+        done = threading.Event(); self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self.flush(5); self._stopping.set(); self._writer.join(5)
+        with self._read_lock: self._read_db.close()
+
+    # --- Чтение ---
+    def count_history(self, learner_id):
+        with self._read_lock:
+            return self._read_db.execute("SELECT COUNT(*) FROM sessions WHERE learner_id = ? AND status = ?", (learner_id, SESSION_EVALUATED)).fetchone()[0]
+
+    def list_history(self, learner_id, limit=20, offset=0):
+        # Новые сессии первыми; поля совпадают с прежними записями session_history.
+        with self._read_lock:
+            rows = self._read_db.execute(
+                "SELECT scenario_name, overall_score, difficulty, submitted_at, time_taken_display, timer_active, consultations_used FROM sessions"
+                " WHERE learner_id = ? AND status = ? ORDER BY submitted_at DESC LIMIT ? OFFSET ?", (learner_id, SESSION_EVALUATED, limit, offset)).fetchall()
+        return [dict(zip(HISTORY_COLUMNS, (name, score, difficulty, time.strftime("%Y-%m-%d %H:%M", time.localtime(submitted_at)) if submitted_at else "N/A",
+                                           time_taken or "N/A", bool(timer_active), consultations_used or 0)))
+                for name, score, difficulty, submitted_at, time_taken, timer_active, consultations_used in rows]
+
+    # --- Выборка для аналитики ---
+    def data_version(self):
+        # (число оцененных сессий, последний rowid оценки): меняется при каждой новой или удаленной оценке.
+        with self._read_lock:
+            return tuple(self._read_db.execute("SELECT (SELECT COUNT(*) FROM sessions WHERE status = ?), (SELECT MAX(rowid) FROM evaluations)",
+                                               (SESSION_EVALUATED,)).fetchone())
+
+    def cohort_rows(self, after_evaluation=None):
+        # Оцененные сессии, баллы по категориям и ошибки — списками строк для построения таблиц.
+        # after_evaluation — rowid оценки из data_version: только сессии, оцененные после нее (догрузка новых).
+        condition, params = "s.status = ?", (SESSION_EVALUATED,)
+        if after_evaluation is not None:
+            condition += " AND s.session_id IN (SELECT session_id FROM evaluations WHERE rowid > ?)"; params += (after_evaluation,)
+        with self._read_lock:
+            sessions = self._read_db.execute(f"SELECT {', '.join('s.' + c for c in COHORT_SESSION_COLUMNS)} FROM sessions s WHERE {condition}", params).fetchall()
+            scores = self._read_db.execute(f"SELECT s.session_id, c.category, c.score FROM session_scores c JOIN sessions s ON s.session_id = c.session_id WHERE {condition}", params).fetchall()
+            mistakes = self._read_db.execute(f"SELECT s.session_id, m.mistake_id FROM session_mistakes m JOIN sessions s ON s.session_id = m.session_id WHERE {condition}", params).fetchall()
+        return {"sessions": sessions, "scores": scores, "mistakes": mistakes}
+
+    def get_session_messages(self, session_id):
+        with self._read_lock:
+            rows = self._read_db.execute("SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), **self._counters}
@@ -0,0 +1,395 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Инструментирование ---
+# Спаны (вложенные интервалы с атрибутами) для запросов к LLM, разбора JSON, оценки, генерации
+# сценариев и перезапусков скрипта Streamlit. По завершении спан пишется строкой JSON в логгер
+# virtual_patient.telemetry (если настроен вывод) и попадает в метрики процесса. Метрики
+# (счетчики, гистограммы и показатели, снимаемые в момент запроса) отдаются в текстовом формате
+# Prometheus по HTTP (/metrics) — без внешних зависимостей. Профилировщик cProfile включается по
+# желанию для доли перезапусков скрипта и сохраняет только медленные.
+#
+# При нескольких процессах приложения за балансировщиком каждый процесс с общим каталогом
+# (share) периодически сохраняет туда снимок своих метрик, а /metrics любого процесса отдает
+# сумму счетчиков и гистограмм по свежим снимкам всех процессов; показатели — с меткой worker.
+
+LOGGER_NAME = "virtual_patient.telemetry"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+METRIC_HELP = {
+    "vp_span_duration_seconds": ("histogram", "Длительность спанов по имени и статусу."),
+    "vp_llm_request_duration_seconds": ("histogram", "Полное время запроса к LLM (для потока — до последнего токена)."),
+    "vp_llm_ttft_seconds": ("histogram", "Время до первого токена потокового ответа LLM."),
+    "vp_llm_queue_wait_seconds": ("histogram", "Ожидание в очереди планировщика перед отправкой запроса на узел."),
+    "vp_llm_prompt_tokens": ("histogram", "Токенов в промпте (по данным сервера)."),
+    "vp_llm_completion_tokens": ("histogram", "Токенов в ответе."),
+    "vp_llm_requests_total": ("counter", "Запросы к LLM по классу, источнику ответа (llm/cache) и статусу."),
+    "vp_llm_retries_total": ("counter", "Повторы запроса на другом узле после сбоя."),
+    "vp_llm_backend_failures_total": ("counter", "Сбои узлов LLM."),
+    "vp_llm_rejected_total": ("counter", "Запросы, отклоненные планировщиком (очередь переполнена или истекло ожидание)."),
+    "vp_json_parse_total": ("counter", "Разбор JSON-ответов LLM по статусу."),
+    "vp_json_repairs_total": ("counter", "Примененные ремонты JSON по коду (A–H)."),
+    "vp_streamlit_run_duration_seconds": ("histogram", "Длительность перезапуска скрипта Streamlit по исходу (completed/rerun)."),
+}
+
+_logger = logging.getLogger(LOGGER_NAME)
+_local = threading.local()
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _format_labels(label_key, extra=()):
+    items = list(label_key) + list(extra)
+    if not items: return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items) + "}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # имя -> {метки: значение}
+        self._histograms = {}  # имя -> {метки: [счетчики корзин, сумма, число]}
+        self._buckets = {}
+        self._collectors = []
+        self.shared_dir = None
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.share_interval = 15.0
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            series = self._counters.setdefault(name, {}); key = _label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        if value is None: return
+        with self._lock:
+            bounds = self._buckets.setdefault(name, tuple(buckets))
+            series = self._histograms.setdefault(name, {}); key = _label_key(labels)
+            state = series.get(key)
+            if state is None: state = series[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                if value <= bound: state[0][i] += 1
+            state[1] += value; state[2] += 1
+
+    def register_collector(self, collect_fn):
+        # collect_fn() -> [(имя, {метки}, значение)]: показатели, снимаемые в момент запроса /metrics.
+        with self._lock: self._collectors.append(collect_fn)
+
+    def _snapshot(self):
+        # Состояние процесса в виде, пригодном для JSON: {"counters": {имя: [[метки, значение]]}, "histograms": ..., "gauges": ...}.
+        with self._lock:
+            counters = {name: [[list(map(list, key)), value] for key, value in series.items()] for name, series in self._counters.items()}
+            histograms = {name: {"buckets": list(self._buckets[name]), "series": [[list(map(list, key)), list(state[0]), state[1], state[2]] for key, state in series.items()]}
+                          for name, series in self._histograms.items()}
+            collectors = list(self._collectors)
+        gauges = {}
+        for collect_fn in collectors:
+            try:
+                for name, labels, value in collect_fn(): gauges.setdefault(name, []).append([list(map(list, _label_key(labels))), float(value)])
+            except Exception as e:
+                _logger.warning(json.dumps({"event": "collector_failed", "error": str(e)}, ensure_ascii=False))
+        return {"worker_id": self.worker_id, "counters": counters, "histograms": histograms, "gauges": gauges}
+
+    def share(self, directory, interval=15.0, worker_id=None):
+        # Общий каталог метрик для нескольких процессов: снимок этого процесса — <каталог>/<worker_id>.json.
+        os.makedirs(directory, exist_ok=True)
+        self.shared_dir = directory; self.share_interval = interval
+        if worker_id: self.worker_id = worker_id
+        def _share_loop():
+            while True:
+                self._write_shared_snapshot(); time.sleep(self.share_interval)
+        threading.Thread(target=_share_loop, name="metrics-share", daemon=True).start()
+
+    def _write_shared_snapshot(self, snapshot=None):
+        path = os.path.join(self.shared_dir, f"{self.worker_id}.json"); tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f: json.dump(snapshot or self._snapshot(), f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            _logger.warning(json.dumps({"event": "metrics_share_failed", "error": str(e)}, ensure_ascii=False))
+
+    def _shared_snapshots(self, own_snapshot):
+        # Свежие снимки других процессов; снимок остановленного процесса перестает учитываться через 3 интервала.
+        snapshots = [own_snapshot]; cutoff = time.time() - 3 * self.share_interval
+        for name in os.listdir(self.shared_dir):
+            path = os.path.join(self.shared_dir, name)
+            if not name.endswith(".json") or name == f"{self.worker_id}.json": continue
+            try:
+                if os.path.getmtime(path) < cutoff: continue
+                with open(path, encoding="utf-8") as f: snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render_prometheus(self):
+        snapshot = self._snapshot()
+        if self.shared_dir is None: snapshots = [snapshot]
+        else:
+            self._write_shared_snapshot(snapshot); snapshots = self._shared_snapshots(snapshot)
+        counters = {}; histograms = {}; buckets = {}; gauges = {}
+        for snap in snapshots:
+            for name, series in snap.get("counters", {}).items():
+                merged = counters.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(map(tuple, key)); merged[key] = merged.get(key, 0) + value
+            for name, hist in snap.get("histograms", {}).items():
+                bounds = buckets.setdefault(name, tuple(hist["buckets"]))
+                if tuple(hist["buckets"]) != bounds: continue  # другая версия приложения с другими корзинами
+                merged = histograms.setdefault(name, {})
+                for key, bucket_counts, total, count in hist["series"]:
+                    state = merged.setdefault(tuple(map(tuple, key)), [[0] * len(bounds), 0.0, 0])
+                    state[0] = [a + b for a, b in zip(state[0], bucket_counts)]; state[1] += total; state[2] += count
+            for name, series in snap.get("gauges", {}).items():
+                worker_label = [("worker", snap.get("worker_id", ""))] if self.shared_dir is not None else []
+                gauges.setdefault(name, []).extend((tuple(map(tuple, key)), worker_label, value) for key, value in series)
+        lines = []
+        for name, series in sorted(counters.items()):
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, ('', name))[1]}", f"# TYPE {name} counter"]
+            lines += [f"{name}{_format_labels(key)} {value}" for key, value in sorted(series.items())]
+        for name, series in sorted(histograms.items()):
+            bounds = buckets[name]
+            lines += [f"# HELP {name} {METRIC_HELP.get(name, ('', name))[1]}", f"# TYPE {name} histogram"]
+            for key, (bucket_counts, total, count) in sorted(series.items()):
+                lines += [f"{name}_bucket{_format_labels(key, [('le', bound)])} {n}" for bound, n in zip(bounds, bucket_counts)]
+                lines += [f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}", f"{name}_sum{_format_labels(key)} {total}", f"{name}_count{_format_labels(key)} {count}"]
+        for name, series in sorted(gauges.items()):
+            lines += [f"# TYPE {name} gauge"] + [f"{name}{_format_labels(key, worker_label)} {float(value)}" for key, worker_label, value in series]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+# --- Спаны ---
+class Span:
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = {k: v for k, v in attributes.items() if v is not None}
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.duration_s = None
+
+    def set(self, **attributes):
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+        return self
+
+    def add(self, name, value=1):
+        self.attributes[name] = self.attributes.get(name, 0) + value
+        return self
+
+    def activate(self):
+        # Делает спан текущим в потоке (для вложенных спанов и атрибутов от нижних слоев), не завершая его.
+        return _Activation(self)
+
+    def end(self, error=None, status=None):
+        if self.duration_s is not None: return self  # повторное завершение (например, поток закрыт дважды)
+        self.duration_s = time.perf_counter() - self._started
+        self.attributes["status"] = status or ("error" if error is not None else self.attributes.get("status", "ok"))
+        if error is not None: self.attributes["error"] = f"{type(error).__name__}: {error}"
+        metrics.observe("vp_span_duration_seconds", self.duration_s, span=self.name, status=self.attributes["status"])
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info(json.dumps({"ts": self.started_at, "span": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                                     "duration_s": round(self.duration_s, 4), **self.attributes}, ensure_ascii=False, default=str))
+        return self
+
+
+class _NoopSpan:
+    def set(self, **attributes): return self
+    def add(self, name, value=1): return self
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Activation:
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        _stack().append(self.span); return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        stack = _stack()
+        if stack and stack[-1] is self.span: stack.pop()
+        return False
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None: stack = _local.stack = []
+    return stack
+
+
+def current_span():
+    stack = _stack()
+    return stack[-1] if stack else _NOOP_SPAN
+
+
+def start_span(name, **attributes):
+    stack = _stack()
+    return Span(name, stack[-1] if stack else None, **attributes)
+
+
+class span:
+    # with telemetry.span("json_parse", source="evaluation") as s: ... s.set(repairs="A,B")
+    def __init__(self, name, **attributes):
+        self.name = name; self.attributes = attributes; self.span = None
+
+    def __enter__(self):
+        self.span = start_span(self.name, **self.attributes); _stack().append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        stack = _stack()
+        if stack and stack[-1] is self.span: stack.pop()
+        self.span.end(error=exc)
+        return False
+
+
+def traced(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name): return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Запросы к LLM ---
+class InstrumentedLLMClient:
+    # Внешняя обертка клиента LLM: спан llm_request на каждый запрос (класс приоритета, узел, ожидание
+    # в очереди, токены, время до первого токена, повторы), метрики по ним. Атрибуты stats, pool и т. п.
+    # берутся у обернутого клиента.
+    def __init__(self, llm_client):
+        self.llm_client = llm_client
+
+    def __getattr__(self, name):
+        return getattr(self.llm_client, name)
+
+    def create_chat_completion(self, **kwargs):
+        request_span = start_span("llm_request", priority=kwargs.get("priority"), stream=bool(kwargs.get("stream")), max_tokens=kwargs.get("max_tokens"),
+                                  user_id=kwargs.get("user_id"))
+        try:
+            with request_span.activate(): response = self.llm_client.create_chat_completion(**kwargs)
+        except Exception as e:
+            self._finish(request_span, error=e); raise
+        if kwargs.get("stream"): return self._instrumented_stream(request_span, response)
+        usage = getattr(response, "usage", None)
+        request_span.set(source="cache" if getattr(response, "cached", False) else "llm",
+                         prompt_tokens=getattr(usage, "prompt_tokens", None), completion_tokens=getattr(usage, "completion_tokens", None))
+        self._finish(request_span)
+        return response
+
+    def _instrumented_stream(self, request_span, stream):
+        chunks = 0; error = None; source = "llm"
+        try:
+            for chunk in stream:
+                if getattr(chunk, "cached", False): source = "cache"
+                usage = getattr(chunk, "usage", None)
+                if usage is not None and getattr(usage, "completion_tokens", None):
+                    request_span.set(prompt_tokens=getattr(usage, "prompt_tokens", None), completion_tokens=usage.completion_tokens)
+                if chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+                    if chunks == 0: request_span.set(ttft_s=round(time.perf_counter() - request_span._started, 4))
+                    chunks += 1
+                yield chunk
+        except GeneratorExit:
+            raise  # потребитель закрыл поток сам (например, JSON уже получен) — это не ошибка
+        except Exception as e:
+            error = e; raise
+        finally:
+            close_stream = getattr(stream, "close", None)
+            if close_stream: close_stream()
+            request_span.set(source=source, chunks=chunks)
+            if "completion_tokens" not in request_span.attributes: request_span.set(completion_tokens=chunks)
+            self._finish(request_span, error=error)
+
+    @staticmethod
+    def _finish(request_span, error=None):
+        request_span.end(error=error)
+        attributes = request_span.attributes; priority = attributes.get("priority", "unknown")
+        metrics.inc("vp_llm_requests_total", priority=priority, source=attributes.get("source", "llm"), status=attributes["status"])
+        if attributes.get("source") == "cache": return
+        metrics.observe("vp_llm_request_duration_seconds", request_span.duration_s, priority=priority)
+        metrics.observe("vp_llm_ttft_seconds", attributes.get("ttft_s"), priority=priority)
+        metrics.observe("vp_llm_prompt_tokens", attributes.get("prompt_tokens"), buckets=TOKEN_BUCKETS, priority=priority)
+        metrics.observe("vp_llm_completion_tokens", attributes.get("completion_tokens"), buckets=TOKEN_BUCKETS, priority=priority)
+
+
+# --- Перезапуски скрипта Streamlit и профилировщик ---
+class ScriptRunTracker:
+    # Спан перезапуска скрипта: начинается в начале app.py, завершается в конце скрипта или перед st.rerun().
+    # С profile_dir доля sample_rate перезапусков профилируется; профиль сохраняется, если перезапуск длился
+    # не меньше min_seconds (файлы .prof открываются через snakeviz или pstats).
+    def __init__(self, profile_dir=None, sample_rate=0.0, min_seconds=0.0):
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.min_seconds = min_seconds
+        self._random = __import__("random").Random()
+        if profile_dir: os.makedirs(profile_dir, exist_ok=True)
+
+    def start(self, **attributes):
+        run_span = Span("streamlit_run", **attributes); run_span.profiler = None
+        _local.stack = [run_span]  # корень трассы в потоке скрипта; спан прерванного исключением прогона отбрасывается
+        if self.profile_dir and self._random.random() < self.sample_rate:
+            profiler = cProfile.Profile()
+            try: profiler.enable(); run_span.profiler = profiler
+            except ValueError: pass  # профилировщик уже активен в этом потоке
+        return run_span
+
+    def finish(self, run_span, outcome="completed"):
+        if run_span is None or run_span.duration_s is not None: return
+        if run_span.profiler is not None: run_span.profiler.disable()
+        if run_span in _stack(): _stack().remove(run_span)
+        run_span.end(status=outcome)
+        metrics.observe("vp_streamlit_run_duration_seconds", run_span.duration_s, outcome=outcome)
+        if run_span.profiler is not None and run_span.duration_s >= self.min_seconds:
+            profile_path = os.path.join(self.profile_dir, f"run-{time.strftime('%Y%m%d-%H%M%S')}-{run_span.span_id}.prof")
+            try: run_span.profiler.dump_stats(profile_path); run_span.set(profile=profile_path)
+            except OSError: pass
+        run_span.profiler = None
+
+
+# --- Вывод ---
+class _JSONLineFormatter(logging.Formatter):
+    def format(self, record):
+        return record.getMessage()
+
+
+def configure_json_logs(destination):
+    # destination: "stderr", "stdout" или путь к файлу; каждая строка — JSON одного спана.
+    if not destination or getattr(_logger, "_configured_destination", None) == destination: return
+    handler = logging.StreamHandler(sys.stdout if destination == "stdout" else sys.stderr) if destination in ("stdout", "stderr") else logging.FileHandler(destination, encoding="utf-8")
+    handler.setFormatter(_JSONLineFormatter())
+    _logger.addHandler(handler); _logger.setLevel(logging.INFO); _logger.propagate = False
+    _logger._configured_destination = destination
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0].rstrip("/") not in ("/metrics", ""):
+                self.send_response(404); self.end_headers(); return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200); self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler); server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
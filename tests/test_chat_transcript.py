@@ -0,0 +1,26 @@
+from chat_transcript import frozen_message_count, message_blocks, render_message_block
+
+
+def test_frozen_message_count_uses_whole_blocks_only():
+    assert frozen_message_count(0, block_size=20, live_messages=10) == 0
+    assert frozen_message_count(29, block_size=20, live_messages=10) == 0
+    assert frozen_message_count(30, block_size=20, live_messages=10) == 20
+    assert frozen_message_count(49, block_size=20, live_messages=10) == 20
+    assert frozen_message_count(50, block_size=20, live_messages=10) == 40
+
+
+def test_frozen_message_count_keeps_live_messages_and_never_shrinks():
+    previous = 0
+    for message_count in range(200):
+        frozen = frozen_message_count(message_count)
+        assert message_count - frozen >= min(message_count, 10)
+        assert frozen % 20 == 0 and frozen >= previous
+        previous = frozen
+
+
+def test_message_blocks_and_rendering():
+    messages = [{"role": "user" if i % 2 else "assistant", "content": f"<b>{i}</b>"} for i in range(45)]
+    blocks = message_blocks(messages, 40)
+    assert len(blocks) == 2 and all(len(block) == 20 for block in blocks)
+    html_text = render_message_block(blocks[0])
+    assert "&lt;b&gt;0&lt;/b&gt;" in html_text and "<b>0</b>" not in html_text
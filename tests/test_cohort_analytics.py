@@ -0,0 +1,50 @@
+import pytest
+
+from cohort_analytics import CohortAnalytics
+from session_store import SQLiteSessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), flush_interval=0.01)
+    yield store
+    store.close()
+
+
+def evaluated_session(store, session_id, learner_id, score, job_id=None, mistakes=()):
+    store.start_session(session_id, learner_id, {"id": "sc1", "name": "Сценарий"})
+    store.submit_session(session_id, 600, "10 мин 0 сек", True, 0)
+    store.record_evaluation(session_id, job_id or f"job-{session_id}", {"overall_score": score, "score_breakdown": {"anamnesis_collection": {"score": score}},
+                                                                       "identified_scenario_mistakes_ids": list(mistakes)})
+    store.flush()
+
+
+def test_new_evaluations_are_loaded_incrementally(store):
+    evaluated_session(store, "s1", "alice", 6, mistakes=["m1"])
+    analytics = CohortAnalytics(store)
+    assert analytics.summary()["sessions"] == 1
+    evaluated_session(store, "s2", "bob", 8)
+    summary = analytics.summary()
+    assert summary["sessions"] == 2 and summary["mean_score"] == 7
+    assert analytics.category_distribution().loc["anamnesis_collection", "sessions"] == 2
+    assert analytics.stats()["full_loads"] == 1 and analytics.stats()["incremental_loads"] == 1
+
+
+def test_reevaluated_session_replaces_its_rows(store):
+    evaluated_session(store, "s1", "alice", 6, mistakes=["m1"])
+    analytics = CohortAnalytics(store); analytics.refresh()
+    evaluated_session(store, "s1", "alice", 9, job_id="job-s1-retry")
+    assert analytics.summary(learner_id="alice")["mean_score"] == 9
+    assert analytics.category_distribution().loc["anamnesis_collection", "sessions"] == 1
+    assert analytics.mistake_frequencies().empty
+    assert analytics.stats()["full_loads"] == 1
+
+
+def test_cleared_history_triggers_a_full_reload_and_results_are_cached(store):
+    evaluated_session(store, "s1", "alice", 6)
+    evaluated_session(store, "s2", "bob", 8)
+    analytics = CohortAnalytics(store)
+    assert analytics.summary()["sessions"] == 2 and analytics.summary()["sessions"] == 2
+    assert analytics.stats()["cache_hits"] == 1
+    store.clear_history("alice"); store.flush()
+    assert analytics.summary()["sessions"] == 1 and analytics.stats()["full_loads"] == 2
@@ -0,0 +1,70 @@
+import json
+from types import SimpleNamespace
+
+from evaluation import CATEGORY_TITLES, DEFAULT_ERROR_RESULT, EVALUATION_SHARDED, SCORE_CATEGORIES, evaluate_with_llm
+from scenarios_data import SCENARIOS
+
+
+def chunks(text):
+    for ch in text: yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=ch), finish_reason=None)], usage=None)
+
+
+class FakeEvaluator:
+    def __init__(self, reply): self.reply = reply
+
+    def create_chat_completion(self, **kwargs):
+        return chunks(self.reply)
+
+
+def evaluate(reply, **kwargs):
+    return evaluate_with_llm(FakeEvaluator(reply), SCENARIOS[0], [{"role": "user", "content": "Что беспокоит?"}], "Аппендицит", "Операция", **kwargs)[0]
+
+
+def test_single_mode_reads_the_evaluation():
+    reply = {"overall_score": "7", "score_breakdown": {"anamnesis_collection": {"score": 8, "comments": "ок"}}, "identified_scenario_mistakes_ids": ["m1"]}
+    result = evaluate(json.dumps(reply, ensure_ascii=False))
+    assert result["overall_score"] == 7 and not result.get("evaluation_failed")
+    assert result["score_breakdown"]["anamnesis_collection"] == {"score": 8, "comments": "ок"}
+    assert result["score_breakdown"]["communication_skills"]["score"] is None
+    assert result["identified_scenario_mistakes_ids"] == ["m1"]
+
+
+def test_single_mode_fails_on_json_without_scores():
+    for reply in ['{"answer": "не знаю"}', '{"overall_score": "нет", "score_breakdown": {}}', '{"overall_score": 7, "score_breakdown": []}', '["7"]']:
+        assert evaluate(reply) == DEFAULT_ERROR_RESULT
+
+
+class FakeShardEvaluator:
+    # Оценщик с температурой 0.3 / 0.5 / 0.7 ставит 6 / 8 / 9 по всем категориям части.
+    def __init__(self, failing_shard_title=None): self.failing_shard_title = failing_shard_title
+
+    def create_chat_completion(self, **kwargs):
+        prompt = kwargs["messages"][-1]["content"]
+        if self.failing_shard_title and f"работы врача: {self.failing_shard_title}." in prompt: raise RuntimeError("узел недоступен")
+        score = {0.3: 6, 0.5: 8, 0.7: 9}[round(kwargs["temperature"], 1)]
+        reply = {cat: {"score": score, "comments": f"балл {score}"} for cat in SCORE_CATEGORIES}
+        reply["identified_scenario_mistakes_ids"] = ["m2"] + (["m1"] if score == 6 else [])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(reply)))])
+
+
+def evaluate_sharded(llm_client, consultations_count=0):
+    return evaluate_with_llm(llm_client, SCENARIOS[0], [{"role": "user", "content": "Что беспокоит?"}], "Аппендицит", "Операция",
+                             consultations_count=consultations_count, evaluation_mode=EVALUATION_SHARDED, raters=3)[0]
+
+
+def test_sharded_mode_takes_the_median_of_raters_and_majority_mistakes():
+    result = evaluate_sharded(FakeShardEvaluator())
+    anamnesis = result["score_breakdown"]["anamnesis_collection"]
+    assert anamnesis["score"] == 8 and anamnesis["comments"] == "балл 8" and anamnesis["rater_scores"] == [6, 8, 9]
+    assert result["overall_score"] == 8 and result["identified_scenario_mistakes_ids"] == ["m2"]
+
+
+def test_sharded_overall_score_is_reduced_per_consultation():
+    assert evaluate_sharded(FakeShardEvaluator(), consultations_count=2)["overall_score"] == 7
+    assert evaluate_sharded(FakeShardEvaluator(), consultations_count=30)["overall_score"] == 0
+
+
+def test_failed_shard_leaves_its_categories_unscored():
+    result = evaluate_sharded(FakeShardEvaluator(failing_shard_title=CATEGORY_TITLES["communication_skills"]))
+    assert result["score_breakdown"]["communication_skills"]["score"] is None
+    assert result["overall_score"] == 8 and not result.get("evaluation_failed")
@@ -0,0 +1,38 @@
+import copy
+
+from compiled_scenario import CompiledScenario
+from scenarios_data import SCENARIOS
+from trigger_engine import TriggerEngine, VITALS_DETERIORATION
+
+
+def scenario_with_deterioration():
+    scenario = copy.deepcopy(SCENARIOS[0])
+    scenario["dynamic_state_triggers"] = [{"condition_type": VITALS_DETERIORATION, "turns_to_trigger": 2,
+                                           "vitals_update": {"blood_pressure": "90/60 мм рт.ст.", "Pulse": "120 уд/мин"},
+                                           "modify_system_prompt_add": "Пациенту хуже."}]
+    return scenario
+
+
+def test_exam_command_is_answered_from_scenario_data():
+    responder = CompiledScenario(SCENARIOS[0]).exam_responder
+    reply = responder.respond("Измеряю АД и пульс.")
+    assert SCENARIOS[0]["physical_exam_findings_prompt_details"]["blood_pressure"] in reply
+    assert SCENARIOS[0]["physical_exam_findings_prompt_details"]["pulse"] in reply
+
+
+def test_questions_and_mixed_messages_go_to_the_llm():
+    responder = CompiledScenario(SCENARIOS[0]).exam_responder
+    assert responder.respond("Измеряю АД?") is None
+    assert responder.respond("Измеряю АД, а когда началась боль") is None
+    assert responder.respond("") is None
+
+
+def test_vitals_update_replaces_baseline_values_after_the_trigger_fires():
+    scenario = scenario_with_deterioration()
+    responder, engine = CompiledScenario(scenario).exam_responder, TriggerEngine(scenario)
+    baseline = scenario["physical_exam_findings_prompt_details"]["blood_pressure"]
+    assert baseline in responder.respond("Измеряю АД.", engine.vitals_overrides())
+    assert engine.next_firing(turn=1) is None and engine.vitals_overrides() == {}
+    assert engine.next_firing(turn=2) is not None
+    reply = responder.respond("Измеряю АД и пульс.", engine.vitals_overrides())
+    assert "90/60 мм рт.ст." in reply and "120 уд/мин" in reply and baseline not in reply
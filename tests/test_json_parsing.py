@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from json_parsing import TolerantJSONParser, consume_json_stream, extract_and_parse_json
+
+
+def parse(text):
+    parser = TolerantJSONParser(); parser.feed(text)
+    return parser.finish(), parser.repairs
+
+
+@pytest.mark.parametrize("text, expected, repair", [
+    ('{key": 1}', {"key": 1}, "A"),
+    ('{key: 1}', {"key": 1}, "A"),
+    ('{"a": 1} и еще текст', {"a": 1}, "B"),
+    ('{"a": [1, 2', {"a": [1, 2]}, "C"),
+    ('{"common_mistakes": [{"id": "m1", "текст ошибки"}]}', {"common_mistakes": [{"id": "m1", "description": "текст ошибки"}]}, "D"),
+    ('{"a": [1, 2,], "b": 3,}', {"a": [1, 2], "b": 3}, "E"),
+    ('{"a": 1 "b": 2}', {"a": 1, "b": 2}, "E"),
+    ('{"a": 1, /* комментарий */ "b": 2 // еще\n}', {"a": 1, "b": 2}, "F"),
+    ('{"a": "строка\nс переводом"}', {"a": "строка\nс переводом"}, "G"),
+    ('{"a": True, "b": None, "c": текст}', {"a": True, "b": None, "c": "текст"}, "H"),
+])
+def test_repairs(text, expected, repair):
+    parsed, repairs = parse(text)
+    assert parsed == expected
+    assert repair in repairs
+
+
+def test_valid_json_needs_no_repairs():
+    document = {"overall_score": 7, "score_breakdown": {"anamnesis_collection": {"score": 8, "comments": "ок \"кавычки\""}}, "ids": []}
+    assert parse(json.dumps(document, ensure_ascii=False)) == (document, [])
+
+
+def test_fenced_block_wins_over_braces_in_prose():
+    assert extract_and_parse_json('Пример {не json}. ```json\n{"a": 1}\n```') == {"a": 1}
+
+
+def test_fenced_block_is_done_without_reading_the_rest():
+    parser = TolerantJSONParser()
+    assert parser.feed('```json\n{"a": 1}')
+    assert parser.finish() == {"a": 1}
+
+
+def test_object_after_prose_waits_for_a_possible_fence():
+    parser = TolerantJSONParser()
+    assert not parser.feed('Вот ответ: {"a": 1}')
+    assert parser.finish() == {"a": 1}
+
+
+def test_braces_in_prose_that_need_repairs_are_skipped():
+    assert extract_and_parse_json('Оценка в формате {score}: {"overall_score": 7}') == {"overall_score": 7}
+    with pytest.raises(ValueError):
+        extract_and_parse_json('Оценка в формате {score}.')
+
+
+def test_stray_slash_fails_instead_of_dropping_data():
+    with pytest.raises(ValueError):
+        extract_and_parse_json('{"a": 1/2}')
+
+
+def test_empty_and_missing_json():
+    with pytest.raises(ValueError): extract_and_parse_json("   ")
+    with pytest.raises(ValueError): extract_and_parse_json("нет json")
+
+
+def test_streaming_matches_single_pass_and_stops_at_the_end_of_the_object():
+    text = '```json\n{"a": {"b": [1, 2, 3]}, "c": "д"}\n```\nпосле блока'
+    parser = TolerantJSONParser()
+    chunks = iter([text[i:i + 3] for i in range(0, len(text), 3)])
+    raw_text = consume_json_stream(chunks, parser)
+    assert "после" not in raw_text
+    assert parser.finish() == extract_and_parse_json(text) == {"a": {"b": [1, 2, 3]}, "c": "д"}
+
+
+def test_partial_does_not_change_the_parser():
+    parser = TolerantJSONParser(); parser.feed('{"a": [1, 2')
+    assert parser.partial() == {"a": [1, 2]}
+    parser.feed(', 3]}')
+    assert parser.finish() == {"a": [1, 2, 3]}
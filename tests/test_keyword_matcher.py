@@ -0,0 +1,35 @@
+from keyword_matcher import KeywordMatcher, split_words, stem_word
+
+
+def test_stem_word_strips_russian_endings():
+    assert stem_word("анализа") == stem_word("анализ") == "анализ"
+    assert stem_word("крови") == "кров"
+    assert stem_word("рентгенографию") == "рентгенограф"
+    assert stem_word("беспокоится") == "беспокоит"
+
+
+def test_stem_word_keeps_short_words():
+    assert stem_word("ад") == "ад"
+    assert stem_word("оак") == "оак"
+
+
+def test_split_words_normalizes_case_and_yo():
+    assert split_words("ЭКГ, Ёлка и  АД!") == ["экг", "елка", "и", "ад"]
+
+
+def test_phrases_match_inflected_words():
+    matcher = KeywordMatcher([("анализ крови", "oak"), ("рентген", "xray"), ("экг", "ecg")])
+    assert matcher.match("Назначаю общий анализ крови и рентгенографию") == {"oak", "xray"}
+    assert matcher.match("Сделаем анализы крови") == {"oak"}
+    assert matcher.match("ЭКГ, пожалуйста") == {"ecg"}
+
+
+def test_short_abbreviations_match_whole_words_only():
+    matcher = KeywordMatcher([("ад", "bp")])
+    assert matcher.match("измеряю АД") == {"bp"}
+    assert matcher.match("адекватно") == set()
+
+
+def test_phrase_words_must_be_consecutive():
+    matcher = KeywordMatcher([("анализ крови", "oak")])
+    assert matcher.match("анализ мочи и крови") == set()
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+from llm_cache import CachingLLMClient, ResponseCache, make_cache_key
+from llm_pool import iter_completion_text
+
+
+def chunks(text, finish_reason="stop"):
+    for i, ch in enumerate(text):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=ch), finish_reason=finish_reason if i == len(text) - 1 else None)], usage=None)
+
+
+class FakeLLM:
+    def __init__(self, finish_reason="stop"): self.calls = 0; self.finish_reason = finish_reason
+
+    def create_chat_completion(self, **kwargs):
+        self.calls += 1
+        if kwargs.get("stream"): return chunks(kwargs["messages"][-1]["content"], self.finish_reason)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=kwargs["messages"][-1]["content"]), finish_reason=self.finish_reason)], usage=None)
+
+
+def request(text, **kwargs):
+    return dict(model="m", messages=[{"role": "user", "content": text}], temperature=0.3, max_tokens=10, **kwargs)
+
+
+def test_cache_key_ignores_unrelated_fields():
+    assert make_cache_key(request("a", user_id="u1", timeout=5)) == make_cache_key(request("a", user_id="u2"))
+    assert make_cache_key(request("a")) != make_cache_key(request("b"))
+
+
+def test_completion_is_served_from_cache():
+    llm = FakeLLM(); client = CachingLLMClient(llm, ResponseCache())
+    client.create_chat_completion(use_cache=True, **request("ответ"))
+    cached = client.create_chat_completion(use_cache=True, **request("ответ"))
+    assert llm.calls == 1 and cached.cached and cached.choices[0].message.content == "ответ"
+
+
+def test_stream_closed_early_is_not_cached():
+    client = CachingLLMClient(FakeLLM(), ResponseCache())
+    text_chunks = iter_completion_text(client.create_chat_completion(use_cache=True, stream=True, **request("длинный ответ")))
+    next(text_chunks); text_chunks.close()
+    assert client.cache.stats()["stores"] == 0
+
+
+def test_stream_closed_early_is_cached_when_confirmed_complete():
+    client = CachingLLMClient(FakeLLM(), ResponseCache())
+    text_chunks = iter_completion_text(client.create_chat_completion(use_cache=True, stream=True, stream_complete=lambda: True, **request("ответ")))
+    assert next(text_chunks) == "о"; text_chunks.close()
+    assert client.cache.get(make_cache_key(dict(request("ответ"), stream=True))) == "о"
+
+
+def test_fully_read_stream_is_cached():
+    client = CachingLLMClient(FakeLLM(), ResponseCache())
+    assert "".join(iter_completion_text(client.create_chat_completion(use_cache=True, stream=True, **request("ответ")))) == "ответ"
+    assert client.cache.stats()["stores"] == 1
+
+
+def test_response_cut_by_max_tokens_is_not_cached():
+    client = CachingLLMClient(FakeLLM(finish_reason="length"), ResponseCache())
+    assert "".join(iter_completion_text(client.create_chat_completion(use_cache=True, stream=True, **request("обрезанный")))) == "обрезанный"
+    client.create_chat_completion(use_cache=True, **request("обрезанный"))
+    assert client.cache.stats()["stores"] == 0
+
+
+def test_disk_size_limit_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), memory_items=0, max_disk_bytes=1000)
+    for i in range(30): cache.put(f"k{i}", "x" * 100)
+    assert cache.stats()["disk_items"] == 10
+    assert cache.get("k29") is not None and cache.get("k0") is None
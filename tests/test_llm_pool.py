@@ -0,0 +1,49 @@
+import gc
+from types import SimpleNamespace
+
+import pytest
+from openai import APIConnectionError
+
+from llm_pool import LLMBackendPool, NoAvailableBackendError, iter_completion_text
+
+
+class FakeBackend:
+    def __init__(self, name, fail=False, max_concurrency=1):
+        self.base_url = name; self.max_concurrency = max_concurrency; self.fail = fail
+        self.outstanding = 0; self.healthy = True; self.consecutive_failures = 0
+        self.total_requests = 0; self.total_failures = 0; self.last_error = None; self.last_checked_at = None
+
+    def create_chat_completion(self, **kwargs):
+        if self.fail: raise APIConnectionError(request=None)
+        text = f"ответ {self.base_url}"
+        if kwargs.get("stream"): return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])])
+        return text
+
+    def check_health(self): pass
+
+
+def outstanding(pool):
+    return [b.outstanding for b in pool.backends]
+
+
+def test_connection_errors_fail_over_to_the_next_backend():
+    pool = LLMBackendPool([FakeBackend("a", fail=True), FakeBackend("b")], failure_threshold=1)
+    assert pool.create_chat_completion(timeout=1) == "ответ b"
+    assert not pool.backends[0].healthy and outstanding(pool) == [0, 0]
+
+
+def test_stream_keeps_the_backend_busy_until_it_is_read():
+    pool = LLMBackendPool([FakeBackend("a")])
+    stream = pool.create_chat_completion(stream=True, timeout=0.01)
+    assert outstanding(pool) == [1]
+    with pytest.raises(NoAvailableBackendError): pool.create_chat_completion(timeout=0.01)
+    assert "".join(iter_completion_text(stream)) == "ответ a" and outstanding(pool) == [0]
+
+
+def test_stream_that_is_never_read_releases_the_backend():
+    pool = LLMBackendPool([FakeBackend("a")])
+    pool.create_chat_completion(stream=True, timeout=1).close()
+    assert outstanding(pool) == [0]
+    stream = pool.create_chat_completion(stream=True, timeout=1)
+    del stream; gc.collect()
+    assert outstanding(pool) == [0]
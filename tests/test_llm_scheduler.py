@@ -0,0 +1,51 @@
+import gc
+import threading
+import time
+
+import pytest
+
+from llm_scheduler import PRIORITY_EVALUATION, PRIORITY_GENERATION, PRIORITY_PATIENT, PriorityLLMScheduler, SchedulerRejectedError
+
+
+class FakePool:
+    def __init__(self, capacity): self.total_capacity = capacity; self.calls = []
+
+    def create_chat_completion(self, **kwargs):
+        self.calls.append(kwargs["messages"])
+        return iter(["ответ"]) if kwargs.get("stream") else "ответ"
+
+
+def in_flight(scheduler):
+    return {priority: data["in_flight"] for priority, data in scheduler.stats()["classes"].items() if data["in_flight"]}
+
+
+def wait_until_queued(scheduler, count):
+    while sum(data["queued"] for data in scheduler.stats()["classes"].values()) < count: time.sleep(0.005)
+
+
+def test_interactive_requests_overtake_queued_batch_requests():
+    pool = FakePool(1); scheduler = PriorityLLMScheduler(pool, reserved_interactive_slots=0)
+    busy = scheduler.create_chat_completion(priority=PRIORITY_EVALUATION, messages="занят", stream=True)
+    threads = [threading.Thread(target=scheduler.create_chat_completion, kwargs={"priority": priority, "messages": priority})
+               for priority in [PRIORITY_EVALUATION, PRIORITY_GENERATION, PRIORITY_PATIENT]]
+    for i, thread in enumerate(threads): thread.start(); wait_until_queued(scheduler, i + 1)
+    busy.close()
+    for thread in threads: thread.join(5)
+    assert pool.calls == ["занят", PRIORITY_PATIENT, PRIORITY_GENERATION, PRIORITY_EVALUATION]
+
+
+def test_reserved_slot_is_kept_for_interactive_requests():
+    scheduler = PriorityLLMScheduler(FakePool(2), reserved_interactive_slots=1, max_queue_wait={PRIORITY_EVALUATION: 0.05})
+    stream = scheduler.create_chat_completion(priority=PRIORITY_EVALUATION, messages="оценка", stream=True)
+    assert not scheduler.has_idle_capacity()
+    with pytest.raises(SchedulerRejectedError): scheduler.create_chat_completion(priority=PRIORITY_EVALUATION, messages="оценка 2")
+    assert scheduler.create_chat_completion(priority=PRIORITY_PATIENT, messages="пациент") == "ответ"
+    assert list(stream) == ["ответ"] and in_flight(scheduler) == {}
+
+
+def test_stream_that_is_never_read_releases_its_slot():
+    scheduler = PriorityLLMScheduler(FakePool(1))
+    stream = scheduler.create_chat_completion(priority=PRIORITY_PATIENT, messages="пациент", stream=True)
+    assert in_flight(scheduler) == {PRIORITY_PATIENT: 1}
+    del stream; gc.collect()
+    assert in_flight(scheduler) == {}
@@ -0,0 +1,31 @@
+from patient_prompt import STATE_MODIFIERS_HEADER, build_patient_messages, make_state_modifier
+from trigger_engine import TRIGGER_MESSAGE_KEY
+
+
+def roles(messages):
+    return [m["role"] for m in messages]
+
+
+def test_trigger_cue_after_the_patient_reply_is_merged_into_one_assistant_turn():
+    dialogue = [{"role": "user", "content": "Что беспокоит?"}, {"role": "assistant", "content": "Живот болит."},
+                {"role": "assistant", "content": "Меня тошнит.", "pinned": True, TRIGGER_MESSAGE_KEY: 0},
+                {"role": "user", "content": "Давно?"}]
+    messages = build_patient_messages("system", dialogue)
+    assert roles(messages) == ["system", "user", "assistant", "user"]
+    assert messages[2]["content"] == "Живот болит.\n\nМеня тошнит."
+
+
+def test_modifier_is_attached_to_the_next_doctor_message_and_keeps_the_prefix():
+    dialogue = [{"role": "user", "content": "Что беспокоит?"}, {"role": "assistant", "content": "Живот болит."}]
+    modifiers = [make_state_modifier("Пациенту хуже.", dialogue)]
+    before = build_patient_messages("system", dialogue, modifiers)
+    assert roles(before) == ["system", "user", "assistant", "user"] and STATE_MODIFIERS_HEADER in before[-1]["content"]
+    after = build_patient_messages("system", dialogue + [{"role": "user", "content": "Давно?"}], modifiers)
+    assert after[:3] == before[:3] and roles(after) == ["system", "user", "assistant", "user"]
+    assert after[-1]["content"].startswith(f"({STATE_MODIFIERS_HEADER}\nПациенту хуже.)") and after[-1]["content"].endswith("Давно?")
+
+
+def test_summary_goes_into_the_single_system_message():
+    dialogue = [{"role": "user", "content": "Что беспокоит?"}, {"role": "assistant", "content": "Живот болит."}]
+    messages = build_patient_messages("system", dialogue, history_view={"summary": "Болит живот.", "start_index": 0, "pinned_indices": []})
+    assert roles(messages).count("system") == 1 and "Болит живот." in messages[0]["content"]
@@ -0,0 +1,36 @@
+import pytest
+
+from scenario_pool import InMemoryPoolStorage, SQLitePoolStorage, make_pool_key
+
+SURGERY_MALE = make_pool_key("30-40", "Мужской", "Хирургия", "Средний")
+SURGERY_FEMALE = make_pool_key("30-40", "Женский", "Хирургия", "Средний")
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    return InMemoryPoolStorage() if request.param == "memory" else SQLitePoolStorage(str(tmp_path / "pool.sqlite3"))
+
+
+def test_exact_key_is_served_in_order(storage):
+    storage.put(SURGERY_MALE, {"id": 1}); storage.put(SURGERY_FEMALE, {"id": 2}); storage.put(SURGERY_MALE, {"id": 3})
+    assert storage.pop(SURGERY_MALE) == {"id": 1}
+    assert storage.pop(SURGERY_MALE) == {"id": 3}
+    assert storage.pop(SURGERY_MALE) is None
+    assert storage.sizes() == {SURGERY_FEMALE: 1}
+
+
+def test_any_value_accepts_specific_scenarios_but_not_the_reverse(storage):
+    storage.put(SURGERY_FEMALE, {"id": 2})
+    assert storage.pop(SURGERY_MALE) is None
+    assert storage.pop(make_pool_key("30-40", "Любой", "Хирургия", "Средний")) == {"id": 2}
+    storage.put(make_pool_key(), {"id": 4})
+    assert storage.pop(SURGERY_MALE) is None
+
+
+def test_refill_claim_is_exclusive_until_expired(tmp_path):
+    storage = SQLitePoolStorage(str(tmp_path / "pool.sqlite3"))
+    assert storage.try_claim(SURGERY_MALE, "a", ttl=60)
+    assert not storage.try_claim(SURGERY_MALE, "b", ttl=60)
+    storage.release_claim(SURGERY_MALE, "a")
+    assert storage.try_claim(SURGERY_MALE, "b", ttl=-1)
+    assert storage.try_claim(SURGERY_MALE, "a", ttl=60)
@@ -0,0 +1,62 @@
+import copy
+
+import pytest
+
+from scenario_similarity import DEFAULT_THRESHOLD, ScenarioSimilarityIndex, build_similarity_index
+from scenarios_data import SCENARIOS
+
+
+def reworded(scenario, scenario_id):
+    # Тот же случай другими словами: диагноз тот же, часть текста изменена.
+    copy_scenario = copy.deepcopy(scenario)
+    copy_scenario["id"] = scenario_id
+    copy_scenario["name"] = copy_scenario["name"] + " (вариант)"
+    copy_scenario["patient_initial_info_display"] = "Обратился повторно. " + copy_scenario["patient_initial_info_display"]
+    return copy_scenario
+
+
+@pytest.fixture
+def index():
+    return build_similarity_index(SCENARIOS + [reworded(SCENARIOS[0], "dup_0")])
+
+
+def test_identical_signatures_have_similarity_one(index):
+    signature = index.signature(SCENARIOS[0])
+    assert index.similarity(signature, signature) == 1.0
+
+
+def test_reworded_scenario_is_a_near_duplicate(index):
+    matches = dict(index.similar_to("dup_0"))
+    assert SCENARIOS[0]["id"] in matches and matches[SCENARIOS[0]["id"]] >= DEFAULT_THRESHOLD
+    assert index.near_duplicate_groups() == [sorted(["dup_0", SCENARIOS[0]["id"]])]
+
+
+def test_distinct_builtin_scenarios_are_not_duplicates():
+    index = build_similarity_index(SCENARIOS)
+    assert index.near_duplicate_groups() == []
+    for scenario in SCENARIOS:
+        assert index.similar_to(scenario["id"]) == []
+
+
+def test_low_threshold_compares_against_every_scenario(index):
+    # Ниже порога LSH кандидаты без общей полосы тоже находятся.
+    low = index.similar_to(SCENARIOS[0]["id"], threshold=0.0, limit=None)
+    assert len(low) == len(index) - 1
+
+
+def test_query_excludes_and_remove_forgets(index):
+    assert all(scenario_id != "dup_0" for scenario_id, _ in index.query(SCENARIOS[0], exclude_id="dup_0"))
+    index.remove("dup_0")
+    assert "dup_0" not in dict(index.similar_to(SCENARIOS[0]["id"], threshold=0.0, limit=None))
+    assert index.describe("dup_0") == ("", "")
+
+
+def test_signatures_are_deterministic():
+    first, second = ScenarioSimilarityIndex(), ScenarioSimilarityIndex()
+    assert (first.signature(SCENARIOS[1]) == second.signature(SCENARIOS[1])).all()
+
+
+def test_empty_scenario_is_not_indexed():
+    index = ScenarioSimilarityIndex()
+    index.add("empty", {"id": "empty"})
+    assert len(index) == 0 and index.query({"id": "other"}) == []
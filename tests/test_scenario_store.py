@@ -0,0 +1,52 @@
+import json
+
+from scenario_store import ScenarioStore
+from scenarios_data import SCENARIOS
+
+
+def make_store():
+    store = ScenarioStore(); store.sync(SCENARIOS)
+    return store
+
+
+def test_search_ids_matches_inflected_complaints():
+    store = make_store()
+    assert SCENARIOS[0]["id"] in store.search_ids("боли живота")
+    assert store.search_ids("") is None
+    assert store.search_ids("несуществующееслово") == set()
+
+
+def test_search_does_not_reveal_the_diagnosis():
+    store = make_store()
+    assert "аппендицит" in SCENARIOS[0]["true_diagnosis_internal"].lower()
+    assert store.search_ids("аппендицит") == set()
+
+
+def test_put_upserts_in_place_and_appends_new_ids():
+    store = make_store()
+    store.put(dict(SCENARIOS[1], name="Обновленный"))
+    store.put(dict(SCENARIOS[1], id="new_id"))
+    entries = store.entries()
+    assert len(entries) == len(SCENARIOS) + 1
+    assert entries[1]["name"] == "Обновленный" and entries[-1]["id"] == "new_id"
+    assert store.get(SCENARIOS[1]["id"])["name"] == "Обновленный"
+
+
+def test_duplicate_ids_keep_the_first_source_across_restarts(tmp_path):
+    catalog = tmp_path / "catalog.jsonl"
+    catalog.write_text(json.dumps(dict(SCENARIOS[0], name="Дубликат"), ensure_ascii=False) + "\n", encoding="utf-8")
+    db_path = str(tmp_path / "index.sqlite3")
+    for _ in range(2):
+        notices = []
+        store = ScenarioStore(db_path); store.sync(SCENARIOS, [str(catalog)], notify=lambda level, message: notices.append(message))
+        assert store.get(SCENARIOS[0]["id"])["name"] == SCENARIOS[0]["name"]
+        assert len(store) == len(SCENARIOS) and any("дубликат" in notice for notice in notices)
+
+
+def test_filter_and_version():
+    store = make_store()
+    version = store.version
+    difficulty = SCENARIOS[0]["difficulty_level_tag"]
+    assert all(entry["difficulty"] == difficulty for entry in store.filter(difficulty=difficulty))
+    store.put(dict(SCENARIOS[0], id="another"))
+    assert store.version > version
@@ -0,0 +1,53 @@
+import pytest
+
+from session_store import SQLiteSessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), flush_interval=0.01)
+    yield store
+    store.close()
+
+
+def evaluated_session(store, session_id, learner_id, score, job_id=None):
+    store.start_session(session_id, learner_id, {"id": "sc1", "name": "Сценарий", "difficulty_level_tag": "Легкий"})
+    store.append_messages(session_id, 0, [{"role": "user", "content": "Что беспокоит?"}, {"role": "assistant", "content": "Живот болит."}])
+    store.submit_session(session_id, 90, "1 мин 30 сек", True, 1)
+    store.record_evaluation(session_id, job_id or f"job-{session_id}", {"overall_score": score, "score_breakdown": {"anamnesis_collection": {"score": score}},
+                                                                       "identified_scenario_mistakes_ids": ["m1", "m1"]})
+
+
+def test_history_lists_only_evaluated_sessions_of_the_learner(store):
+    evaluated_session(store, "s1", "alice", 7)
+    evaluated_session(store, "s2", "bob", 5)
+    store.start_session("s3", "alice", {"id": "sc1"})
+    store.flush()
+    assert store.count_history("alice") == 1
+    [entry] = store.list_history("alice")
+    assert entry["score"] == 7 and entry["time_taken"] == "1 мин 30 сек" and entry["timer_active"] and entry["consultations_used"] == 1
+    assert [m["content"] for m in store.get_session_messages("s1")] == ["Что беспокоит?", "Живот болит."]
+
+
+def test_recording_the_same_job_twice_does_not_duplicate_rows(store):
+    evaluated_session(store, "s1", "alice", 7)
+    store.record_evaluation("s1", "job-s1", {"overall_score": 7, "score_breakdown": {"anamnesis_collection": {"score": 7}}, "identified_scenario_mistakes_ids": ["m1"]})
+    store.flush()
+    rows = store.cohort_rows()
+    assert len(rows["sessions"]) == 1 and rows["scores"] == [("s1", "anamnesis_collection", 7)] and rows["mistakes"] == [("s1", "m1")]
+
+
+def test_cohort_rows_after_a_version_return_only_new_evaluations(store):
+    evaluated_session(store, "s1", "alice", 7); store.flush()
+    _, last_evaluation = store.data_version()
+    evaluated_session(store, "s2", "bob", 5); store.flush()
+    assert [row[0] for row in store.cohort_rows(after_evaluation=last_evaluation)["sessions"]] == ["s2"]
+    assert store.data_version() != (1, last_evaluation)
+
+
+def test_clear_history_removes_only_the_learner(store):
+    evaluated_session(store, "s1", "alice", 7)
+    evaluated_session(store, "s2", "bob", 5)
+    store.clear_history("alice"); store.flush()
+    assert store.count_history("alice") == 0 and store.count_history("bob") == 1
+    assert store.get_session_messages("s1") == []
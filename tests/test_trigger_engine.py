@@ -0,0 +1,62 @@
+from trigger_engine import (EXAM_NOT_PERFORMED, MISSED_KEY_QUESTION, TRIGGER_MESSAGE_KEY, VITALS_DETERIORATION,
+                            TriggerEngine)
+
+
+def engine_with(*triggers):
+    return TriggerEngine({"dynamic_state_triggers": list(triggers)}, started_at=0)
+
+
+def test_missed_key_question_fires_only_when_the_question_was_not_asked():
+    trigger = {"condition_type": MISSED_KEY_QUESTION, "key_question_keyword": "аллергия", "turns_to_trigger": 2,
+               "patient_response_cue": "У меня аллергия на пенициллин."}
+    engine = engine_with(trigger)
+    assert engine.next_firing(turn=1, now=0) is None
+    firing = engine.next_firing(turn=2, now=0)
+    assert firing["message"]["content"].endswith("У меня аллергия на пенициллин.") and firing["message"][TRIGGER_MESSAGE_KEY] == 0
+    assert engine.next_firing(turn=3, now=0) is None  # один раз
+
+    asked = engine_with(trigger)
+    asked.on_user_message("Есть ли у вас аллергия на лекарства?", 1)
+    assert asked.next_firing(turn=5, now=0) is None
+
+
+def test_vitals_deterioration_is_prevented_by_the_ordered_investigation():
+    trigger = {"condition_type": VITALS_DETERIORATION, "turns_to_trigger": 2, "unless_investigation_ordered": "ecg",
+               "vitals_update": {"pulse": "130 уд/мин"}}
+    engine = engine_with(trigger)
+    engine.on_investigation_ordered("ecg", 1)
+    assert engine.next_firing(turn=3, now=0) is None and engine.vitals_overrides() == {}
+
+    engine = engine_with(trigger)
+    firing = engine.next_firing(turn=2, now=0)
+    assert firing["message"] is None and "130 уд/мин" in firing["modifier"]
+    assert engine.vitals_overrides() == {"pulse": "130 уд/мин"}
+
+
+def test_one_trigger_per_turn_in_scenario_order():
+    first = {"condition_type": EXAM_NOT_PERFORMED, "exam": "pulse", "by_turn": 1, "modify_system_prompt_add": "Первый."}
+    second = {"condition_type": VITALS_DETERIORATION, "minutes_elapsed": 5, "modify_system_prompt_add": "Второй."}
+    engine = engine_with(first, second)
+    assert engine.next_firing(turn=1, now=600)["modifier"] == "Первый."
+    assert engine.next_firing(turn=1, now=600)["modifier"] == "Второй."
+    assert engine.next_firing(turn=2, now=600) is None
+
+
+def test_invalid_triggers_are_dropped():
+    engine = engine_with({"condition_type": MISSED_KEY_QUESTION, "turns_to_trigger": 1, "patient_response_cue": "нет ключевого слова"},
+                         {"condition_type": "unknown", "patient_response_cue": "?"},
+                         {"condition_type": VITALS_DETERIORATION, "vitals_update": {"pulse": "130"}})
+    assert len(engine) == 0
+
+
+def test_replay_restores_state_from_the_dialogue():
+    triggers = [{"condition_type": EXAM_NOT_PERFORMED, "exam": "pulse", "by_turn": 2, "modify_system_prompt_add": "Пульс не проверен."},
+                {"condition_type": VITALS_DETERIORATION, "turns_to_trigger": 1, "vitals_update": {"pulse": "130 уд/мин"},
+                 "patient_response_cue": "Мне хуже."}]
+    engine = engine_with(*triggers)
+    engine.replay([{"role": "user", "content": "Проверяю пульс."},
+                   {"role": "assistant", "content": "Мне хуже.", TRIGGER_MESSAGE_KEY: 1},
+                   {"role": "user", "content": "Что беспокоит?"}], pending_investigations=["ecg"])
+    assert engine.fired == {1} and engine.exams_done == {"pulse": 1} and engine.investigations_ordered == {"ecg": 2}
+    assert engine.vitals_overrides() == {"pulse": "130 уд/мин"}
+    assert engine.next_firing(turn=2, now=0) is None
@@ -0,0 +1,142 @@
+import time
+
+from constants import PHYSICAL_EXAM_KEYWORDS
+from keyword_matcher import KeywordMatcher
+
+# --- Динамические триггеры сценария ---
+# Состояние сессии (заданные вопросы, проведенные осмотры, назначенные исследования,
+# ключевые слова в ответах пациента) обновляется по событиям: каждое новое сообщение
+# разбирается один раз. Проверка триггеров в конце хода не перечитывает диалог — каждое
+# условие проверяется по накопленному состоянию за O(1). Каждый триггер срабатывает не
+# более одного раза; за ход срабатывает не больше одного триггера (остальные — на следующих ходах).
+#
+# Типы условий (condition_type) и их поля:
+#   missed_key_question         key_question_keyword, turns_to_trigger — врач так и не спросил
+#   after_llm_response_contains keyword_in_llm_response, turns_to_trigger_after_keyword
+#   elapsed_time                minutes_elapsed — с начала сценария
+#   vitals_deterioration        turns_to_trigger и/или minutes_elapsed, vitals_update {показатель: значение},
+#                               unless_investigation_ordered — не срабатывает, если исследование уже назначено
+#   investigation_ordered       investigation, turns_after (по умолчанию 0)
+#   investigation_not_ordered   investigation, by_turn
+#   exam_not_performed          exam (ключ PHYSICAL_EXAM_KEYWORDS), by_turn
+# Общие поля: patient_response_cue (реплика пациента), modify_system_prompt_add (модификатор состояния).
+
+MISSED_KEY_QUESTION = "missed_key_question"
+AFTER_LLM_RESPONSE_CONTAINS = "after_llm_response_contains"
+ELAPSED_TIME = "elapsed_time"
+VITALS_DETERIORATION = "vitals_deterioration"
+INVESTIGATION_ORDERED = "investigation_ordered"
+INVESTIGATION_NOT_ORDERED = "investigation_not_ordered"
+EXAM_NOT_PERFORMED = "exam_not_performed"
+
+REQUIRED_TRIGGER_FIELDS = {
+    MISSED_KEY_QUESTION: ["key_question_keyword", "turns_to_trigger"],
+    AFTER_LLM_RESPONSE_CONTAINS: ["keyword_in_llm_response"],
+    ELAPSED_TIME: ["minutes_elapsed"],
+    VITALS_DETERIORATION: [],
+    INVESTIGATION_ORDERED: ["investigation"],
+    INVESTIGATION_NOT_ORDERED: ["investigation", "by_turn"],
+    EXAM_NOT_PERFORMED: ["exam", "by_turn"],
+}
+TRIGGER_TOASTS = {
+    MISSED_KEY_QUESTION: ("Пациент что-то вспомнил и добавил информацию!", "💡"),
+    VITALS_DETERIORATION: ("Состояние пациента ухудшилось!", "⚠️"),
+}
+DEFAULT_TRIGGER_TOAST = ("Состояние пациента изменилось.", "💬")
+TRIGGER_MESSAGE_KEY = "trigger_index"  # отметка в сообщении-реплике триггера, чтобы восстановить состояние по диалогу
+
+_exam_matcher = KeywordMatcher((keyword, exam_key) for exam_key, keywords in PHYSICAL_EXAM_KEYWORDS.items() for keyword in keywords)
+
+
+def _is_valid_trigger(trigger):
+    if not isinstance(trigger, dict) or trigger.get("condition_type") not in REQUIRED_TRIGGER_FIELDS: return False
+    if any(trigger.get(field) in (None, "") for field in REQUIRED_TRIGGER_FIELDS[trigger["condition_type"]]): return False
+    if trigger["condition_type"] == VITALS_DETERIORATION and trigger.get("turns_to_trigger") is None and trigger.get("minutes_elapsed") is None: return False
+    return bool(trigger.get("patient_response_cue") or trigger.get("modify_system_prompt_add") or trigger.get("vitals_update"))
+
+
+class TriggerEngine:
+    def __init__(self, scenario, started_at=None):
+        self.started_at = time.time() if started_at is None else started_at
+        self.triggers = [t for t in scenario.get("dynamic_state_triggers", []) or [] if _is_valid_trigger(t)]
+        self._question_matcher = KeywordMatcher((t["key_question_keyword"], i) for i, t in enumerate(self.triggers) if t["condition_type"] == MISSED_KEY_QUESTION)
+        self._response_matcher = KeywordMatcher((t["keyword_in_llm_response"], i) for i, t in enumerate(self.triggers) if t["condition_type"] == AFTER_LLM_RESPONSE_CONTAINS)
+        self.asked = set()  # индексы missed_key_question, чей вопрос уже задан
+        self.response_seen_turn = {}  # индекс триггера -> ход, на котором пациент произнес ключевое слово
+        self.investigations_ordered = {}  # ключ исследования -> ход назначения
+        self.exams_done = {}  # ключ осмотра -> ход
+        self.fired = set()
+
+    def __len__(self):
+        return len(self.triggers)
+
+    # --- События ---
+    def on_user_message(self, text, turn):
+        self.asked |= self._question_matcher.match(text)
+        for exam_key in _exam_matcher.match(text): self.exams_done.setdefault(exam_key, turn)
+
+    def on_patient_message(self, text, turn):
+        for i in self._response_matcher.match(text): self.response_seen_turn.setdefault(i, turn)
+
+    def on_investigation_ordered(self, inv_key, turn):
+        self.investigations_ordered.setdefault(inv_key, turn)
+
+    def replay(self, messages, pending_investigations=None):
+        # Восстановление состояния по уже накопленному диалогу (сессия без движка).
+        turn = 0
+        for message in messages:
+            if message["role"] == "user": turn += 1; self.on_user_message(message["content"], turn)
+            elif message.get(TRIGGER_MESSAGE_KEY) is not None: self.fired.add(message[TRIGGER_MESSAGE_KEY])
+            else: self.on_patient_message(message["content"], turn)
+        for inv_key in pending_investigations or []: self.on_investigation_ordered(inv_key, turn)
+
+    def vitals_overrides(self):
+        # Данные осмотра из vitals_update всех сработавших триггеров (более поздний в сценарии перекрывает ранний).
+        overrides = {}
+        for i in sorted(self.fired):
+            if i < len(self.triggers) and isinstance(self.triggers[i].get("vitals_update"), dict): overrides.update(self.triggers[i]["vitals_update"])
+        return overrides
+
+    # --- Проверка условий ---
+    def _is_due(self, i, trigger, turn, minutes):
+        condition_type = trigger["condition_type"]
+        if condition_type == MISSED_KEY_QUESTION:
+            return i not in self.asked and turn >= trigger["turns_to_trigger"]
+        if condition_type == AFTER_LLM_RESPONSE_CONTAINS:
+            return i in self.response_seen_turn and turn >= self.response_seen_turn[i] + (trigger.get("turns_to_trigger_after_keyword") or 0)
+        if condition_type == ELAPSED_TIME:
+            return minutes >= trigger["minutes_elapsed"]
+        if condition_type == VITALS_DETERIORATION:
+            if trigger.get("unless_investigation_ordered") in self.investigations_ordered: return False
+            return turn >= (trigger.get("turns_to_trigger") or 0) and minutes >= (trigger.get("minutes_elapsed") or 0)
+        if condition_type == INVESTIGATION_ORDERED:
+            ordered_turn = self.investigations_ordered.get(trigger["investigation"])
+            return ordered_turn is not None and turn >= ordered_turn + (trigger.get("turns_after") or 0)
+        if condition_type == INVESTIGATION_NOT_ORDERED:
+            return trigger["investigation"] not in self.investigations_ordered and turn >= trigger["by_turn"]
+        if condition_type == EXAM_NOT_PERFORMED:
+            return trigger["exam"] not in self.exams_done and turn >= trigger["by_turn"]
+        return False
+
+    def next_firing(self, turn, now=None):
+        # Первый созревший триггер в порядке сценария; помечается сработавшим.
+        minutes = ((time.time() if now is None else now) - self.started_at) / 60
+        for i, trigger in enumerate(self.triggers):
+            if i in self.fired or not self._is_due(i, trigger, turn, minutes): continue
+            self.fired.add(i)
+            return self._firing(i, trigger)
+        return None
+
+    def _firing(self, i, trigger):
+        cue = trigger.get("patient_response_cue")
+        modifier_parts = []
+        if trigger.get("modify_system_prompt_add"): modifier_parts.append(trigger["modify_system_prompt_add"])
+        elif cue: modifier_parts.append(f"Пациент дополнительно сообщил следующее: {cue}")
+        if isinstance(trigger.get("vitals_update"), dict) and trigger["vitals_update"]:
+            modifier_parts.append("Актуальные данные осмотра (используй вместо прежних): " + "; ".join(f"{k}: {v}" for k, v in trigger["vitals_update"].items()))
+        message = None
+        if cue:
+            message = {"role": "assistant", "content": f"(Пациент внезапно вспоминает) {cue}" if trigger["condition_type"] == MISSED_KEY_QUESTION else cue,
+                       "pinned": True, TRIGGER_MESSAGE_KEY: i}
+        toast_text, toast_icon = TRIGGER_TOASTS.get(trigger["condition_type"], DEFAULT_TRIGGER_TOAST)
+        return {"message": message, "modifier": " ".join(modifier_parts), "toast": toast_text, "toast_icon": toast_icon}